@@ -0,0 +1,46 @@
+{ apiToken ? "changeme"
+, location ? "nbg1" }:
+let
+  backend =
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        inherit apiToken location;
+        serverType = "cx11";
+        labels.role = "web";
+      };
+      services.nginx.enable = true;
+      networking.firewall.allowedTCPPorts = [ 80 ];
+    };
+in
+{
+  network.description = "Hetzner Cloud load balancer example deployment";
+
+  resources.hetznerCloudLoadBalancers.lb1 =
+    { resources, ... }:
+    {
+      inherit apiToken location;
+      balancerType = "lb11";
+      # Machines of this deployment such as resources.machines.web1, or names
+      # of servers not managed by NixOps.
+      targets = [ "legacy-web" ];
+      # Every server labelled role=web joins the pool, including ones created
+      # later, without any change to the load balancer.
+      labelSelectors = [ "role=web" ];
+      services = [
+        { protocol = "http";
+          listenPort = 80;
+          destinationPort = 80;
+          healthCheck = {
+            protocol = "http";
+            port = 80;
+            http = { domain = "example.com"; path = "/"; response = ""; };
+          };
+        }
+      ];
+    };
+
+  web1 = backend;
+  web2 = backend;
+}
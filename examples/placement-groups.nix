@@ -0,0 +1,26 @@
+{ apiToken ? "changeme"
+, location ? "nbg1" }:
+let
+  replica =
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        inherit apiToken location;
+        serverType = "cx11";
+        # Each replica goes to whichever group holds the fewest servers, so
+        # no two replicas in the same group share a physical host.
+        placementGroup = with resources.hetznerCloudPlacementGroups; [ db1 db2 ];
+      };
+    };
+in
+{
+  network.description = "Hetzner Cloud placement group example deployment";
+
+  resources.hetznerCloudPlacementGroups.db1 = { inherit apiToken; };
+  resources.hetznerCloudPlacementGroups.db2 = { inherit apiToken; };
+
+  replica1 = replica;
+  replica2 = replica;
+  replica3 = replica;
+}
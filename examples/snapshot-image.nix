@@ -0,0 +1,29 @@
+{ apiToken ? "changeme"
+, location ? "nbg1" }:
+let
+  machine =
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        inherit apiToken location;
+        serverType = "cx11";
+        # Boot straight into NixOS instead of running nixos-infect.
+        image = resources.hetznerCloudImages.nixos;
+      };
+    };
+in
+{
+  network.description = "Hetzner Cloud snapshot image example deployment";
+
+  machine1 = machine;
+  machine2 = machine;
+  machine3 = machine;
+
+  # Built once, on a temporary server of the same architecture as the machines.
+  resources.hetznerCloudImages.nixos = {
+    inherit apiToken location;
+    serverType = "cx11";
+  };
+
+}
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# Discovery of a Hetzner Cloud server's newly attached volume devices.
+
+import shlex
+
+from nixops_hetznercloud.hetznercloud_trace import tracer
+
+from typing import Any, Dict
+
+# How long to wait for udev to create the devices, in seconds.
+DEVICE_TIMEOUT = 60
+
+# Waits for udev to create every device path given as an argument, then
+# reports what each resolves to, or nothing for those that never appeared.
+DISCOVER_SCRIPT = r"""
+deadline=$(( $(date +%s) + {timeout} ))
+while :; do
+    missing=0
+    for dev in "$@"; do
+        [ -e "$dev" ] || missing=1
+    done
+    [ $missing -eq 0 ] || [ "$(date +%s)" -ge $deadline ] && break
+    udevadm settle --timeout=5 2>/dev/null
+    sleep 0.2
+done
+i=0
+for dev in "$@"; do
+    if [ -e "$dev" ]; then
+        printf 'nixops-device %s %s\n' $i "$(readlink -f "$dev")"
+    fi
+    i=$((i + 1))
+done
+[ $missing -eq 0 ] || lsblk | sed 's/^/nixops-lsblk /'
+"""
+
+
+def wait_for_devices(
+    machine: Any, devices: Dict[str, str], timeout: int = DEVICE_TIMEOUT
+) -> Dict[str, str]:
+    """
+    Wait in a single SSH command until the device path of every volume in
+    ``devices`` exists on a machine, returning the block device each
+    resolves to.
+    """
+    if not devices:
+        return {}
+    names = list(devices)
+    command = "bash -c {} nixops-devices {}".format(
+        shlex.quote(DISCOVER_SCRIPT.format(timeout=timeout)),
+        " ".join(shlex.quote(devices[name]) for name in names),
+    )
+    machine.logger.log_start(
+        f"waiting for {len(names)} volume device{'s' if len(names) > 1 else ''}..."
+    )
+    with tracer.span("wait for devices", "ssh", volumes=", ".join(names)):
+        output = machine.run_command(command, capture_stdout=True, check=False) or ""
+
+    resolved: Dict[str, str] = {}
+    lsblk = []
+    for line in output.splitlines():
+        words = line.split(" ", 2)
+        if words[0] == "nixops-device" and len(words) == 3 and words[2]:
+            resolved[names[int(words[1])]] = words[2]
+        elif words[0] == "nixops-lsblk":
+            lsblk.append(line[len("nixops-lsblk ") :])
+
+    missing = [name for name in names if name not in resolved]
+    if missing:
+        machine.logger.log_end("(timed out)")
+        for name in missing:
+            machine.logger.log(f"can't find device ‘{devices[name]}’...")
+        if lsblk:
+            machine.logger.log("available devices:")
+            for line in lsblk:
+                machine.logger.log(f"  {line}")
+        raise Exception("operation timed out")
+    machine.logger.log_end("")
+    return resolved
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Moving floating IPs to a standby machine outside of a deploy.
+
+import time
+
+from nixops.deployment import Deployment
+
+from nixops_hetznercloud import hetznercloud_async
+from nixops_hetznercloud.hetznercloud_async import gather
+from nixops_hetznercloud.hetznercloud_trace import tracer
+from nixops_hetznercloud.resources.floating_ip import FloatingIPState
+
+from typing import List, Sequence
+
+from .hetznercloud import HetznerCloudState
+
+# How often an assignment is retried while the server is locked by another,
+# and how soon the assignments are first checked, in seconds.
+FAILOVER_INTERVAL = 0.1
+
+
+def failover(depl: Deployment, standby: str, floating_ips: Sequence[str]) -> float:
+    """
+    Assign floating IPs of a deployment to its machine ``standby``,
+    returning how many seconds it took.
+
+    Only the IDs in the deployment's state are used, so the network isn't
+    evaluated and no other machine is checked. All of the IPs are assigned
+    at once, and this returns as soon as every assignment has succeeded.
+    """
+    machine = depl.resources.get(standby)
+    if not isinstance(machine, HetznerCloudState) or machine.vm_id is None:
+        raise Exception(f"‘{standby}’ isn't a Hetzner Cloud machine with a server")
+    fips: List[FloatingIPState] = []
+    for name in floating_ips:
+        fip = depl.resources.get(name)
+        if not isinstance(fip, FloatingIPState) or fip.resource_id is None:
+            raise Exception(f"‘{name}’ isn't a floating IP of the deployment")
+        fips.append(fip)
+
+    client = machine.get_async_client()
+
+    async def assign() -> None:
+        responses = await gather(
+            [
+                client.start_action(
+                    "floating_ips",
+                    fip.resource_id,
+                    "assign",
+                    {"server": machine.vm_id},
+                    retry_interval=FAILOVER_INTERVAL,
+                )
+                for fip in fips
+            ]
+        )
+        await client.wait_for_actions(
+            [x["action"] for x in responses], poll_interval=FAILOVER_INTERVAL
+        )
+
+    machine.logger.log(
+        f"assigning floating IPs {', '.join(floating_ips)} to {machine.full_name}..."
+    )
+    start = time.monotonic()
+    with tracer.span("failover", "api"):
+        hetznercloud_async.run(assign())
+    seconds = time.monotonic() - start
+
+    # The IPs move to the standby's state along with the assignment, so that
+    # the state matches Hetzner Cloud. The machines which held them forget
+    # them, and the next deploy assigns them back wherever the specification
+    # puts them.
+    machines = [x for x in depl.resources.values() if isinstance(x, HetznerCloudState)]
+    with depl._db:
+        for fip in fips:
+            key = f"nixops-{depl.uuid}-{fip.name}"
+            for m in machines:
+                if m is not machine and key in m.ip_addresses:
+                    m._update_attr("ip_addresses", key, None)
+                    m.forget_instance()
+            machine._update_attr("ip_addresses", key, fip.address)
+            machine.get_snapshot().forget("floating_ips", fip.resource_id)
+    machine.forget_instance()
+
+    machine.logger.log(f"failed over in {seconds:.2f}s")
+    return seconds
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+# Fleet-wide operations on many Hetzner Cloud machines at once.
+
+import asyncio
+import threading
+import time
+
+from hcloud import APIException
+
+from nixops_hetznercloud import hetznercloud_async
+from nixops_hetznercloud.hetznercloud_async import AsyncClient, gather
+from nixops_hetznercloud.hetznercloud_readiness import get_readiness_monitor
+
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+if TYPE_CHECKING:
+    from .hetznercloud import HetznerCloudState
+
+# How long the first machine to ask for an operation waits for the other
+# machines of its deployment to join the batch, in seconds.
+BATCH_WINDOW = 0.05
+
+
+class FleetError(Exception):
+    """
+    Raised when an operation failed on some of the machines, holding each
+    of their errors by machine name.
+    """
+
+    def __init__(self, errors: Dict[str, BaseException]) -> None:
+        super().__init__("; ".join(f"{name}: {e}" for name, e in errors.items()))
+        self.errors = errors
+
+
+def _with_servers(
+    machines: Sequence["HetznerCloudState"],
+) -> List["HetznerCloudState"]:
+    return [m for m in machines if m.vm_id is not None]
+
+
+async def _each(
+    machines: Sequence["HetznerCloudState"],
+    run: Callable[["HetznerCloudState"], Awaitable[Any]],
+) -> Dict[str, BaseException]:
+    results = await asyncio.gather(*(run(m) for m in machines), return_exceptions=True)
+    return {
+        m.name: result
+        for m, result in zip(machines, results)
+        if isinstance(result, BaseException)
+    }
+
+
+def _power(
+    machines: Sequence["HetznerCloudState"], command: str
+) -> Tuple[List["HetznerCloudState"], Dict[str, BaseException]]:
+    errors = hetznercloud_async.run(
+        _each(
+            machines, lambda m: m.get_async_client().action("servers", m.vm_id, command)
+        )
+    )
+    for m in machines:
+        m.forget_instance()
+        m.logger.log_end("")
+    return [m for m in machines if m.name not in errors], errors
+
+
+def _wait_for_ssh(
+    machines: Sequence["HetznerCloudState"], errors: Dict[str, BaseException]
+) -> None:
+    # The readiness monitor polls for every machine at once, so waiting on
+    # one machine after another takes as long as the slowest of them.
+    for m in machines:
+        try:
+            m.wait_for_ssh()
+        except Exception as e:
+            errors[m.name] = e
+            continue
+        m.state = m.UP
+    if errors:
+        raise FleetError(errors)
+
+
+def start(machines: Sequence["HetznerCloudState"]) -> None:
+    """
+    Power on machines and wait until all of them accept SSH connections.
+    """
+    machines, errors = _power(_with_servers(machines), "poweron")
+    _wait_for_ssh(machines, errors)
+
+
+def stop(machines: Sequence["HetznerCloudState"]) -> None:
+    """
+    Send machines an ACPI shutdown request and wait until all are off.
+    """
+    machines, errors = _power(_with_servers(machines), "shutdown")
+    monitor = get_readiness_monitor()
+    monitor.wait(
+        [
+            monitor.watch_status(
+                m.get_client(), m.vm_id, "off", f"CharonNetworkUUID={m.depl.uuid}"
+            )
+            for m in machines
+        ]
+    )
+    for m in machines:
+        m.forget_instance()
+        m.state = m.STOPPED
+    if errors:
+        raise FleetError(errors)
+
+
+def reboot(machines: Sequence["HetznerCloudState"], hard: bool = False) -> None:
+    """
+    Reboot machines, or hard reset them, and wait until all of them accept
+    SSH connections again.
+    """
+    machines, errors = _power(_with_servers(machines), "reset" if hard else "reboot")
+    _wait_for_ssh(machines, errors)
+
+
+async def _get_statuses(
+    machines: Sequence["HetznerCloudState"],
+) -> Dict[str, Optional[str]]:
+    groups: Dict[Tuple[int, str], Tuple[AsyncClient, List["HetznerCloudState"]]] = {}
+    for m in machines:
+        client = m.get_async_client()
+        groups.setdefault((id(client), m.depl.uuid), (client, []))[1].append(m)
+
+    async def list_servers(client: AsyncClient, uuid: str) -> Dict[int, Optional[str]]:
+        servers = await client.get_all("servers", f"CharonNetworkUUID={uuid}")
+        return {x["id"]: x["status"] for x in servers}
+
+    keys = list(groups)
+    listed = await gather([list_servers(groups[k][0], k[1]) for k in keys])
+    statuses: Dict[str, Optional[str]] = {}
+    for key, servers in zip(keys, listed):
+        for m in groups[key][1]:
+            statuses[m.name] = servers.get(m.vm_id)
+    return statuses
+
+
+def check(machines: Sequence["HetznerCloudState"]) -> Dict[str, Optional[str]]:
+    """
+    Get the status of every machine's server with one labelled list request
+    per deployment, or None for servers which no longer exist.
+    """
+    machines = _with_servers(machines)
+    if not machines:
+        return {}
+    return hetznercloud_async.run(_get_statuses(machines))
+
+
+def destroy(machines: Sequence["HetznerCloudState"]) -> None:
+    """
+    Destroy machines, detaching their volumes and deleting their servers and
+    SSH keys concurrently.
+    """
+    plans: Dict[str, Dict[str, Any]] = {}
+    errors: Dict[str, BaseException] = {}
+    for m in machines:
+        if m.state != m.UP:
+            continue
+        m.logger.log(f"destroying {m.full_name}")
+        try:
+            plans[m.name] = m._plan_destroy()
+        except Exception as e:
+            errors[m.name] = e
+    planned = [m for m in machines if m.name in plans]
+    errors.update(
+        hetznercloud_async.run(
+            _each(planned, lambda m: m._destroy_async(plans[m.name]))
+        )
+    )
+    for m in planned:
+        if m.name not in errors:
+            m._finish_destroy(plans[m.name])
+    if errors:
+        raise FleetError(errors)
+
+
+class Batch(object):
+    """
+    The machines taking part in one run of a fleet operation.
+    """
+
+    def __init__(self) -> None:
+        self.machines: List["HetznerCloudState"] = []
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class Batcher(object):
+    """
+    Runs a fleet operation once for all the machines of a deployment which
+    ask for it at about the same time.
+
+    NixOps starts, stops, reboots, checks and destroys machines, and removes
+    their backups, from one thread each. The first machine to ask opens a
+    batch and waits briefly for the others to join it. Then one fleet call
+    covers all of them, and each machine gets back the overall result or its
+    own error.
+    """
+
+    def __init__(self, operation: Callable[[List["HetznerCloudState"]], Any]) -> None:
+        self._operation = operation
+        self._lock = threading.Lock()
+        self._open: Optional[Batch] = None
+
+    def submit(self, machine: "HetznerCloudState") -> Any:
+        with self._lock:
+            batch = self._open
+            leader = batch is None
+            if batch is None:
+                batch = self._open = Batch()
+            batch.machines.append(machine)
+
+        if leader:
+            time.sleep(BATCH_WINDOW)
+            with self._lock:
+                self._open = None
+            try:
+                batch.result = self._operation(batch.machines)
+            except BaseException as e:
+                batch.error = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        if isinstance(batch.error, FleetError):
+            error = batch.error.errors.get(machine.name)
+            if error is not None:
+                raise error
+        elif batch.error is not None:
+            raise batch.error
+        return batch.result
+
+
+_batchers_lock = threading.Lock()
+_batchers: Dict[Tuple[str, str], Batcher] = {}
+
+
+def get_batcher(
+    uuid: str, name: str, operation: Callable[[List["HetznerCloudState"]], Any]
+) -> Batcher:
+    """
+    Get the batcher shared by a deployment's machines for an operation.
+    """
+    with _batchers_lock:
+        batcher = _batchers.get((uuid, name))
+        if batcher is None:
+            batcher = _batchers[(uuid, name)] = Batcher(operation)
+        return batcher
+
+
+async def _create_images(
+    machines: Sequence["HetznerCloudState"], backup_id: str, wait: bool
+) -> List[Dict[str, Any]]:
+    responses = await gather(
+        [
+            m.get_async_client().start_action(
+                "servers", m.vm_id, "create_image", m._get_backup_body(backup_id)
+            )
+            for m in machines
+        ]
+    )
+    if wait:
+        groups: Dict[int, Tuple[AsyncClient, List[Dict[str, Any]]]] = {}
+        for m, response in zip(machines, responses):
+            client = m.get_async_client()
+            groups.setdefault(id(client), (client, []))[1].append(response["action"])
+        await gather([client.wait_for_actions(x) for client, x in groups.values()])
+    return responses
+
+
+def backup(
+    machines: Sequence["HetznerCloudState"], backup_id: str, wait: bool = True
+) -> None:
+    """
+    Snapshot machines' disks concurrently, recording each snapshot as their
+    backup ``backup_id``. Unless ``wait`` is false, returns once all of the
+    snapshots are available.
+    """
+    machines = _with_servers(machines)
+    responses = hetznercloud_async.run(_create_images(machines, backup_id, wait))
+    for m, response in zip(machines, responses):
+        with m.depl._db:
+            m.backups = {**m.backups, backup_id: response["image"]["id"]}
+
+
+async def _delete_image(client: AsyncClient, id: int) -> None:
+    try:
+        await client.delete("images", id)
+    except APIException as e:
+        if e.code != "not_found":
+            raise
+
+
+def remove_backups(
+    machines: Sequence["HetznerCloudState"],
+    backup_ids: Sequence[str],
+    keep_physical: bool = False,
+) -> None:
+    """
+    Forget machines' backups, deleting all of their snapshots at once unless
+    ``keep_physical`` is set.
+    """
+    removed = [
+        (m, backup_id)
+        for m in machines
+        for backup_id in backup_ids
+        if backup_id in m.backups
+    ]
+    if not keep_physical:
+        hetznercloud_async.run(
+            gather(
+                [
+                    _delete_image(m.get_async_client(), m.backups[backup_id])
+                    for m, backup_id in removed
+                ]
+            )
+        )
+    for m in machines:
+        with m.depl._db:
+            m.backups = {k: v for k, v in m.backups.items() if k not in set(backup_ids)}
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Concurrent execution of tasks which depend on each other.
+
+import contextvars
+import functools
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from typing import Callable, Dict, List, Optional, Sequence, TypeVar
+
+
+class Task(object):
+    """
+    A unit of work which may only start once the tasks it comes after have
+    finished.
+    """
+
+    def __init__(self, after: Sequence["Task"] = ()) -> None:
+        self.after = list(after)
+
+
+T = TypeVar("T", bound=Task)
+
+
+def run_graph(
+    tasks: Sequence[T],
+    run: Callable[[T], None],
+    on_success: Optional[Callable[[T], None]] = None,
+) -> None:
+    """
+    Run tasks concurrently, each as soon as the tasks it comes after have
+    succeeded, calling ``on_success`` on this thread as each one does. Once
+    a task fails no further tasks are started, and the first error is raised
+    when those already running have finished. Tasks run in a copy of the
+    caller's context, so their spans are traced to the caller's subject.
+    """
+    if not tasks:
+        return
+    done: List[T] = []
+    errors: List[BaseException] = []
+    waiting = list(tasks)
+    running: Dict[Future, T] = {}
+
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        while True:
+            if not errors:
+                for task in [x for x in waiting if set(x.after) <= set(done)]:
+                    waiting.remove(task)
+                    context = contextvars.copy_context()
+                    call = functools.partial(context.run, run, task)
+                    running[executor.submit(call)] = task
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                if (error := future.exception()) is not None:
+                    errors.append(error)
+                    continue
+                if on_success is not None:
+                    on_success(task)
+                done.append(task)
+
+    if errors:
+        raise errors[0]
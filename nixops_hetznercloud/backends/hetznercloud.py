@@ -2,19 +2,20 @@
 
 # Automatic provisioning of a Hetzner Cloud Server instance.
 
+import hashlib
+import json
 import os
 import re
-import time
 import socket
 import getpass
 
-from hcloud import APIException
 from hcloud import Client
 from hcloud.actions.client import BoundAction
 from hcloud.images.domain import Image
 from hcloud.floating_ips.client import BoundFloatingIP
-from hcloud.locations.client import BoundLocation
+from hcloud.locations.domain import Location
 from hcloud.networks.client import BoundNetwork
+from hcloud.placement_groups.domain import PlacementGroup
 from hcloud.servers.client import BoundServer
 from hcloud.servers.domain import Server
 from hcloud.server_types.domain import ServerType
@@ -26,20 +27,46 @@ from nixops.backends import MachineDefinition, MachineState
 from nixops.deployment import Deployment
 from nixops.nix_expr import RawValue
 from nixops.resources import ResourceEval, ResourceState, ResourceDefinition
-from nixops.util import attr_property, create_key_pair, check_wait
-
+from nixops.util import attr_property, create_key_pair
+
+from nixops_hetznercloud import hetznercloud_async
+from nixops_hetznercloud.hetznercloud_async import AsyncClient, gather, get_async_client
+from nixops_hetznercloud.hetznercloud_catalogue import (
+    Catalogue,
+    get_catalogue,
+    validate_offline,
+)
+from nixops_hetznercloud.hetznercloud_client import get_action_waiter, get_client
+from nixops_hetznercloud.hetznercloud_keys import SSHKeyRegistry, get_key_registry
+from nixops_hetznercloud.hetznercloud_common import INFECT_PATH
+from nixops_hetznercloud.hetznercloud_readiness import Waiter, get_readiness_monitor
+from nixops_hetznercloud.hetznercloud_snapshot import (
+    DeploymentSnapshot,
+    get_snapshot,
+    within_pass,
+)
+from nixops_hetznercloud.hetznercloud_teardown import (
+    bulk_destroy_enabled,
+    destroy_deployment,
+    forget_teardown,
+)
+from nixops_hetznercloud.hetznercloud_trace import traced, tracer
 from nixops_hetznercloud.resources.floating_ip import FloatingIPState
+from nixops_hetznercloud.resources.image import ImageState, get_architecture
 from nixops_hetznercloud.resources.network import NetworkState
+from nixops_hetznercloud.resources.placement_group import PlacementGroupState
 from nixops_hetznercloud.resources.volume import VolumeState
 
-from typing import Dict, List, Optional, Set, Any
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Any
 
+from . import fleet
+from .devices import wait_for_devices
 from .options import HetznerCloudMachineOptions
-
-
-INFECT_PATH = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), "..", "data", "nixos-infect")
-)
+from .placement import get_spread_scheduler
+from .provision import ProvisioningPipeline
+from .reconcile import ReconciliationPlan
+from .resize import ResizeQueue
+from .rolling import get_rolling_resize
 
 
 class HetznerCloudDefinition(MachineDefinition):
@@ -61,11 +88,14 @@ class HetznerCloudDefinition(MachineDefinition):
         self.location = self.config.hetznerCloud.location
         self.server_name = self.config.hetznerCloud.serverName
         self.server_type = self.config.hetznerCloud.serverType
+        self.image = self.config.hetznerCloud.image
         self.server_networks = {
             x.network: dict(x) for x in self.config.hetznerCloud.serverNetworks
         }
         self.volumes = {x.volume: dict(x) for x in self.config.hetznerCloud.volumes}
         self.ip_addresses = {x: None for x in self.config.hetznerCloud.ipAddresses}
+        self.placement_groups = list(self.config.hetznerCloud.placementGroup)
+        self.shared_ssh_key = self.config.hetznerCloud.sharedSSHKey
 
     def show_type(self):
         return f"{self.get_type()} [{self.location or '???'}]"
@@ -88,6 +118,7 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
     private_ipv4 = attr_property("privateIpv4", None)
     public_client_key = attr_property("hetznerCloud.publicClientKey", None)
     private_client_key = attr_property("hetznerCloud.privateClientKey", None)
+    shared_client_key = attr_property("hetznerCloud.sharedClientKey", False, bool)
     public_host_key = attr_property("hetznerCloud.publicHostKey", None)
     private_host_key = attr_property("hetznerCloud.privateHostKey", None)
     legacy_if_scheme = attr_property("legacyIfScheme", None, bool)
@@ -95,9 +126,14 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
     location = attr_property("hetznerCloud.location", None)
     server_name = attr_property("hetznerCloud.serverName", None)
     server_type = attr_property("hetznerCloud.serverType", None)
+    image = attr_property("hetznerCloud.image", None, int)
     server_networks = attr_property("hetznerCloud.serverNetworks", {}, "json")
     volumes = attr_property("hetznerCloud.volumes", {}, "json")
     ip_addresses = attr_property("hetznerCloud.ipAddresses", {}, "json")
+    placement_group = attr_property("hetznerCloud.placementGroup", None, int)
+    fingerprint = attr_property("hetznerCloud.fingerprint", None)
+    attachments = attr_property("hetznerCloud.attachments", {}, "json")
+    backups = attr_property("hetznerCloud.backups", {}, "json")
 
     def __init__(self, depl: Deployment, name: str, id):
         MachineState.__init__(self, depl, name, id)
@@ -111,16 +147,21 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
             self.public_ipv6 = None
             self.private_client_key = None
             self.public_client_key = None
+            self.shared_client_key = False
             self.private_host_key = None
             self.public_host_key = None
             self.legacy_if_scheme = None
             self.location = None
             self.server_name = None
             self.server_type = None
+            self.image = None
             self.server_networks = {}
             self.labels = {}
             self.volumes = {}
             self.ip_addresses = {}
+            self.placement_group = None
+            self.fingerprint = None
+            self.attachments = {}
 
     def show_type(self):
         s = f"{super(HetznerCloudState, self).show_type()}"
@@ -132,19 +173,24 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
     def full_name(self) -> str:
         return f"Hetzner Cloud Server ‘{self.name}’"
 
-    def get_instance(self) -> BoundServer:
-        try:
-            return self.get_client().servers.get_by_id(self.vm_id)
-        except APIException as e:
-            if e.code == "not_found":
-                self.logger.warn(f"{self.full_name} was deleted from outside of nixops")
-                return None
-            else:
-                raise
+    def get_instance(self, refresh: bool = False) -> BoundServer:
+        if refresh:
+            self.forget_instance()
+        instance = self.get_snapshot().get_by_id("servers", self.vm_id)
+        if instance is None and self.vm_id is not None:
+            self.logger.warn(f"{self.full_name} was deleted from outside of nixops")
+        return instance
+
+    def forget_instance(self) -> None:
+        self.get_snapshot().forget("servers", self.vm_id)
+
+    def get_snapshot(self) -> DeploymentSnapshot:
+        return get_snapshot(self.get_client(), self.depl.uuid)
 
     def get_client(self) -> Client:
         """
-        Generic method to get or create a Hetzner Cloud client.
+        Generic method to get the shared Hetzner Cloud client for this
+        machine's API token.
         """
         if self._client:
             return self._client
@@ -156,9 +202,19 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
         if self.api_token is None:
             raise Exception("please set ‘apiToken’ or $HCLOUD_API_TOKEN")
 
-        self._client = Client(token=self.api_token)
+        self._client = get_client(self.api_token)
         return self._client
 
+    def get_async_client(self) -> AsyncClient:
+        """
+        Get the shared asyncio client for this machine's API token.
+        """
+        self.get_client()
+        return get_async_client(self.api_token)
+
+    def get_catalogue(self) -> Catalogue:
+        return get_catalogue(self.get_async_client())
+
     def get_common_labels(self) -> Dict[str, str]:
         labels = {
             "CharonNetworkUUID": self.depl.uuid,
@@ -188,6 +244,50 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
         super_flags = super(HetznerCloudState, self).get_ssh_flags(*args, **kwargs)
         return super_flags + ["-i", self.get_ssh_private_key_file()]
 
+    def run_command(self, command: str, **kwargs) -> Any:
+        with tracer.span("run_command", "ssh", command=command):
+            return super().run_command(command, **kwargs)
+
+    def wait_for_ssh(self, check: bool = False) -> None:
+        with tracer.span("wait for ssh", "ssh_wait"):
+            self._wait_until_reachable()
+            super().wait_for_ssh(check)
+
+    def _wait_until_reachable(self) -> None:
+        """
+        Wait until the server is running and accepts SSH connections, leaving
+        the polling to the readiness monitor shared by all machines.
+        """
+        monitor = get_readiness_monitor()
+        waiters: List[Waiter] = [
+            monitor.probe_port(self.get_ssh_name(), self.ssh_port or 22)
+        ]
+        if self.vm_id is not None:
+            waiters.append(
+                monitor.watch_status(
+                    self.get_client(),
+                    self.vm_id,
+                    "running",
+                    f"CharonNetworkUUID={self.depl.uuid}",
+                )
+            )
+        monitor.wait(waiters)
+
+    def _wait_for_status(self, status: str) -> None:
+        monitor = get_readiness_monitor()
+        monitor.wait(
+            [
+                monitor.watch_status(
+                    self.get_client(),
+                    self.vm_id,
+                    status,
+                    f"CharonNetworkUUID={self.depl.uuid}",
+                )
+            ],
+            on_tick=lambda: self.logger.log_continue("."),
+        )
+        self.forget_instance()
+
     def get_udev_name(self, volume_id: str) -> str:
         return f"/dev/disk/by-id/scsi-0HC_Volume_{volume_id}"
 
@@ -269,17 +369,56 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
         setattr(self, attr, x)
 
     def _handle_changed_server_networks(
-        self, defn: HetznerCloudDefinition, allow_recreate: bool
+        self,
+        defn: HetznerCloudDefinition,
+        allow_recreate: bool,
+        plan: ReconciliationPlan,
     ) -> None:
         """
-        Detects and corrects any virtual network state desynchronisation.
+        Detects any virtual network state desynchronisation and plans the
+        operations to correct it.
         """
 
         attached: Set[str] = {x.network.id for x in self.get_instance().private_net}
 
+        def detach_from_network(name: str, nw: BoundNetwork) -> None:
+            def on_success() -> None:
+                self.forget_instance()
+                self._update_attr("server_networks", name, None)
+
+            plan.add(
+                f"detaching from network ‘{name}’ [{nw.id}]",
+                lambda: self.get_client().servers.detach_from_network(
+                    server=Server(self.vm_id), network=nw
+                ),
+                on_success,
+            )
+
+        def attach_to_network(name: str, nw: BoundNetwork, x: Dict[str, Any]) -> None:
+            def on_success() -> None:
+                self.forget_instance()
+                if x["privateIpAddress"] is None:
+                    x["privateIpAddress"] = self._get_private_ip(nw.id)
+                self._update_attr("server_networks", x["network"], x)
+
+            # NixOps will update machines in parallel, so the plan retries
+            # network attachment to deal with resource conflict.
+            plan.add(
+                f"attaching instance to network ‘{name}’ [{nw.id}]...",
+                lambda: self.get_client().servers.attach_to_network(
+                    server=Server(self.vm_id),
+                    network=nw,
+                    ip=x["privateIpAddress"],
+                    alias_ips=x["aliasIpAddresses"],
+                ),
+                on_success,
+            )
+
         # Detach server from networks
         for name in self.server_networks.keys():
-            nw: Optional[BoundNetwork] = self.get_client().networks.get_by_name(name)
+            nw: Optional[BoundNetwork] = self.get_snapshot().get_by_name(
+                "networks", name
+            )
 
             # Detect destroyed networks
             if nw is None:
@@ -303,16 +442,12 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                     self._update_attr("server_networks", name, None)
             # Detach from existing networks if required.
             elif name not in defn.server_networks:
-                self.logger.log(f"detaching from network ‘{name}’ [{nw.id}]")
-                self.get_client().servers.detach_from_network(
-                    server=Server(self.vm_id), network=nw
-                ).wait_until_finished()
-                self._update_attr("server_networks", name, None)
+                detach_from_network(name, nw)
 
         # Attach server to networks
         for name, x in defn.server_networks.items():
             if name not in self.server_networks:
-                nw = self.get_client().networks.get_by_name(name)
+                nw = self.get_snapshot().get_by_name("networks", name)
 
                 if nw is None:
                     raise Exception(
@@ -320,44 +455,45 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                         " but it doesn't exist..."
                     )
 
-                # NixOps will update machines in parallel, so retry
-                # network attachment to deal with resource conflict.
-                def attach_to_network() -> bool:
-                    try:
-                        self.wait_on_action(
-                            self.get_client().servers.attach_to_network(
-                                server=Server(self.vm_id),
-                                network=nw,
-                                ip=x["privateIpAddress"],
-                                alias_ips=x["aliasIpAddresses"],
-                            )
-                        )
-                    except APIException as e:
-                        if e.code == "conflict":
-                            return False
-                        else:
-                            raise
-                    else:
-                        self._update_attr("server_networks", x["network"], x)
-                        return True
+                attach_to_network(name, nw, x)
 
-                self.logger.log(f"attaching instance to network ‘{name}’ [{nw.id}]...")
-                check_wait(attach_to_network)
+    def _get_private_ip(self, network_id: int) -> str:
+        """
+        The IP address Hetzner Cloud assigned the server on a network.
+        """
+        for x in self.get_instance().private_net:
+            if x.network.id == network_id:
+                return x.ip
+        raise Exception(f"{self.full_name} isn't attached to network {network_id}")
 
     def _handle_changed_floating_ips(
-        self, defn: HetznerCloudDefinition, allow_recreate: bool
+        self,
+        defn: HetznerCloudDefinition,
+        allow_recreate: bool,
+        plan: ReconciliationPlan,
     ) -> None:
         """
-        Detects and corrects any floating IP state desynchronisation.
+        Detects any floating IP state desynchronisation and plans the
+        operations to correct it.
         """
 
-        assigned: Set[str] = {
-            x.name for x in self.get_instance().public_net.floating_ips
-        }
+        assigned: Set[int] = {x.id for x in self.get_instance().public_net.floating_ips}
+
+        def assign_floating_ip(name: str, fip: BoundFloatingIP) -> None:
+            def on_success() -> None:
+                self.get_snapshot().forget("floating_ips", fip.id)
+                self.forget_instance()
+                self._update_attr("ip_addresses", name, fip.ip)
+
+            plan.add(
+                f"assigning floating IP ‘{name}’ [{fip.id}]...",
+                lambda: fip.assign(Server(self.vm_id)),
+                on_success,
+            )
 
         for name in self.ip_addresses.keys():
-            fip: Optional[BoundFloatingIP] = self.get_client().floating_ips.get_by_name(
-                name
+            fip: Optional[BoundFloatingIP] = self.get_snapshot().get_by_name(
+                "floating_ips", name
             )
 
             # Detect manually destroyed floating IPs
@@ -382,44 +518,87 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                             " was manually destroyed"
                         )
 
+            # Detect floating IPs that are no longer needed, such as those
+            # failed over to this machine, which are left to the machines
+            # whose specification lists them.
+            elif name not in defn.ip_addresses:
+                self.logger.warn(
+                    f"forgetting about floating IP ‘{name}’ [{fip.id}]"
+                    " that is no longer needed by the deployment specification"
+                )
+                self._update_attr("ip_addresses", name, None)
+
             # Detect unassigned floating IPs
-            elif name not in assigned:
-                if name not in defn.ip_addresses:  # we dont need it
-                    self.logger.warn(
-                        f"forgetting about unassigned floating IP ‘{name}’ [{fip.id}]"
-                        " that is no longer needed by the deployment specification"
-                    )
-                else:  # we do need it
-                    self.logger.warn(
-                        f"floating IP ‘{name}’ [{fip.id}] was manually unassigned;"
-                        " will reassign it."
-                    )
-                    self._update_attr("ip_addresses", name, None)
+            elif fip.id not in assigned:
+                self.logger.warn(
+                    f"floating IP ‘{name}’ [{fip.id}] was manually unassigned;"
+                    " will reassign it."
+                )
+                self._update_attr("ip_addresses", name, None)
 
         # Assign missing floating IPs.
         for name in defn.ip_addresses:
             if name not in self.ip_addresses:
-                fip = self.get_client().floating_ips.get_by_name(name)
+                fip = self.get_snapshot().get_by_name("floating_ips", name)
                 if fip is None:
                     raise Exception(
                         f"tried to assign floating IP ‘{name}’"
                         " but it doesn't exist..."
                     )
-                self.logger.log(f"assigning floating IP ‘{name}’ [{fip.id}]...")
-                self.wait_on_action(fip.assign(Server(self.vm_id)))
-                self._update_attr("ip_addresses", name, fip.ip)
+                assign_floating_ip(name, fip)
 
     def _handle_changed_volumes(
-        self, defn: HetznerCloudDefinition, allow_recreate: bool
-    ) -> None:
+        self,
+        defn: HetznerCloudDefinition,
+        allow_recreate: bool,
+        plan: ReconciliationPlan,
+    ) -> Dict[str, BoundVolume]:
         """
-        Detects and corrects any volume state desynchronisation.
+        Detects any volume state desynchronisation and plans the operations
+        to correct it. Returns the volumes which will be attached.
         """
 
-        attached: Set[str] = {x.name for x in self.get_instance().volumes}
+        attached: Set[int] = {x.id for x in self.get_instance().volumes}
+        attaching: Dict[str, BoundVolume] = {}
+
+        def detach_volume(name: str, volume: BoundVolume) -> None:
+            def on_success() -> None:
+                self.get_snapshot().forget("volumes", volume.id)
+                self.forget_instance()
+                self._update_attr("volumes", name, None)
+
+            plan.add(
+                f"detaching volume ‘{name}’ [{volume.id}]...",
+                volume.detach,
+                on_success,
+            )
+
+        def attach_volume(name: str, volume: BoundVolume, steal: bool) -> None:
+            def on_success() -> None:
+                self.get_snapshot().forget("volumes", volume.id)
+                self.forget_instance()
+
+            after = []
+            if steal:
+                after.append(
+                    plan.add(
+                        f"detaching volume ‘{name}’ from instance"
+                        f" ‘{volume.server.id}’...",
+                        volume.detach,
+                    )
+                )
+            plan.add(
+                f"attaching volume ‘{name}’ [{volume.id}]...",
+                lambda: volume.attach(Server(self.vm_id)),
+                on_success,
+                after=after,
+            )
+            attaching[name] = volume
 
         for name in self.volumes.keys():
-            volume: Optional[BoundVolume] = self.get_client().volumes.get_by_name(name)
+            volume: Optional[BoundVolume] = self.get_snapshot().get_by_name(
+                "volumes", name
+            )
 
             # Detect destroyed volumes.
             if volume is None:
@@ -440,7 +619,7 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                             " manually destroyed"
                         )
             # Detect detached volumes.
-            elif name not in attached:
+            elif volume.id not in attached:
                 if name not in defn.volumes:  # we dont need it
                     self.logger.warn(
                         f"forgetting about detached volume ‘{name}’ [{volume.id}]"
@@ -458,16 +637,15 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                     f"detaching volume ‘{name}’ [{volume.id}] that is no longer"
                     " needed by the deployment specification"
                 )
-                volume.detach().wait_until_finished()
-                self._update_attr("volumes", name, None)
+                detach_volume(name, volume)
 
-        # Attach missing volumes. resize filesystems if required, before mounting.
+        # Attach missing volumes.
         for name, v in defn.volumes.items():
             if name not in self.volumes:
 
                 # Check if it exists. resources will have been created if user ran check,
                 # but prexisting vols which got deleted may be gone (detected in code above)
-                volume = self.get_client().volumes.get_by_name(name)
+                volume = self.get_snapshot().get_by_name("volumes", name)
 
                 if volume is None:
                     self.logger.warn(
@@ -475,49 +653,108 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                         " but it doesn't exist... skipping"
                     )
                     continue
+                # Attached when the server was created.
+                elif volume.server and volume.server.id == self.vm_id:
+                    attaching[name] = volume
+                    continue
                 elif volume.location.name != self.location:
                     raise Exception(
                         f"volume ‘{name}’ [{volume.id}] is in a different location"
                         " to {self.full_name}; attempting to attach it will fail."
                     )
-                elif (
+
+                steal = bool(
                     volume.server
                     and volume.server.id != self.vm_id
                     and self.depl.logger.confirm(
                         f"volume ‘{name}’ is in use by instance ‘{volume.server.id}’,"
                         " are you sure you want to attach this volume?"
                     )
-                ):  # noqa: E124
-                    self.logger.log(
-                        f"detaching volume ‘{name}’ from instance ‘{volume.server.id}’..."
-                    )
-                    volume.detach().wait_until_finished()
-                    volume.server = None
+                )
+                attach_volume(name, volume, steal)
 
-                # Attach volume.
+        return attaching
 
-                self.logger.log(f"attaching volume ‘{name}’ [{volume.id}]... ")
-                volume.attach(Server(self.vm_id)).wait_until_finished()
+    def _get_fingerprint(self, defn: HetznerCloudDefinition) -> str:
+        """
+        Digest of everything in a definition which is realised on the
+        Hetzner side.
+        """
+        spec = {
+            "location": defn.location,
+            "serverName": defn.server_name,
+            "serverType": defn.server_type,
+            "image": defn.image,
+            "labels": defn.labels,
+            "serverNetworks": defn.server_networks,
+            "volumes": defn.volumes,
+            "ipAddresses": sorted(defn.ip_addresses),
+            "placementGroup": defn.placement_groups,
+        }
+        return hashlib.sha256(
+            json.dumps(spec, sort_keys=True, default=str).encode()
+        ).hexdigest()
 
-                # Wait until the device is visible in the instance.
+    def _get_attachments(self, instance: BoundServer) -> Dict[str, List[int]]:
+        return {
+            "volumes": sorted(x.id for x in instance.volumes),
+            "networks": sorted(x.network.id for x in instance.private_net),
+            "floatingIps": sorted(x.id for x in instance.public_net.floating_ips),
+        }
 
-                v["device"] = self.get_udev_name(volume.id)
+    def _is_unchanged(self, defn: HetznerCloudDefinition, fingerprint: str) -> bool:
+        """
+        Whether the definition is the one last realised and the server still
+        has the attachments it was left with, in which case there's nothing
+        to reconcile.
+        """
+        if (
+            self.fingerprint != fingerprint
+            or set(self.volumes) != set(defn.volumes)
+            or set(self.server_networks) != set(defn.server_networks)
+            or set(self.ip_addresses) != set(defn.ip_addresses)
+        ):
+            return False
 
-                def check_device() -> bool:
-                    return 0 == self.run_command(f"test -e {v['device']}", check=False)
-
-                if not check_wait(
-                    check_device, initial=1, max_tries=10, exception=False
-                ):
-                    # If stopping times out, then do an unclean shutdown.
-                    self.logger.log_end("(timed out)")
-                    self.logger.log(f"can't find device ‘{v['device']}’...")
-                    self.logger.log("available devices:")
-                    self.run_command("lsblk")
-                    raise Exception("operation timed out")
-                else:
-                    self._update_attr("volumes", name, v)
-                    self.logger.log_end("")
+        # Growing the filesystem of a resized volume still needs doing.
+        for name in self.volumes:
+            if name.startswith("nixops-" + self.depl.uuid):
+                res = self.depl.get_typed_resource(
+                    name[44:], "hetznercloud-volume", VolumeState
+                )
+                if res.needsFSResize:
+                    return False
+
+        instance = self.get_instance()
+        return (
+            instance is not None
+            and instance.server_type.name == defn.server_type
+            and self._get_attachments(instance) == self.attachments
+        )
+
+    def _handle_attached_volumes(
+        self, defn: HetznerCloudDefinition, attaching: Dict[str, BoundVolume]
+    ) -> None:
+        """
+        Waits for newly attached volumes to become visible in the instance,
+        and resizes filesystems if required, before mounting.
+        """
+        resizes = ResizeQueue(self)
+
+        # Wait until all newly attached devices are visible in the instance.
+        devices = {
+            name: self.get_udev_name(attaching[name].id)
+            for name in defn.volumes
+            if name not in self.volumes and name in attaching
+        }
+        wait_for_devices(self, devices)
+
+        for name, v in defn.volumes.items():
+            if name not in self.volumes:
+                if name not in attaching:
+                    continue
+                v["device"] = devices[name]
+                self._update_attr("volumes", name, v)
 
             # Grow filesystems on resource based volumes.
 
@@ -537,37 +774,23 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                 v["size"] = res._state["size"]
                 v["fsType"] = res._state["fsType"]
                 v["device"] = self.get_udev_name(res._state["resourceId"])
-
-                question = (
-                    f"volume {name} was resized, do you wish to grow its"
-                    " filesystem to fill the space?"
-                )
-                op = (
-                    f"umount {v['device']} ;"
-                    f"e2fsck -fy {v['device']} &&"
-                    f"resize2fs {v['device']}"
-                )
-
-                if (
-                    v["fsType"] == "ext4"
-                    and res.needsFSResize
-                    and self.depl.logger.confirm(question)
-                    and self.run_command(op, check=False) == 0
-                ):
-                    with res.depl._db:
-                        res.needsFSResize = False
+                if v["fsType"] == "ext4":
+                    resizes.add(name, res, v["device"], "ext4")
 
                 self._update_attr("volumes", name, v)
 
             if v["mountPoint"]:
-                volume = self.get_client().volumes.get_by_name(name)
+                volume = self.get_snapshot().get_by_name("volumes", name)
                 v["device"] = self.get_udev_name(volume.id)
                 self._update_attr("volumes", name, v)
 
+        resizes.run()
+
     def after_activation(self, defn: ResourceDefinition) -> None:
 
         # Unlike ext4, xfs filesystems must be resized while the underlying drive is mounted.
         # Thus this operation is delayed until after activation.
+        resizes = ResizeQueue(self)
         for name, v in self.volumes.items():
             if (
                 name.startswith("nixops-" + self.depl.uuid)
@@ -577,18 +800,8 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                 res = self.depl.get_typed_resource(
                     name[44:], "hetznercloud-volume", VolumeState
                 )
-                question = (
-                    f"volume {name} was resized, do you wish to grow its"
-                    " filesystem to fill the space?"
-                )
-                if (
-                    res.needsFSResize
-                    and self.depl.logger.confirm(question)
-                    and 0
-                    == self.run_command(f"xfs_growfs {v['mountPoint']}", check=False)
-                ):
-                    with res.depl._db:
-                        res.needsFSResize = False
+                resizes.add(name, res, v["mountPoint"], "xfs")
+        resizes.run()
 
     def create_after(
         self, resources, defn: Optional[ResourceDefinition]
@@ -597,40 +810,209 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
             r
             for r in resources
             if isinstance(r, FloatingIPState)
+            or isinstance(r, ImageState)
             or isinstance(r, NetworkState)
+            or isinstance(r, PlacementGroupState)
             or isinstance(r, VolumeState)
         }
 
+    def get_key_registry(self) -> SSHKeyRegistry:
+        return get_key_registry(self.get_client(), self.depl.uuid)
+
+    def _get_ssh_key_name(self) -> str:
+        if self.shared_client_key:
+            return f"nixops-{self.depl.uuid}"
+        return f"nixops-{self.depl.uuid}-{self.name}"
+
     def _create_ssh_key(self, public_key: str) -> BoundSSHKey:
         """Create or get a hetzner cloud ssh key."""
-        public_key = public_key.strip()
-        hetzner_ssh_keys: List[BoundSSHKey] = self.get_client().ssh_keys.get_all()
-        name: str = f"nixops-{self.depl.uuid}-{self.name}"
-        for key in hetzner_ssh_keys:
-            if key.public_key.strip() == public_key:
-                return key
-            elif key.name == name:
-                self.get_client().ssh_keys.delete(key)
-        ssh_key: BoundSSHKey = self.get_client().ssh_keys.create(
-            name=name,
-            public_key=public_key,
+        labels = self.get_common_labels()
+        if self.shared_client_key:
+            del labels["CharonInstanceName"]
+        return self.get_key_registry().ensure(
+            self._get_ssh_key_name(), public_key, labels
         )
-        return ssh_key
 
-    def _create_instance(self, defn) -> None:
-        if not self.public_client_key:
-            (private, public) = create_key_pair(type="ed25519")
-            self.public_client_key = public
-            self.private_client_key = private
+    def _get_shared_key_users(self) -> List["HetznerCloudState"]:
+        return [
+            m
+            for m in self.depl.resources.values()
+            if isinstance(m, HetznerCloudState)
+            and m is not self
+            and m.shared_client_key
+            and m.public_client_key
+        ]
+
+    def _adopt_shared_client_key(self) -> None:
+        """
+        Use the key pair shared by the deployment's machines, generating it
+        if this is the first machine to need it.
+        """
+        with self.get_key_registry().shared_lock:
+            users = self._get_shared_key_users()
+            if users:
+                (private, public) = (
+                    users[0].private_client_key,
+                    users[0].public_client_key,
+                )
+            else:
+                (private, public) = create_key_pair(type="ed25519")
+            with self.depl._db:
+                self.public_client_key = public
+                self.private_client_key = private
+                self.shared_client_key = True
 
-        if not self.public_host_key:
-            (private, public) = create_key_pair(type="ed25519")
-            self.public_host_key = public
-            self.private_host_key = private
+    def _get_image(self, defn: HetznerCloudDefinition) -> Image:
+        """
+        Get the image to boot a new server from: either a NixOS snapshot
+        image resource, or Ubuntu for lustration with nixos-infect.
+        """
+        if defn.image is None:
+            return Image(name="ubuntu-20.04")
 
-        location: BoundLocation = self.get_client().locations.get_by_name(defn.location)
+        res = self.depl.get_typed_resource(
+            defn.image[44:], "hetznercloud-image", ImageState
+        )
+        if res.resource_id is None:
+            raise Exception(f"image ‘{defn.image}’ hasn't been built yet")
+        if res.architecture != get_architecture(defn.server_type):
+            raise Exception(
+                f"image ‘{defn.image}’ was built for {res.architecture} servers"
+                f" and can't boot a ‘{defn.server_type}’ server"
+            )
+        return Image(id=res.resource_id)
 
-        ssh_keys: List[BoundSSHKey] = [self._create_ssh_key(self.public_client_key)]
+    def _get_placement_groups(
+        self, defn: HetznerCloudDefinition
+    ) -> List[Tuple[str, int, List[int]]]:
+        """
+        The name, ID and servers of each placement group the machine may use.
+        """
+        groups = []
+        for name in defn.placement_groups:
+            if name.startswith("nixops-" + self.depl.uuid):
+                res = self.depl.get_typed_resource(
+                    name[44:], "hetznercloud-placement-group", PlacementGroupState
+                )
+                group = self.get_snapshot().get_by_id(
+                    "placement_groups", res.resource_id
+                )
+            else:
+                group = self.get_snapshot().get_by_name("placement_groups", name)
+            if group is None:
+                raise Exception(f"placement group ‘{name}’ doesn't exist")
+            groups.append((name, group.id, list(group.servers)))
+        return groups
+
+    def _handle_changed_placement_group(
+        self, defn: HetznerCloudDefinition, allow_reboot: bool
+    ) -> None:
+        """
+        Move the server into one of its placement groups, which can only be
+        done while it's off.
+        """
+        groups = self._get_placement_groups(defn)
+        if self.placement_group in {id for _, id, _ in groups} or (
+            not groups and self.placement_group is None
+        ):
+            return
+        if not allow_reboot:
+            raise Exception(
+                "cannot change placement group of a running instance;"
+                " use ‘--allow-reboot’"
+            )
+
+        scheduler = get_spread_scheduler(self.depl.uuid)
+        target = scheduler.choose(self.name, groups) if groups else None
+        client = self.get_async_client()
+
+        async def move() -> None:
+            if self.placement_group is not None:
+                await client.action(
+                    "servers", self.vm_id, "remove_from_placement_group"
+                )
+            if target is not None:
+                await client.action(
+                    "servers",
+                    self.vm_id,
+                    "add_to_placement_group",
+                    {"placement_group": target},
+                )
+
+        self.logger.log_start(f"moving {self.full_name} to another placement group...")
+        self._run_power_action("shutdown")
+        self._wait_for_status("off")
+        try:
+            hetznercloud_async.run(move())
+        except Exception:
+            scheduler.release(self.name)
+            raise
+        finally:
+            self.logger.log_start(f"powering on {self.full_name}...")
+            self._run_power_action("poweron")
+            self.wait_for_ssh()
+        if target is not None:
+            scheduler.placed(self.name, target, self.vm_id)
+        self.placement_group = target
+
+    def _get_create_attachments(
+        self, defn: HetznerCloudDefinition
+    ) -> Tuple[List[BoundVolume], Dict[str, BoundNetwork]]:
+        """
+        The volumes and networks a new server can be attached to by the
+        request creating it: free volumes in its location, and networks on
+        which Hetzner Cloud is left to choose its IP address. Everything else
+        is attached once the server exists.
+        """
+        snapshot = self.get_snapshot()
+        volumes = [
+            volume
+            for volume in (
+                snapshot.get_by_name("volumes", name) for name in defn.volumes
+            )
+            if volume is not None
+            and volume.server is None
+            and volume.location.name == defn.location
+        ]
+        networks = {}
+        for name, x in defn.server_networks.items():
+            if x["privateIpAddress"] is None and not x["aliasIpAddresses"]:
+                nw = snapshot.get_by_name("networks", name)
+                if nw is not None:
+                    networks[name] = nw
+        return volumes, networks
+
+    def _validate_offline(self, defn: HetznerCloudDefinition) -> None:
+        """
+        Check the server type and location against the cached catalogue
+        before making any API calls. Only a server being created, or whose
+        type or location changes, fails the check: one which exists already
+        is still managed, with a warning, if Hetzner Cloud no longer lists
+        its type or location.
+        """
+        try:
+            validate_offline(defn.server_type, defn.location)
+        except Exception as e:
+            if self.vm_id is None or (self.server_type, self.location) != (
+                defn.server_type,
+                defn.location,
+            ):
+                raise
+            self.warn(str(e))
+
+    def _create_instance(
+        self, defn: HetznerCloudDefinition, ssh_key: BoundSSHKey
+    ) -> None:
+        catalogue = self.get_catalogue()
+        catalogue.validate(defn.server_type, defn.location)
+        location = catalogue.location(defn.location)
+
+        image = self._get_image(defn)
+        volumes, networks = self._get_create_attachments(defn)
+
+        scheduler = get_spread_scheduler(self.depl.uuid)
+        groups = self._get_placement_groups(defn)
+        placement_group = scheduler.choose(self.name, groups) if groups else None
 
         # Ensure host keys get injected into the base OS
         user_data = (
@@ -642,21 +1024,35 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
         ).format(self.public_host_key, self.private_host_key.replace("\n", "\n    "))
 
         self.logger.log_start(
-            f"creating {defn.server_type} server at {location.description}..."
-        )
-        response = self.get_client().servers.create(
-            name=defn.server_name,
-            labels={**self.get_common_labels(), **dict(defn.labels)},
-            location=location,
-            server_type=ServerType(defn.server_type),
-            ssh_keys=ssh_keys,
-            user_data=user_data,
-            image=Image(name="ubuntu-20.04"),  # for lustration
-            start_after_create=True,
+            f"creating {defn.server_type} server at {location['description']}..."
         )
+        try:
+            response = self.get_client().servers.create(
+                name=defn.server_name,
+                labels={**self.get_common_labels(), **dict(defn.labels)},
+                location=Location(name=defn.location),
+                server_type=ServerType(defn.server_type),
+                ssh_keys=[ssh_key],
+                user_data=user_data,
+                image=image,
+                start_after_create=True,
+                volumes=volumes or None,
+                networks=list(networks.values()) or None,
+                automount=False if volumes else None,
+                placement_group=(
+                    PlacementGroup(id=placement_group)
+                    if placement_group is not None
+                    else None
+                ),
+            )
+        except Exception:
+            scheduler.release(self.name)
+            raise
+        if placement_group is not None:
+            scheduler.placed(self.name, placement_group, response.server.id)
 
         self.state = self.STARTING
-        self.wait_on_action(response.action)
+        self.wait_on_actions([response.action] + (response.next_actions or []))
 
         with self.depl._db:
             self.vm_id = response.server.id
@@ -664,14 +1060,106 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
             self.public_ipv6 = response.server.public_net.ipv6.ip
             self.server_name = defn.server_name
             self.server_type = defn.server_type
+            self.image = image.id
             self.legacy_if_scheme = defn.server_type.startswith("cx")
             self.location = defn.location
             self.labels = dict(defn.labels)
+            self.placement_group = placement_group
             self.private_host_key = None
 
+        # The volumes' attachments and the networks' addresses are only known
+        # once the actions attaching them have finished.
+        for volume in volumes:
+            self.get_snapshot().forget("volumes", volume.id)
+        self.forget_instance()
+        with self.depl._db:
+            for name, nw in networks.items():
+                self._update_attr(
+                    "server_networks",
+                    name,
+                    {
+                        **defn.server_networks[name],
+                        "privateIpAddress": self._get_private_ip(nw.id),
+                    },
+                )
+
         known_hosts.add(self.public_ipv4, self.public_host_key)
-        self.logger.log_end(f"{self.public_ipv4}")
+        self.logger.log(f"created {self.full_name} at {self.public_ipv4}")
 
+    def _reconcile_attachments(
+        self, defn: HetznerCloudDefinition, allow_recreate: bool
+    ) -> Dict[str, BoundVolume]:
+        """
+        Plan every attachment change up front, then issue them concurrently.
+        Returns the volumes which were attached.
+        """
+        plan = ReconciliationPlan(self.get_client(), self.logger)
+        self._handle_changed_floating_ips(defn, allow_recreate, plan)
+        attaching = self._handle_changed_volumes(defn, allow_recreate, plan)
+        self._handle_changed_server_networks(defn, allow_recreate, plan)
+        plan.execute()
+        return attaching
+
+    def _provision(self, defn: HetznerCloudDefinition, allow_recreate: bool) -> None:
+        """
+        Create the server and bring it up to its definition as a pipeline,
+        in which attaching it to floating IPs, volumes and networks overlaps
+        with waiting for it to boot and installing NixOS.
+        """
+        if defn.shared_ssh_key:
+            self._adopt_shared_client_key()
+        elif not self.public_client_key:
+            (private, public) = create_key_pair(type="ed25519")
+            self.public_client_key = public
+            self.private_client_key = private
+
+        if not self.public_host_key:
+            (private, public) = create_key_pair(type="ed25519")
+            self.public_host_key = public
+            self.private_host_key = private
+
+        ssh_keys: List[BoundSSHKey] = []
+        attaching: Dict[str, BoundVolume] = {}
+
+        def infect() -> None:
+            self.state = self.RESCUE
+            self.logger.log("running nixos-infect")
+            self.run_command("bash </dev/stdin 2>&1", stdin=open(INFECT_PATH))
+            self.logger.log("rebooting into NixOS 😎")
+            self.reboot_sync()
+
+        pipeline = ProvisioningPipeline(self.logger)
+        key = pipeline.add(
+            "create ssh key",
+            "api",
+            lambda: ssh_keys.append(self._create_ssh_key(self.public_client_key)),
+        )
+        server = pipeline.add(
+            "create server",
+            "api",
+            lambda: self._create_instance(defn, ssh_keys[0]),
+            after=[key],
+        )
+        attach = pipeline.add(
+            "attach",
+            "api",
+            lambda: attaching.update(self._reconcile_attachments(defn, allow_recreate)),
+            after=[server],
+        )
+        booted = pipeline.add("wait for ssh", "ssh", self.wait_for_ssh, after=[server])
+        if defn.image is None:
+            booted = pipeline.add("nixos-infect", "ssh", infect, after=[booted])
+        pipeline.add(
+            "wait for volumes",
+            "ssh",
+            lambda: self._handle_attached_volumes(defn, attaching),
+            after=[attach, booted],
+        )
+        pipeline.execute()
+        self.state = self.UP
+
+    @traced("create")
+    @within_pass
     def create(  # noqa: C901
         self,
         defn: HetznerCloudDefinition,
@@ -680,15 +1168,23 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
         allow_recreate: bool,
     ) -> None:
         self.api_token = defn.api_token
+        forget_teardown(self.depl.uuid)
 
         if self.state != self.UP:
             check = True
 
         self.set_common_state(defn)
 
+        fingerprint = self._get_fingerprint(defn)
+        if self.vm_id and not check and self._is_unchanged(defn, fingerprint):
+            self.logger.log("no changes to the server or its attachments")
+            return
+
         if self.api_token and self.api_token != defn.api_token:
             raise Exception("cannot change api token of an existing instance")
 
+        self._validate_offline(defn)
+
         # Destroy the instance (if allowed) to handle attribute changes which
         # require recreating i.e. location
         if (
@@ -701,15 +1197,20 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
         ):
             self._destroy()
 
-        # Stop the instance (if allowed) to handle attribute changes which
-        # require rebooting i.e. server_type
-        if self.vm_id and allow_reboot and self.server_type != defn.server_type:
-            self.stop()
-            check = True
+        # Change the server type (if allowed), which requires stopping the
+        # instance, in waves across the deployment's machines.
+        if (
+            self.vm_id
+            and allow_reboot
+            and self.server_type != defn.server_type
+            and self.depl.logger.confirm(
+                f"are you sure you want to stop {self.full_name}"
+                " to change its server type?"
+            )
+        ):
+            get_rolling_resize(self.depl.uuid).resize(self, defn.server_type)
 
         # Check whether the instance hasn't been killed behind our backs.
-        # Handle changed server type.
-        # Restart stopped instances.
         if self.vm_id and check:
             instance = self.get_instance()
 
@@ -725,34 +1226,13 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
                 )
                 self.cleanup_state()
 
-            # Modify the server type, if desired. TODO store disk size
-            # in state to enable option to later downsize server type.
-            if instance.status == "off" and self.server_type != defn.server_type:
-                self.logger.log_start(
-                    f"changing server type from ‘{self.server_type}’ to"
-                    f" ‘{defn.server_type}’; may take a few minutes..."
-                )
-                instance.change_type(
-                    ServerType(defn.server_type), upgrade_disk=True
-                ).wait_until_finished()
-                self.logger.log_end("done!")
-
-                with self.depl._db:
-                    self.server_type = defn.server_type
-
-                self.logger.log("instance was stopped, restarting...")
-                self.start()
-
         # Provision the instance.
         if not self.vm_id:
-            self._create_instance(defn)
-            self.wait_for_ssh()
-            self.state = self.RESCUE
-            self.logger.log_start("running nixos-infect")
-            self.run_command("bash </dev/stdin 2>&1", stdin=open(INFECT_PATH))
-            self.logger.log("rebooting into NixOS 😎")
-            self.reboot_sync()
-            self.state = self.UP
+            self._provision(defn, allow_recreate)
+            with self.depl._db:
+                self.attachments = self._get_attachments(self.get_instance())
+                self.fingerprint = fingerprint
+            return
 
         if self.location != defn.location:
             raise Exception(
@@ -774,81 +1254,272 @@ class HetznerCloudState(MachineState[HetznerCloudDefinition]):
             self.get_instance().update(
                 defn.server_name, {**self.get_common_labels(), **dict(defn.labels)}
             )
+            self.forget_instance()
 
-        self._handle_changed_floating_ips(defn, allow_recreate)
-        self._handle_changed_volumes(defn, allow_recreate)
-        self._handle_changed_server_networks(defn, allow_recreate)
-
-    def _destroy(self) -> None:
-        if self.state != self.UP:
-            return
-        self.logger.log(f"destroying {self.full_name}")
+        self._handle_changed_placement_group(defn, allow_reboot)
 
-        # Detach volumes
-        for name, v in self.volumes.items():
-            self.logger.log(f"detaching volume {name}...")
-            self.get_client().volumes.get_by_name(name).detach().wait_until_finished()
+        attaching = self._reconcile_attachments(defn, allow_recreate)
+        self._handle_attached_volumes(defn, attaching)
 
-        if (instance := self.get_instance()) is not None:
-            instance.delete()
+        with self.depl._db:
+            self.attachments = self._get_attachments(self.get_instance())
+            self.fingerprint = fingerprint
+
+    def _plan_destroy(self) -> Dict[str, Any]:
+        volumes = [
+            v
+            for v in (
+                self.get_snapshot().get_by_name("volumes", x) for x in self.volumes
+            )
+            if v is not None
+        ]
+        instance = self.get_instance()
+        # The deployment's shared key is deleted once no machine uses it.
+        ssh_key = (
+            None
+            if self.shared_client_key
+            else self.get_snapshot().get_by_name("ssh_keys", self._get_ssh_key_name())
+        )
+        return {
+            "volumes": {v.name: v.id for v in volumes if v.server is not None},
+            "server": instance.id if instance is not None else None,
+            "ssh_key": ssh_key.id if ssh_key is not None else None,
+        }
 
+    async def _destroy_async(self, plan: Dict[str, Any]) -> None:
+        client = self.get_async_client()
+        for name in plan["volumes"]:
+            self.logger.log(f"detaching volume {name}...")
+        await gather(
+            [client.action("volumes", id, "detach") for id in plan["volumes"].values()]
+        )
+        deletions = []
+        if plan["server"] is not None:
+            deletions.append(client.delete("servers", plan["server"]))
         # Remove host ssh key.
-
-        self.get_client().ssh_keys.get_by_name(
-            f"nixops-{self.depl.uuid}-{self.name}"
-        ).delete()
+        if plan["ssh_key"] is not None:
+            deletions.append(client.delete("ssh_keys", plan["ssh_key"]))
+        await gather(deletions)
+
+    def _finish_destroy(self, plan: Dict[str, Any]) -> None:
+        snapshot = self.get_snapshot()
+        for id in plan["volumes"].values():
+            snapshot.forget("volumes", id)
+        if plan["ssh_key"] is not None:
+            snapshot.forget("ssh_keys", plan["ssh_key"])
+            self.get_key_registry().forget(plan["ssh_key"])
+        if plan["server"] is not None:
+            get_spread_scheduler(self.depl.uuid).removed(plan["server"])
+        self.forget_instance()
         known_hosts.remove(self.public_ipv4, self.public_host_key)
+        registry = self.get_key_registry()
+        with registry.shared_lock:
+            shared = self.shared_client_key
+            self.cleanup_state()
+            if shared and not any(m.vm_id for m in self._get_shared_key_users()):
+                self.logger.log("deleting the deployment's shared SSH key...")
+                registry.delete(f"nixops-{self.depl.uuid}")
 
+    def _destroy(self) -> None:
+        fleet.get_batcher(self.depl.uuid, "destroy", fleet.destroy).submit(self)
+
+    def _destroy_in_bulk(self) -> None:
+        if self.vm_id is not None:
+            destroy_deployment(self.get_async_client(), self.depl.uuid, self.logger)
+        self.forget_instance()
+        known_hosts.remove(self.public_ipv4, self.public_host_key)
         self.cleanup_state()
 
+    @traced("destroy")
+    @within_pass
     def destroy(self, wipe: bool = False) -> bool:
         question = f"are you sure you want to destroy {self.full_name}?"
         if not self.depl.logger.confirm(question):
             return False
-        self._destroy()
+        if bulk_destroy_enabled():
+            self._destroy_in_bulk()
+        else:
+            self._destroy()
         return True
 
+    @traced("start")
     def start(self) -> None:
         self.logger.log_start(f"powering on {self.full_name}...")
-        self.wait_on_action(self.get_client().servers.power_on(Server(self.vm_id)))
-        self.wait_for_ssh()
-        self.state = self.UP
+        fleet.get_batcher(self.depl.uuid, "start", fleet.start).submit(self)
 
+    @traced("stop")
     def stop(self) -> None:
         question = f"are you sure you want to stop {self.full_name}?"
         if not self.depl.logger.confirm(question):
             return
         self.logger.log_start(f"sending ACPI shutdown request to {self.full_name}...")
-        self.wait_on_action(self.get_client().servers.shutdown(Server(self.vm_id)))
-        while not self._check_status("off"):
-            time.sleep(1)
-        self.state = self.STOPPED
+        fleet.get_batcher(self.depl.uuid, "stop", fleet.stop).submit(self)
 
+    @traced("reboot")
     def reboot(self, hard: bool = False) -> None:
         question = f"are you sure you want to reboot {self.full_name}?"
         if self.state == self.UP and not self.depl.logger.confirm(question):
             return
         if hard:
             self.logger.log_start(f"sending hard reset to {self.full_name}...")
-            self.wait_on_action(self.get_client().servers.reset(Server(self.vm_id)))
+            batcher = fleet.get_batcher(
+                self.depl.uuid, "reset", lambda ms: fleet.reboot(ms, hard=True)
+            )
         else:
             self.logger.log_start(f"sending ACPI reboot request to {self.full_name}...")
-            self.wait_on_action(self.get_client().servers.reboot(Server(self.vm_id)))
-        self.wait_for_ssh()
-        self.state = self.UP
+            batcher = fleet.get_batcher(self.depl.uuid, "reboot", fleet.reboot)
+        batcher.submit(self)
+
+    def _change_server_type(self, server_type: str) -> None:
+        """
+        Stop the server, change its type and start it again, returning once
+        it accepts SSH connections.
+        """
+        instance = self.get_instance()
+        if instance is not None and instance.status != "off":
+            self.logger.log_start(
+                f"sending ACPI shutdown request to {self.full_name}..."
+            )
+            self._run_power_action("shutdown")
+            with tracer.span("wait for status off", "status_wait"):
+                self._wait_for_status("off")
+        self.state = self.STOPPED
 
+        self.logger.log_start(
+            f"changing server type from ‘{self.server_type}’ to ‘{server_type}’..."
+        )
+        with tracer.span("change server type", "api"):
+            hetznercloud_async.run(
+                self.get_async_client().action(
+                    "servers",
+                    self.vm_id,
+                    "change_type",
+                    {"server_type": server_type, "upgrade_disk": True},
+                )
+            )
+        self.forget_instance()
+        self.logger.log_end("done!")
+        with self.depl._db:
+            self.server_type = server_type
+        self.start()
+
+    def _run_power_action(self, command: str) -> None:
+        hetznercloud_async.run(
+            self.get_async_client().action("servers", self.vm_id, command)
+        )
+        self.forget_instance()
+        self.logger.log_end("")
+
+    def _get_backup_body(self, backup_id: str) -> Dict[str, Any]:
+        # Backups aren't labelled with the deployment's CharonNetworkUUID, so
+        # that they outlive the deployment's resources.
+        return {
+            "type": "snapshot",
+            "description": f"{self.server_name} backup {backup_id}",
+            "labels": {
+                "CharonBackupOf": self.depl.uuid,
+                "CharonInstanceName": self.name,
+                "CharonBackupID": backup_id,
+            },
+        }
+
+    def backup(
+        self, defn: HetznerCloudDefinition, backup_id: str, devices: List[str] = []
+    ) -> None:
+        """
+        Snapshot the server's disk without waiting for the snapshot, so that
+        every machine's snapshot is taken at once.
+        """
+        if devices:
+            self.logger.warn("snapshots only hold a server's disk, not its volumes")
+        self.logger.log(f"snapshotting {self.full_name} as backup {backup_id}")
+        fleet.backup([self], backup_id, wait=False)
+
+    def get_backups(self) -> Dict[str, Dict[str, Any]]:
+        if not self.backups:
+            return {}
+        images = hetznercloud_async.run(
+            self.get_async_client().get_all(
+                "images",
+                f"CharonBackupOf={self.depl.uuid},CharonInstanceName={self.name}",
+                type="snapshot",
+            )
+        )
+        statuses = {x["id"]: x["status"] for x in images}
+        backups: Dict[str, Dict[str, Any]] = {}
+        for backup_id, image in self.backups.items():
+            status = statuses.get(image)
+            if status == "available":
+                backups[backup_id] = {"status": "complete", "info": []}
+            elif status is not None:
+                info = [f"snapshot {image} of {self.name} is {status}"]
+                backups[backup_id] = {"status": "running", "info": info}
+            else:
+                info = [f"snapshot {image} of {self.name} no longer exists"]
+                backups[backup_id] = {"status": "unavailable", "info": info}
+        return backups
+
+    def remove_backup(self, backup_id: str, keep_physical: bool = False) -> None:
+        batcher = fleet.get_batcher(
+            self.depl.uuid,
+            f"remove backup {backup_id}{' keeping images' if keep_physical else ''}",
+            lambda ms: fleet.remove_backups(ms, [backup_id], keep_physical),
+        )
+        batcher.submit(self)
+
+    def restore(
+        self,
+        defn: HetznerCloudDefinition,
+        backup_id: Optional[str],
+        devices: List[str] = [],
+    ) -> None:
+        """
+        Rebuild the server from a backup's snapshot, or from the latest
+        complete backup if none is given.
+        """
+        if devices:
+            self.logger.warn("snapshots only hold a server's disk, not its volumes")
+        if backup_id is None:
+            complete = [
+                k for k, v in self.get_backups().items() if v["status"] == "complete"
+            ]
+            if not complete:
+                raise Exception(f"{self.full_name} has no complete backups")
+            backup_id = max(complete)
+        if backup_id not in self.backups:
+            raise Exception(f"{self.full_name} has no backup {backup_id}")
+        if not self.vm_id:
+            raise Exception(f"{self.full_name} has no server to restore")
+
+        self.logger.log_start(f"rebuilding {self.full_name} from backup {backup_id}...")
+        with tracer.span("rebuild server", "api"):
+            hetznercloud_async.run(
+                self.get_async_client().action(
+                    "servers", self.vm_id, "rebuild", {"image": self.backups[backup_id]}
+                )
+            )
+        self.forget_instance()
+        self.logger.log_end("done!")
+
+    @traced("check")
     def _check(self, res):
         if not self.vm_id:
             res.exists = False
-
-    def _check_status(self, status) -> bool:
-        return status == self.get_instance().status
+            return
+        statuses = fleet.get_batcher(self.depl.uuid, "check", fleet.check).submit(self)
+        status = statuses.get(self.name)
+        res.exists = status is not None
+        res.is_up = status == "running"
+        if status is None:
+            self.state = self.MISSING
+        elif status == "off":
+            self.state = self.STOPPED
 
     def wait_on_action(self, action: BoundAction) -> None:
-        while action.status == "running":
-            self.logger.log_continue(".")
-            time.sleep(1)
-            action = self.get_client().actions.get_by_id(action.id)
+        self.wait_on_actions([action])
+
+    def wait_on_actions(self, actions: Sequence[BoundAction]) -> None:
+        get_action_waiter(self.get_client()).wait(
+            actions, on_tick=lambda: self.logger.log_continue(".")
+        )
         self.logger.log_end("")
-        if action.status != "success":
-            raise Exception(f"unexpected status: {action.status}")
@@ -5,7 +5,7 @@ from typing import Mapping, Optional, Sequence
 
 class ServerNetworkOptions(ResourceOptions):
     network: str
-    privateIpAddress: str
+    privateIpAddress: Optional[str]
     aliasIpAddresses: Sequence[str]
 
 
@@ -21,10 +21,13 @@ class HetznerCloudOptions(ResourceOptions):
     location: str
     serverName: str
     serverType: str
+    image: Optional[str]
     labels: Mapping[str, str]
     volumes: Sequence[DiskOptions]
     ipAddresses: Sequence[str]
     serverNetworks: Sequence[ServerNetworkOptions]
+    placementGroup: Sequence[str]
+    sharedSSHKey: bool
 
 
 class HetznerCloudMachineOptions(MachineOptions):
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Spreading a deployment's machines across Hetzner Cloud placement groups.
+
+import threading
+
+from typing import Dict, List, Sequence, Set, Tuple, Union
+
+# The most servers Hetzner Cloud puts in one spread placement group.
+GROUP_SIZE = 10
+
+
+class SpreadScheduler(object):
+    """
+    Chooses the placement group of each new machine of a deployment among
+    the groups it may use.
+
+    Every machine goes to whichever of its groups holds the fewest servers,
+    the earliest listed winning ties, so that replicas listing the same
+    groups are spread evenly over them. Machines are created concurrently,
+    so each choice is reserved until the machine's server exists or its
+    creation fails.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._members: Dict[int, Set[Union[int, str]]] = {}
+
+    def choose(self, machine: str, groups: Sequence[Tuple[str, int, List[int]]]) -> int:
+        """
+        Reserve a place for a machine in one of ``groups``, each given by its
+        name, ID and the IDs of its servers, returning the chosen group's ID.
+        """
+        with self._lock:
+            for _, id, servers in groups:
+                self._members.setdefault(id, set(servers))
+            for _, id, _ in groups:
+                if machine in self._members[id]:
+                    return id
+            free = [id for _, id, _ in groups if len(self._members[id]) < GROUP_SIZE]
+            if not free:
+                raise Exception(
+                    f"placement groups {', '.join(name for name, _, _ in groups)}"
+                    f" already hold {GROUP_SIZE} servers each"
+                )
+            chosen = min(free, key=lambda id: len(self._members[id]))
+            self._members[chosen].add(machine)
+            return chosen
+
+    def placed(self, machine: str, group: int, server: int) -> None:
+        """
+        Record that a machine's server was created in its reserved group.
+        """
+        with self._lock:
+            members = self._members.get(group)
+            if members is not None:
+                members.discard(machine)
+                members.add(server)
+
+    def removed(self, server: int) -> None:
+        """
+        Record that a server was deleted, leaving room in its group.
+        """
+        with self._lock:
+            for members in self._members.values():
+                members.discard(server)
+
+    def release(self, machine: str) -> None:
+        """
+        Give up a machine's reservation, as its server wasn't created.
+        """
+        with self._lock:
+            for members in self._members.values():
+                members.discard(machine)
+
+
+_schedulers_lock = threading.Lock()
+_schedulers: Dict[str, SpreadScheduler] = {}
+
+
+def get_spread_scheduler(uuid: str) -> SpreadScheduler:
+    """
+    Get the scheduler shared by every machine of a deployment.
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(uuid)
+        if scheduler is None:
+            scheduler = _schedulers[uuid] = SpreadScheduler()
+        return scheduler
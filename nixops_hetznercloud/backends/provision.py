@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Pipelined provisioning of a new Hetzner Cloud server.
+
+import time
+
+from nixops_hetznercloud.hetznercloud_trace import tracer
+
+from typing import Callable, List, Optional, Sequence
+
+from .graph import Task, run_graph
+
+
+class Stage(Task):
+    """
+    One step of provisioning a server, bound either by the Hetzner Cloud API
+    (``"api"``) or by SSH to the machine (``"ssh"``).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        run: Callable[[], None],
+        after: Sequence["Stage"] = (),
+    ) -> None:
+        super().__init__(after)
+        self.name = name
+        self.kind = kind
+        self.run = run
+        self.seconds: Optional[float] = None
+
+
+class ProvisioningPipeline(object):
+    """
+    The stages of bringing up a new server, with the dependencies between
+    them made explicit.
+
+    Each stage starts as soon as the stages it depends on have finished, so
+    API-bound work such as assigning floating IPs overlaps with SSH-bound
+    work such as waiting for the server to boot and installing NixOS. Once
+    a stage fails no further stages are started, and the first error is
+    raised when those already running have finished.
+    """
+
+    def __init__(self, logger) -> None:
+        self.logger = logger
+        self.stages: List[Stage] = []
+
+    def add(
+        self,
+        name: str,
+        kind: str,
+        run: Callable[[], None],
+        after: Sequence[Stage] = (),
+    ) -> Stage:
+        stage = Stage(name, kind, run, after)
+        self.stages.append(stage)
+        return stage
+
+    def _run(self, stage: Stage) -> None:
+        start = time.monotonic()
+        with tracer.span(stage.name, stage.kind):
+            stage.run()
+        stage.seconds = time.monotonic() - start
+
+    def execute(self) -> None:
+        if not self.stages:
+            return
+        start = time.monotonic()
+        run_graph(self.stages, self._run)
+        timings = ", ".join(f"{x.name} {x.seconds:.1f}s" for x in self.stages)
+        self.logger.log(f"provisioned in {time.monotonic() - start:.1f}s ({timings})")
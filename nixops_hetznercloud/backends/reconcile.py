@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Concurrent reconciliation of a Hetzner Cloud server's attachments.
+
+import time
+
+from hcloud import APIException, Client
+from hcloud.actions.client import BoundAction
+
+from nixops_hetznercloud.hetznercloud_client import (
+    POLL_TIMEOUT,
+    RETRYABLE_ERRORS,
+    backoff_intervals,
+    get_action_waiter,
+)
+
+from typing import Callable, List, Optional, Sequence
+
+from .graph import Task, run_graph
+
+
+class Operation(Task):
+    """
+    A single attach, detach or assign action planned for a server.
+    """
+
+    def __init__(
+        self,
+        description: str,
+        issue: Callable[[], BoundAction],
+        on_success: Optional[Callable[[], None]] = None,
+        after: Sequence["Operation"] = (),
+    ) -> None:
+        super().__init__(after)
+        self.description = description
+        self.issue = issue
+        self.on_success = on_success
+
+
+class ReconciliationPlan(object):
+    """
+    The set of operations needed to bring a server's volumes, floating IPs and
+    networks in line with its definition.
+
+    Operations are planned up front and then issued concurrently, so a server
+    converges in the time of its slowest action rather than the sum of all of
+    them. Operations only wait for those they explicitly depend on, and are
+    retried with backoff when Hetzner Cloud reports the server or resource as
+    locked by another action.
+    """
+
+    def __init__(self, client: Client, logger) -> None:
+        self._client = client
+        self.logger = logger
+        self.operations: List[Operation] = []
+
+    def add(
+        self,
+        description: str,
+        issue: Callable[[], BoundAction],
+        on_success: Optional[Callable[[], None]] = None,
+        after: Sequence[Operation] = (),
+    ) -> Operation:
+        op = Operation(description, issue, on_success, after)
+        self.operations.append(op)
+        return op
+
+    def _run(self, op: Operation) -> None:
+        self.logger.log(op.description)
+        deadline = time.monotonic() + POLL_TIMEOUT
+        for interval in backoff_intervals():
+            try:
+                action = op.issue()
+                get_action_waiter(self._client).wait([action])
+            except APIException as e:
+                if e.code not in RETRYABLE_ERRORS or time.monotonic() > deadline:
+                    raise
+                time.sleep(interval)
+            else:
+                return
+
+    def execute(self) -> None:
+        """
+        Issue all planned operations, running state updates on this thread.
+        """
+        run_graph(self.operations, self._run, self._on_success)
+
+    def _on_success(self, op: Operation) -> None:
+        if op.on_success is not None:
+            op.on_success()
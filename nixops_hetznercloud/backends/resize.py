@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Batched filesystem growth for a Hetzner Cloud server's resized volumes.
+
+import shlex
+
+from nixops_hetznercloud.hetznercloud_trace import tracer
+from nixops_hetznercloud.resources.volume import VolumeState
+
+from typing import Any, List, Optional
+
+# Runs a grow in the background, reporting its exit status and how long it
+# took, followed by its output if it failed.
+RESIZE_SCRIPT = r"""
+run() {
+    i=$1; shift
+    start=$(date +%s%N)
+    out=$("$@" 2>&1); rc=$?
+    printf 'nixops-resize %s %s %s %s\n' "$i" "$rc" "$start" "$(date +%s%N)"
+    [ "$rc" -eq 0 ] || printf '%s\n' "$out" | sed "s/^/nixops-resize-log $i /"
+}
+
+# ext4 grows online while mounted on any recent kernel. Unmounted
+# filesystems, or kernels that refuse, get checked and resized offline.
+grow_ext4() {
+    if findmnt -rn -S "$1" >/dev/null && resize2fs "$1"; then
+        return 0
+    fi
+    umount "$1" 2>/dev/null
+    e2fsck -fy "$1"
+    [ $? -le 1 ] && resize2fs "$1"
+}
+
+# xfs can only grow while mounted.
+grow_xfs() {
+    xfs_growfs "$1"
+}
+"""
+
+
+class Grow(object):
+    """
+    A volume whose filesystem should grow to fill it.
+    """
+
+    def __init__(self, name: str, res: VolumeState, target: str, fs_type: str):
+        self.name = name
+        self.res = res
+        self.target = target
+        self.fs_type = fs_type
+        self.status: Optional[int] = None
+        self.seconds = 0.0
+        self.output: List[str] = []
+
+
+class ResizeQueue(object):
+    """
+    The filesystems waiting to grow on one machine, driven by each volume's
+    ``needsFSResize`` flag.
+
+    All queued grows run in a single SSH session, each device in parallel
+    with the others, and the volume's flag is only cleared once its grow has
+    succeeded.
+    """
+
+    def __init__(self, machine: Any) -> None:
+        self.machine = machine
+        self.grows: List[Grow] = []
+
+    def add(self, name: str, res: VolumeState, target: str, fs_type: str) -> None:
+        """
+        Queue a filesystem to grow; ``target`` is the device for ext4 and the
+        mount point for xfs.
+        """
+        question = (
+            f"volume {name} was resized, do you wish to grow its"
+            " filesystem to fill the space?"
+        )
+        if res.needsFSResize and self.machine.depl.logger.confirm(question):
+            self.grows.append(Grow(name, res, target, fs_type))
+
+    def _script(self) -> str:
+        jobs = [
+            f"run {i} grow_{grow.fs_type} {shlex.quote(grow.target)} &"
+            for i, grow in enumerate(self.grows)
+        ]
+        return "\n".join([RESIZE_SCRIPT] + jobs + ["wait"])
+
+    def _parse(self, output: str) -> None:
+        for line in output.splitlines():
+            words = line.split(" ", 2)
+            if words[0] == "nixops-resize":
+                i, rc, start, end = line.split()[1:5]
+                grow = self.grows[int(i)]
+                grow.status = int(rc)
+                grow.seconds = (int(end) - int(start)) / 1e9
+            elif words[0] == "nixops-resize-log" and len(words) == 3:
+                self.grows[int(words[1])].output.append(words[2])
+
+    def run(self) -> None:
+        if not self.grows:
+            return
+        names = ", ".join(grow.name for grow in self.grows)
+        self.machine.logger.log(f"growing filesystems on {names}...")
+        with tracer.span("grow filesystems", "ssh", volumes=names):
+            output = self.machine.run_command(
+                self._script(), capture_stdout=True, check=False
+            )
+        self._parse(output or "")
+
+        for grow in self.grows:
+            if grow.status == 0:
+                self.machine.logger.log(
+                    f"grew filesystem on {grow.name} in {grow.seconds:.1f}s"
+                )
+                with grow.res.depl._db:
+                    grow.res.needsFSResize = False
+            else:
+                self.machine.logger.warn(
+                    f"couldn't grow filesystem on {grow.name}"
+                    + (f" (exit status {grow.status})" if grow.status else "")
+                )
+                for line in grow.output:
+                    self.machine.logger.log(f"  {line}")
+        self.grows = []
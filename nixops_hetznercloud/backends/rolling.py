@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Rolling server type changes across a deployment's machines.
+
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from nixops_hetznercloud.hetznercloud_trace import tracer
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .hetznercloud import HetznerCloudState
+
+# How long the first machines to change type wait for others to join their
+# wave, in seconds.
+WAVE_GATHER = 1.0
+
+
+def get_max_unavailable() -> int:
+    """
+    How many machines may be down for a server type change at once, set
+    with ``HCLOUD_MAX_UNAVAILABLE``.
+    """
+    return max(1, int(os.environ.get("HCLOUD_MAX_UNAVAILABLE", 1)))
+
+
+class Resize(object):
+    """
+    A machine waiting to change server type.
+    """
+
+    def __init__(self, machine: "HetznerCloudState", server_type: str) -> None:
+        self.machine = machine
+        self.server_type = server_type
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.seconds = 0.0
+
+
+class RollingResize(object):
+    """
+    Changes the server type of a deployment's machines in waves of at most
+    ``max_unavailable`` machines.
+
+    NixOps creates machines concurrently, so each machine whose type changes
+    queues itself and waits for its wave to finish. The machines of a wave
+    are stopped, resized and started together, and the next wave only
+    starts once every machine of the last one accepts SSH connections. If a
+    machine fails to come back, the machines still queued are left alone and
+    the rollout ends. Nothing of it is kept but its waves, so machines which
+    change type later, such as on the next deploy, start a new rollout.
+    """
+
+    def __init__(self, max_unavailable: int) -> None:
+        self.max_unavailable = max_unavailable
+        self._cond = threading.Condition()
+        self._queue: List[Resize] = []
+        self._leading = False
+        self.waves: List[Tuple[List[str], float]] = []
+
+    def resize(self, machine: "HetznerCloudState", server_type: str) -> None:
+        """
+        Change a machine's server type in its turn, returning once it's back.
+        """
+        job = Resize(machine, server_type)
+        with self._cond:
+            self._queue.append(job)
+            if not self._leading:
+                self._leading = True
+                threading.Thread(
+                    target=self._lead, name="hcloud-rolling-resize", daemon=True
+                ).start()
+            self._cond.notify_all()
+        machine.logger.log(f"waiting to change server type to ‘{server_type}’...")
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+
+    def _next_wave(self) -> List[Resize]:
+        with self._cond:
+            deadline = time.monotonic() + WAVE_GATHER
+            while len(self._queue) < self.max_unavailable:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            wave = self._queue[: self.max_unavailable]
+            del self._queue[: self.max_unavailable]
+            if not wave:
+                self._leading = False
+            return wave
+
+    def _run(self, job: Resize) -> None:
+        start = time.monotonic()
+        try:
+            with tracer.subject_of(job.machine.name):
+                job.machine._change_server_type(job.server_type)
+        except BaseException as e:
+            job.error = e
+        job.seconds = time.monotonic() - start
+
+    def _halt(self, failed: List[Resize]) -> None:
+        names = ", ".join(job.machine.name for job in failed)
+        with self._cond:
+            queued, self._queue = self._queue, []
+            self._leading = False
+        for job in queued:
+            job.error = Exception(
+                f"not changing the server type of {job.machine.full_name}"
+                f" as the rolling change failed on {names}"
+            )
+            job.done.set()
+
+    def _lead(self) -> None:
+        while True:
+            wave = self._next_wave()
+            if not wave:
+                return
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=len(wave)) as executor:
+                list(executor.map(self._run, wave))
+            seconds = time.monotonic() - start
+            names = [job.machine.name for job in wave]
+            self.waves.append((names, seconds))
+            timings = ", ".join(
+                f"{job.machine.name} {job.seconds:.1f}s" for job in wave
+            )
+            for job in wave:
+                job.machine.logger.log(
+                    f"server type change wave {len(self.waves)} took"
+                    f" {seconds:.1f}s ({timings})"
+                )
+            failed = [job for job in wave if job.error is not None]
+            if failed:
+                self._halt(failed)
+            for job in wave:
+                job.done.set()
+            if failed:
+                return
+
+
+_resizes_lock = threading.Lock()
+_resizes: Dict[str, RollingResize] = {}
+
+
+def get_rolling_resize(uuid: str) -> RollingResize:
+    """
+    Get the rolling server type change shared by a deployment's machines.
+    """
+    with _resizes_lock:
+        resize = _resizes.get(uuid)
+        if resize is None:
+            resize = _resizes[uuid] = RollingResize(get_max_unavailable())
+        return resize
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+# Asyncio Hetzner Cloud API client, sharing one event loop across all
+# machines and resources.
+
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hcloud import APIException
+
+from nixops_hetznercloud.hetznercloud_client import (
+    POLL_INTERVAL,
+    POLL_MAX_INTERVAL,
+    POLL_TIMEOUT,
+    POOL_MAXSIZE,
+    RETRYABLE_ERRORS,
+    ActionWaiter,
+    backoff_intervals,
+    check_statuses,
+    get_client,
+)
+from nixops_hetznercloud.hetznercloud_trace import tracer
+
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+
+T = TypeVar("T")
+
+
+class AsyncClient(object):
+    """
+    Hetzner Cloud API client for the shared event loop.
+
+    Requests are handed to a pool of threads and made with the synchronous
+    client for the token, so they share its connection pool, rate limiter,
+    timeouts and proxy settings. Actions are waited on with a single batched
+    poll per client, however many coroutines are waiting, which fetches them
+    the way an ActionWaiter does.
+    """
+
+    def __init__(self, token: str) -> None:
+        self.token = token
+        self._executor = ThreadPoolExecutor(
+            max_workers=POOL_MAXSIZE, thread_name_prefix="hcloud-request"
+        )
+        self._actions: Dict[int, List[asyncio.Future]] = {}
+        self._poller: Optional[asyncio.Task] = None
+        self.requests = 0
+
+    @property
+    def endpoint(self) -> str:
+        return get_client(self.token)._api_endpoint
+
+    # HTTP
+
+    async def _call(
+        self, function: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        # Calls are made in a copy of the caller's context, so that the spans
+        # recorded by the client's session are traced to the caller's subject.
+        call = functools.partial(
+            contextvars.copy_context().run, function, *args, **kwargs
+        )
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Mapping[str, Any]] = None,
+        json_body: Optional[Any] = None,
+    ) -> Dict[str, Any]:
+        """
+        Make an API request, raising an APIException for error responses.
+        """
+        # The client is looked up for every request so that it follows the
+        # registry when it's cleared or the endpoint changes.
+        response = await self._call(
+            get_client(self.token).request, method, url, params=params, json=json_body
+        )
+        self.requests += 1
+        return response or {}
+
+    # Actions
+
+    async def wait_for_actions(
+        self,
+        actions: Iterable[Dict[str, Any]],
+        timeout: float = POLL_TIMEOUT,
+        poll_interval: float = POLL_INTERVAL,
+    ) -> None:
+        """
+        Wait until all actions have finished, raising if any of them failed.
+        If nothing else is being waited on, the first poll is made after
+        ``poll_interval`` seconds.
+        """
+        actions = list(actions)
+        loop = asyncio.get_running_loop()
+        futures: List[Tuple[int, asyncio.Future]] = []
+        for action in actions:
+            if action["status"] == "running":
+                future = loop.create_future()
+                self._actions.setdefault(action["id"], []).append(future)
+                futures.append((action["id"], future))
+        if futures and (self._poller is None or self._poller.done()):
+            self._poller = asyncio.create_task(self._poll_actions(poll_interval))
+
+        commands = ", ".join(sorted({a["command"] for a in actions}))
+        try:
+            with tracer.span(f"wait for {commands}", "action"):
+                results = await asyncio.wait_for(
+                    asyncio.gather(*(f for _, f in futures)), timeout
+                )
+        except asyncio.TimeoutError:
+            raise Exception(
+                "timed out waiting for actions"
+                f" {', '.join(str(id) for id, _ in futures)}"
+            )
+        finally:
+            for id, future in futures:
+                waiting = self._actions.get(id, [])
+                if future in waiting:
+                    waiting.remove(future)
+                if not waiting:
+                    self._actions.pop(id, None)
+
+        check_statuses(
+            [(a["status"], a.get("error")) for a in actions if a["status"] != "running"]
+            + results
+        )
+
+    async def _poll_actions(self, initial: float = POLL_INTERVAL) -> None:
+        for interval in backoff_intervals(initial, POLL_MAX_INTERVAL):
+            if not self._actions:
+                return
+            await asyncio.sleep(interval)
+            # A waiter of the poll's own fetches the actions, so that its
+            # requests are counted here rather than against the shared one.
+            waiter = ActionWaiter(get_client(self.token))
+            finished, failed = await self._call(waiter.fetch, list(self._actions))
+            self.requests += waiter.requests
+            for id, error in failed.items():
+                for future in self._actions.pop(id, []):
+                    if not future.done():
+                        future.set_exception(error)
+            for id, result in finished.items():
+                for future in self._actions.pop(id, []):
+                    if not future.done():
+                        future.set_result(result)
+
+    # Resources
+
+    async def get(self, kind: str, id: int) -> Optional[Dict[str, Any]]:
+        """
+        Get a resource by its ID, or None if it doesn't exist.
+        """
+        try:
+            response = await self.request("GET", f"/{kind}/{id}")
+        except APIException as e:
+            if e.code == "not_found":
+                return None
+            raise
+        return next(iter(response.values()))
+
+    async def get_all(
+        self, kind: str, label_selector: Optional[str] = None, **filters: Any
+    ) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {**filters, "per_page": 50, "page": 1}
+        if label_selector is not None:
+            params["label_selector"] = label_selector
+        results: List[Dict[str, Any]] = []
+        while params["page"]:
+            response = await self.request("GET", f"/{kind}", params=params)
+            results.extend(response[kind])
+            params["page"] = response["meta"]["pagination"]["next_page"]
+        return results
+
+    async def _request_retrying(
+        self,
+        method: str,
+        url: str,
+        json_body: Optional[Any] = None,
+        initial: float = POLL_INTERVAL,
+        max_interval: float = POLL_MAX_INTERVAL,
+    ) -> Dict[str, Any]:
+        deadline = time.monotonic() + POLL_TIMEOUT
+        for interval in backoff_intervals(initial, max_interval):
+            try:
+                return await self.request(method, url, json_body=json_body)
+            except APIException as e:
+                if e.code not in RETRYABLE_ERRORS or time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(interval)
+        raise AssertionError("unreachable")
+
+    async def delete(self, kind: str, id: int) -> None:
+        """
+        Delete a resource, waiting for the deletion if it's an action.
+        """
+        response = await self._request_retrying("DELETE", f"/{kind}/{id}")
+        if response.get("action"):
+            await self.wait_for_actions([response["action"]])
+
+    async def start_action(
+        self,
+        kind: str,
+        id: int,
+        command: str,
+        body: Optional[Dict[str, Any]] = None,
+        retry_interval: float = POLL_INTERVAL,
+    ) -> Dict[str, Any]:
+        """
+        Start an action on a resource without waiting for it to finish,
+        retrying every ``retry_interval`` seconds or so while the resource is
+        locked by another one. Returns the response, which holds the action
+        and any resource it creates.
+        """
+        response = await self._request_retrying(
+            "POST",
+            f"/{kind}/{id}/actions/{command}",
+            json_body=body or {},
+            initial=retry_interval,
+            max_interval=max(retry_interval, POLL_INTERVAL),
+        )
+        return response
+
+    async def action(
+        self, kind: str, id: int, command: str, body: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Run an action on a resource, such as ``poweron`` on a server, and wait
+        for it to finish. Actions are retried while the resource is locked by
+        another one.
+        """
+        response = await self._request_retrying(
+            "POST", f"/{kind}/{id}/actions/{command}", json_body=body or {}
+        )
+        await self.wait_for_actions([response["action"]])
+        return response
+
+
+class EventLoop(object):
+    """
+    An asyncio event loop running in a background thread, which any thread
+    can hand coroutines to.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="hcloud-async", daemon=True
+                ).start()
+            return self._loop
+
+    def run(self, coro: Awaitable[T]) -> T:
+        """
+        Run a coroutine on the loop and block until it returns.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+
+loop = EventLoop()
+
+_clients: Dict[str, AsyncClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_async_client(token: str) -> AsyncClient:
+    """
+    Get the shared asyncio Hetzner Cloud client for an API token.
+    """
+    with _clients_lock:
+        client = _clients.get(token)
+        if client is None:
+            client = _clients[token] = AsyncClient(token)
+        return client
+
+
+def run(coro: Awaitable[T]) -> T:
+    """
+    Run a coroutine on the shared event loop from any thread.
+    """
+    return loop.run(coro)
+
+
+async def gather(aws: Sequence[Awaitable[T]]) -> List[T]:
+    """
+    Run awaitables concurrently, raising the first error only once all of
+    them have finished.
+    """
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results  # type: ignore
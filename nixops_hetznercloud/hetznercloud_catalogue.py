@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of Hetzner Cloud's locations, server types and system images.
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from nixops_hetznercloud import hetznercloud_async
+from nixops_hetznercloud.hetznercloud_async import AsyncClient, gather
+from nixops_hetznercloud.hetznercloud_client import API_ENDPOINT
+
+from typing import Any, Dict, Optional
+
+# How long a fetched catalogue is trusted, in seconds.
+CATALOGUE_TTL = float(os.environ.get("HCLOUD_CATALOGUE_TTL", 24 * 60 * 60))
+
+
+def get_cache_path() -> str:
+    return os.environ.get("HCLOUD_CATALOGUE_CACHE") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "nixops-hetznercloud",
+        "catalogue.json",
+    )
+
+
+def get_endpoint() -> str:
+    return os.environ.get("HCLOUD_ENDPOINT") or API_ENDPOINT
+
+
+class Catalogue(object):
+    """
+    Hetzner Cloud's locations, server types (with their prices and disk
+    sizes) and system images, indexed by name.
+
+    These change rarely and are the same for every project, so they're
+    fetched once and kept on disk for ``CATALOGUE_TTL`` seconds, shared by
+    every deployment and NixOps process. Resources look them up here instead
+    of asking the API each time they create something, and machines being
+    created are checked against whatever catalogue is cached before any API
+    calls.
+    """
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.fetched: float = data["fetched"]
+        self.locations: Dict[str, Dict[str, Any]] = data["locations"]
+        self.server_types: Dict[str, Dict[str, Any]] = data["server_types"]
+        self.images: Dict[str, Dict[str, Any]] = data["images"]
+
+    @property
+    def expired(self) -> bool:
+        return time.time() - self.fetched > CATALOGUE_TTL
+
+    def location(self, name: str) -> Dict[str, Any]:
+        if name not in self.locations:
+            raise Exception(
+                f"unknown Hetzner Cloud location ‘{name}’; choose one of"
+                f" {', '.join(sorted(self.locations))}"
+            )
+        return self.locations[name]
+
+    def server_type(self, name: str) -> Dict[str, Any]:
+        if name not in self.server_types:
+            raise Exception(f"unknown Hetzner Cloud server type ‘{name}’")
+        return self.server_types[name]
+
+    def image(self, name: str) -> Optional[Dict[str, Any]]:
+        return self.images.get(name)
+
+    def validate(self, server_type: Optional[str], location: Optional[str]) -> None:
+        """
+        Raise if a server type or location doesn't exist, or the server type
+        isn't offered at the location.
+        """
+        if location is not None:
+            self.location(location)
+        if server_type is None:
+            return
+        locations = {x["location"] for x in self.server_type(server_type)["prices"]}
+        if location is not None and location not in locations:
+            raise Exception(
+                f"server type ‘{server_type}’ isn't available at ‘{location}’;"
+                f" it is offered at {', '.join(sorted(locations))}"
+            )
+
+    def price(self, server_type: str, location: str) -> Dict[str, Any]:
+        """
+        The hourly and monthly price of a server type at a location.
+        """
+        for price in self.server_type(server_type)["prices"]:
+            if price["location"] == location:
+                return price
+        raise Exception(f"server type ‘{server_type}’ has no price at ‘{location}’")
+
+
+async def _fetch(client: AsyncClient) -> Dict[str, Any]:
+    locations, server_types, images = await gather(
+        [
+            client.get_all("locations"),
+            client.get_all("server_types"),
+            client.get_all("images", type="system"),
+        ]
+    )
+    return {
+        "fetched": time.time(),
+        "locations": {x["name"]: x for x in locations},
+        "server_types": {x["name"]: x for x in server_types},
+        "images": {x["name"]: x for x in images if x["name"]},
+    }
+
+
+class CatalogueCache(object):
+    """
+    The cached catalogue of every API endpoint, kept in one JSON file.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._loaded: Dict[str, Catalogue] = {}
+
+    def _read(self, path: str) -> Dict[str, Any]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, path: str, endpoint: str, data: Dict[str, Any]) -> None:
+        # Other processes may be reading the file, so it's replaced whole.
+        entries = self._read(path)
+        entries[endpoint] = data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".catalogue-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def cached(self, endpoint: Optional[str] = None) -> Optional[Catalogue]:
+        """
+        The cached catalogue for an endpoint, however old, without making any
+        API calls.
+        """
+        path, endpoint = get_cache_path(), endpoint or get_endpoint()
+        with self._lock:
+            catalogue = self._loaded.get(f"{path}#{endpoint}")
+            # Another process may have fetched a newer one meanwhile.
+            if catalogue is None or catalogue.expired:
+                data = self._read(path).get(endpoint)
+                if data is not None:
+                    catalogue = self._loaded[f"{path}#{endpoint}"] = Catalogue(data)
+            return catalogue
+
+    def get(self, client: AsyncClient) -> Catalogue:
+        """
+        The catalogue for the client's endpoint, fetched again once expired.
+        """
+        catalogue = self.cached(client.endpoint)
+        if catalogue is not None and not catalogue.expired:
+            return catalogue
+        path, endpoint = get_cache_path(), client.endpoint
+        with self._lock:
+            catalogue = self._loaded.get(f"{path}#{endpoint}")
+            if catalogue is None or catalogue.expired:
+                data = hetznercloud_async.run(_fetch(client))
+                try:
+                    self._write(path, endpoint, data)
+                except OSError:
+                    pass  # the catalogue is then only cached for this process
+                catalogue = self._loaded[f"{path}#{endpoint}"] = Catalogue(data)
+            return catalogue
+
+
+cache = CatalogueCache()
+
+
+def get_catalogue(client: AsyncClient) -> Catalogue:
+    """
+    Get the catalogue, from disk while it's fresh.
+    """
+    return cache.get(client)
+
+
+def validate_offline(
+    server_type: Optional[str] = None, location: Optional[str] = None
+) -> None:
+    """
+    Check a server type and location against the cached catalogue, if there
+    is a fresh one.
+    """
+    catalogue = cache.cached()
+    if catalogue is not None and not catalogue.expired:
+        catalogue.validate(server_type, location)
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+
+# Process-wide registry of Hetzner Cloud API clients, rate limiters and action
+# waiters.
+
+import atexit
+import os
+import sys
+import threading
+import time
+
+from hcloud import APIException, Client
+from hcloud.actions.client import BoundAction
+from requests import RequestException, Response, Session
+from requests.adapters import HTTPAdapter
+
+from nixops_hetznercloud.hetznercloud_trace import tracer
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+
+# The API can be redirected, e.g. to a mock server in tests, with
+# HCLOUD_ENDPOINT.
+API_ENDPOINT = "https://api.hetzner.cloud/v1"
+
+# NixOps realises machines with a pool of worker threads; size the connection
+# pool so that every worker can keep its own connection alive.
+POOL_MAXSIZE = 32
+
+# How long to wait for the API to accept a connection or send data before
+# giving up on a request, in seconds.
+REQUEST_TIMEOUT = float(os.environ.get("HCLOUD_REQUEST_TIMEOUT", 60))
+
+# Polling schedule for actions and resources which are still being created.
+POLL_INTERVAL = 0.5
+POLL_BACKOFF = 1.5
+POLL_MAX_INTERVAL = float(os.environ.get("HCLOUD_POLL_MAX_INTERVAL", 5))
+POLL_TIMEOUT = float(os.environ.get("HCLOUD_POLL_TIMEOUT", 1800))
+
+# The API returns at most 50 items per page.
+ACTIONS_PER_REQUEST = 50
+
+# Hetzner Cloud allows 3600 requests per hour and project, refilling at one
+# request per second. Once the budget drops below the reserve, requests are
+# paced at the refill rate rather than running the budget dry.
+RATE_LIMIT = 3600
+RATE_LIMIT_REFILL = 1.0
+RATE_LIMIT_RESERVE = float(os.environ.get("HCLOUD_RATE_LIMIT_RESERVE", 100))
+RATE_LIMIT_RETRIES = 10
+
+# Errors returned while a server, or the resource being attached, is busy
+# with another action. These are expected when operations run concurrently.
+RETRYABLE_ERRORS = {"locked", "conflict"}
+
+# Errors which only mean the API couldn't answer this time. Polls failing
+# with them, or with the connection dropping or timing out, are retried.
+TRANSIENT_ERRORS = {
+    "rate_limit_exceeded",
+    "server_error",
+    "service_error",
+    "timeout",
+    "unavailable",
+    500,
+    502,
+    503,
+    504,
+}
+
+
+def backoff_intervals(
+    initial: float = POLL_INTERVAL,
+    max_interval: float = POLL_MAX_INTERVAL,
+    factor: float = POLL_BACKOFF,
+) -> Iterator[float]:
+    """
+    Yield sleep intervals growing exponentially up to a ceiling.
+    """
+    interval = initial
+    while True:
+        yield interval
+        interval = min(interval * factor, max_interval)
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether a failed poll is worth retrying rather than giving up on.
+    """
+    if isinstance(error, RequestException):
+        return True
+    return isinstance(error, APIException) and error.code in TRANSIENT_ERRORS
+
+
+class RateLimiter(object):
+    """
+    Token bucket tracking the request budget of an API token.
+
+    The bucket is kept in step with the ``RateLimit-*`` headers of every
+    response, so requests made by other processes using the same token are
+    accounted for too.
+    """
+
+    def __init__(
+        self,
+        limit: int = RATE_LIMIT,
+        refill_rate: float = RATE_LIMIT_REFILL,
+        reserve: float = RATE_LIMIT_RESERVE,
+    ) -> None:
+        self._lock = threading.Lock()
+        self._updated = time.monotonic()
+        self._next_paced = self._updated
+        self.limit = limit
+        self.refill_rate = refill_rate
+        self.reserve = min(reserve, limit - 1)
+        self.tokens = float(limit)
+        self.throttled = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            float(self.limit), self.tokens + (now - self._updated) * self.refill_rate
+        )
+        self._updated = now
+
+    def take(self) -> float:
+        """
+        Take one request from the budget if there's room for it, otherwise
+        return how long to wait before trying again.
+        """
+        with self._lock:
+            self._refill()
+            now = time.monotonic()
+            if self.tokens >= self.reserve + 1:
+                self.tokens -= 1
+                return 0.0
+            if self.tokens >= 1 and now >= self._next_paced:
+                self.tokens -= 1
+                self._next_paced = now + 1 / self.refill_rate
+                return 0.0
+            delay = max(self._next_paced - now, (1 - self.tokens) / self.refill_rate)
+            self.throttled += delay
+            return delay
+
+    def acquire(self) -> None:
+        """
+        Take one request from the budget, sleeping until there's room for it.
+        """
+        while (delay := self.take()) > 0:
+            time.sleep(delay)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """
+        Resynchronise the budget with the API's ``RateLimit-*`` headers.
+        """
+        try:
+            limit = int(headers["RateLimit-Limit"])
+            remaining = int(headers["RateLimit-Remaining"])
+            reset = int(headers["RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self._refill()
+            self.limit = limit
+            self.reserve = min(self.reserve, limit - 1)
+            self.tokens = float(remaining)
+            # RateLimit-Reset is when the budget will be full again.
+            until_reset = reset - time.time()
+            if until_reset > 0 and remaining < limit:
+                self.refill_rate = max(
+                    (limit - remaining) / until_reset, RATE_LIMIT_REFILL
+                )
+
+    def exhaust(self) -> None:
+        with self._lock:
+            self.tokens = 0.0
+            self._updated = time.monotonic()
+
+    @property
+    def budget(self) -> Dict[str, float]:
+        with self._lock:
+            self._refill()
+            return {
+                "limit": self.limit,
+                "remaining": self.tokens,
+                "refillRate": self.refill_rate,
+                "throttled": self.throttled,
+            }
+
+
+class RateLimitedSession(Session):
+    """
+    Requests session which draws every request from a rate limiter, and waits
+    for the budget to refill when the API reports it's exceeded. Requests
+    time out after ``REQUEST_TIMEOUT`` seconds unless told otherwise.
+    """
+
+    def __init__(self, limiter: RateLimiter) -> None:
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs) -> Response:  # type: ignore
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        for _ in range(RATE_LIMIT_RETRIES):
+            self.limiter.acquire()
+            with tracer.span(f"{method} {url.split('/v1', 1)[-1]}", "api"):
+                response = super().request(method, url, *args, **kwargs)
+            self.limiter.update(response.headers)
+            if response.status_code != 429:
+                break
+            self.limiter.exhaust()
+        return response
+
+
+def check_statuses(statuses: Iterable[Tuple[str, Any]]) -> None:
+    """
+    Raise if any of the statuses and errors of finished actions isn't a
+    success.
+    """
+    for status, error in statuses:
+        if status != "success":
+            message = f": {error['message']}" if error else ""
+            raise Exception(f"unexpected status: {status}{message}")
+
+
+class ActionWaiter(object):
+    """
+    Waits for Hetzner Cloud actions to finish.
+
+    All threads waiting on actions for the same client share a single poll:
+    whichever waiter's turn it is fetches every outstanding action with one
+    ``GET /actions?id=…`` request and hands the results to the others, so N
+    parallel machine operations cost one request per tick rather than N.
+    Polls which fail transiently are retried at the next tick, and a poll
+    which fails for good only fails the actions it asked for.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        max_interval: float = POLL_MAX_INTERVAL,
+        timeout: float = POLL_TIMEOUT,
+    ) -> None:
+        self._client = client
+        self._cond = threading.Condition()
+        self._polling = False
+        self._waiters: Dict[int, int] = {}
+        self._finished: Dict[int, Tuple[str, Any]] = {}
+        self._failed: Dict[int, Exception] = {}
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.requests = 0
+
+    def fetch(
+        self, ids: Sequence[int]
+    ) -> Tuple[Dict[int, Tuple[str, Any]], Dict[int, Exception]]:
+        """
+        Fetch actions with one request per ``ACTIONS_PER_REQUEST`` of them.
+        Returns the status and error of those which have finished, and the
+        error of those whose request failed. Actions whose request failed
+        transiently are in neither, so they're fetched again next time.
+        """
+        finished: Dict[int, Tuple[str, Any]] = {}
+        failed: Dict[int, Exception] = {}
+        for i in range(0, len(ids), ACTIONS_PER_REQUEST):
+            chunk = ids[i : i + ACTIONS_PER_REQUEST]
+            self.requests += 1
+            try:
+                response = self._client.request(
+                    url="/actions",
+                    method="GET",
+                    params={"id": chunk, "per_page": ACTIONS_PER_REQUEST},
+                )
+            except (APIException, RequestException) as e:
+                if not is_transient(e):
+                    failed.update((x, e) for x in chunk)
+                continue
+            for action in response["actions"]:
+                if action["status"] != "running":
+                    finished[action["id"]] = (action["status"], action["error"])
+        return finished, failed
+
+    def _poll(self) -> None:
+        with self._cond:
+            ids = [
+                x
+                for x in self._waiters
+                if x not in self._finished and x not in self._failed
+            ]
+        finished, failed = self.fetch(ids)
+        with self._cond:
+            self._finished.update(finished)
+            self._failed.update(failed)
+
+    def wait(
+        self,
+        actions: Sequence[BoundAction],
+        on_tick: Optional[Callable[[], None]] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Block until all actions have finished, raising if any of them failed.
+        """
+        commands = ", ".join(sorted({a.command for a in actions}))
+        with tracer.span(f"wait for {commands}", "action"):
+            self._wait(actions, on_tick, timeout)
+
+    def _wait(
+        self,
+        actions: Sequence[BoundAction],
+        on_tick: Optional[Callable[[], None]],
+        timeout: Optional[float],
+    ) -> None:
+        statuses: Dict[int, Tuple[str, Any]] = {
+            a.id: (a.status, a.error) for a in actions if a.status != "running"
+        }
+        pending = {a.id for a in actions if a.status == "running"}
+        registered = set(pending)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        intervals = backoff_intervals(max_interval=self.max_interval)
+
+        with self._cond:
+            for x in registered:
+                self._waiters[x] = self._waiters.get(x, 0) + 1
+        try:
+            while True:
+                interval = next(intervals)
+                with self._cond:
+                    for x in [x for x in pending if x in self._failed]:
+                        raise self._failed[x]
+                    for x in [x for x in pending if x in self._finished]:
+                        statuses[x] = self._finished[x]
+                        pending.discard(x)
+                    if not pending:
+                        break
+                    if time.monotonic() > deadline:
+                        raise Exception(
+                            "timed out waiting for actions"
+                            f" {', '.join(map(str, sorted(pending)))}"
+                        )
+                    leader = not self._polling
+                    if leader:
+                        self._polling = True
+                    else:
+                        self._cond.wait(interval)
+                if leader:
+                    try:
+                        time.sleep(interval)
+                        self._poll()
+                    finally:
+                        with self._cond:
+                            self._polling = False
+                            self._cond.notify_all()
+                if on_tick is not None:
+                    on_tick()
+        finally:
+            with self._cond:
+                for x in registered:
+                    self._waiters[x] -= 1
+                    if self._waiters[x] == 0:
+                        del self._waiters[x]
+                        self._finished.pop(x, None)
+                        self._failed.pop(x, None)
+
+        check_statuses(statuses.values())
+
+
+class ClientRegistry(object):
+    """
+    Hands out one shared Hetzner Cloud client per API token.
+
+    Every client is backed by a single requests session whose connection pool
+    keeps connections to the API alive, so resources sharing a token also
+    share TLS sessions instead of performing a handshake each.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._clients: Dict[str, Client] = {}
+        self._waiters: Dict[str, ActionWaiter] = {}
+        self._limiters: Dict[str, RateLimiter] = {}
+        self.clients_opened = 0
+        self.clients_reused = 0
+
+    def get(self, token: str) -> Client:
+        endpoint = os.environ.get("HCLOUD_ENDPOINT") or API_ENDPOINT
+        with self._lock:
+            client = self._clients.get(token)
+            if client is not None and client._api_endpoint == endpoint:
+                self.clients_reused += 1
+                return client
+            client = Client(token=token, api_endpoint=endpoint)
+            limiter = self._limiters.setdefault(token, RateLimiter())
+            client._requests_session = RateLimitedSession(limiter)
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_MAXSIZE, pool_block=False
+            )
+            client._requests_session.mount("https://", adapter)
+            client._requests_session.mount("http://", adapter)
+            self._clients[token] = client
+            self._waiters[token] = ActionWaiter(client)
+            self.clients_opened += 1
+            return client
+
+    def lookup(self, token: str) -> Optional[Client]:
+        """
+        The client for a token, if it's still current, without counting it
+        as reused.
+        """
+        endpoint = os.environ.get("HCLOUD_ENDPOINT") or API_ENDPOINT
+        with self._lock:
+            client = self._clients.get(token)
+            if client is not None and client._api_endpoint == endpoint:
+                return client
+            return None
+
+    def get_rate_limiter(self, token: str) -> RateLimiter:
+        with self._lock:
+            return self._limiters.setdefault(token, RateLimiter())
+
+    def get_action_waiter(self, client: Client) -> ActionWaiter:
+        with self._lock:
+            waiter = self._waiters.get(client.token)
+            if waiter is None or waiter._client is not client:
+                waiter = self._waiters[client.token] = ActionWaiter(client)
+            return waiter
+
+    def _connection_pools(self):
+        adapters = {
+            id(adapter): adapter
+            for client in self._clients.values()
+            for adapter in client._requests_session.adapters.values()
+        }
+        for adapter in adapters.values():
+            yield from adapter.poolmanager.pools._container.values()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Report client and HTTP connection reuse across the process.
+        """
+        with self._lock:
+            pools = list(self._connection_pools())
+            requests = sum(pool.num_requests for pool in pools)
+            connections = sum(pool.num_connections for pool in pools)
+            return {
+                "clientsOpened": self.clients_opened,
+                "clientsReused": self.clients_reused,
+                "connectionsOpened": connections,
+                "connectionsReused": max(requests - connections, 0),
+                "secondsThrottled": sum(
+                    limiter.throttled for limiter in self._limiters.values()
+                ),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client._requests_session.close()
+            self._clients = {}
+            self._waiters = {}
+
+
+registry = ClientRegistry()
+
+
+@atexit.register
+def _report_stats() -> None:
+    if os.environ.get("HCLOUD_CLIENT_STATS") and registry.clients_opened:
+        stats = registry.stats()
+        sys.stderr.write(
+            "hetznercloud: {clientsOpened} clients opened, {clientsReused} reused;"
+            " {connectionsOpened} connections opened,"
+            " {connectionsReused} reused;"
+            " {secondsThrottled:.1f}s throttled by rate limiting\n".format(**stats)
+        )
+
+
+def get_client(token: str) -> Client:
+    """
+    Get the shared Hetzner Cloud client for an API token.
+    """
+    return registry.get(token)
+
+
+def get_action_waiter(client: Client) -> ActionWaiter:
+    """
+    Get the action waiter shared by every user of a client.
+    """
+    return registry.get_action_waiter(client)
+
+
+def get_rate_limiter(token: str) -> RateLimiter:
+    """
+    Get the rate limiter shared by every client for an API token.
+    """
+    return registry.get_rate_limiter(token)
@@ -6,17 +6,41 @@ import socket
 import getpass
 import time
 
-from hcloud import Client, APIException
+from hcloud import Client
 from hcloud.actions.client import BoundAction
 
 from nixops.util import attr_property
 from nixops.resources import ResourceState, DiffEngineResourceState
-
-from typing import Dict, Any, Optional, Type, TypeVar
+from nixops_hetznercloud import hetznercloud_async
+from nixops_hetznercloud.hetznercloud_async import AsyncClient, get_async_client
+from nixops_hetznercloud.hetznercloud_catalogue import Catalogue, get_catalogue
+from nixops_hetznercloud.hetznercloud_client import (
+    POLL_TIMEOUT,
+    backoff_intervals,
+    get_action_waiter,
+    get_client,
+)
+from nixops_hetznercloud.hetznercloud_snapshot import (
+    DeploymentSnapshot,
+    get_snapshot,
+    within_pass,
+)
+from nixops_hetznercloud.hetznercloud_teardown import (
+    bulk_destroy_enabled,
+    destroy_deployment,
+    forget_teardown,
+)
+from nixops_hetznercloud.hetznercloud_trace import traced, tracer
+
+from typing import Dict, Any, Optional, Sequence, Type, TypeVar
 
 
 TypedResource = TypeVar("TypedResource")
 
+INFECT_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "data", "nixos-infect")
+)
+
 
 class HetznerCloudResourceState(DiffEngineResourceState):
 
@@ -69,19 +93,21 @@ class HetznerCloudResourceState(DiffEngineResourceState):
             name = name.split("-")[6]
         return self.depl.get_typed_resource(name, type_name, type)
 
-    def get_instance(self) -> Any:
-        try:
-            subclient = getattr(self.get_client(), self._resource_type)
-            return subclient.get_by_id(self.resource_id)
-        except APIException as e:
-            if e.code == "not_found":
-                return None
-            else:
-                raise
+    def get_instance(self, refresh: bool = False) -> Any:
+        if refresh:
+            self.forget_instance()
+        return self.get_snapshot().get_by_id(self._resource_type, self.resource_id)
+
+    def forget_instance(self) -> None:
+        self.get_snapshot().forget(self._resource_type, self.resource_id)
+
+    def get_snapshot(self) -> DeploymentSnapshot:
+        return get_snapshot(self.get_client(), self.depl.uuid)
 
     def get_client(self) -> Client:
         """
-        Generic method to get or create a Hetzner Cloud client.
+        Generic method to get the shared Hetzner Cloud client for this
+        resource's API token.
         """
 
         if hasattr(self, "_client"):
@@ -100,9 +126,19 @@ class HetznerCloudResourceState(DiffEngineResourceState):
         if self.api_token is None:
             raise Exception("please set ‘apiToken’ or $HCLOUD_API_TOKEN")
 
-        self._client = Client(token=self.api_token)
+        self._client = get_client(self.api_token)
         return self._client
 
+    def get_async_client(self) -> AsyncClient:
+        """
+        Get the shared asyncio client for this resource's API token.
+        """
+        self.get_client()
+        return get_async_client(self.api_token)
+
+    def get_catalogue(self) -> Catalogue:
+        return get_catalogue(self.get_async_client())
+
     def realise_modify_labels(self, allow_recreate: bool) -> None:
         defn = self.get_defn().config
 
@@ -110,6 +146,7 @@ class HetznerCloudResourceState(DiffEngineResourceState):
         self.get_instance().update(
             labels={**self.get_common_labels(), **dict(defn.labels)}
         )
+        self.forget_instance()
 
         with self.depl._db:
             self._state["labels"] = dict(defn.labels)
@@ -118,31 +155,42 @@ class HetznerCloudResourceState(DiffEngineResourceState):
         self, resource_id: str, resource_type: Optional[str] = None
     ) -> None:
         resource_type = resource_type or self._resource_type
-        while True:
-            res = getattr(self.get_client(), resource_type).get_by_id(resource_id)
-            if res.created is None:
+        deadline = time.monotonic() + POLL_TIMEOUT
+        with tracer.span(f"wait for {resource_type}", "action"):
+            for interval in backoff_intervals():
+                res = getattr(self.get_client(), resource_type).get_by_id(resource_id)
+                if res.created is not None:
+                    break
+                if time.monotonic() > deadline:
+                    raise Exception(f"timed out waiting for {self.full_name}")
                 self.logger.log_continue(".")
-                time.sleep(1)
-            else:
-                break
+                time.sleep(interval)
         self.logger.log_end(" done")
 
         with self.depl._db:
             self.state = self.UP
 
     def wait_on_action(self, action: BoundAction) -> None:
-        while action.status == "running":
-            self.logger.log_continue(".")
-            time.sleep(1)
-            action = self.get_client().actions.get_by_id(action.id)
+        self.wait_on_actions([action])
+
+    def wait_on_actions(self, actions: Sequence[BoundAction]) -> None:
+        get_action_waiter(self.get_client()).wait(
+            actions, on_tick=lambda: self.logger.log_continue(".")
+        )
         self.logger.log_end("")
-        if action.status != "success":
-            raise Exception(f"unexpected status: {action.status}")
 
     def cleanup_state(self) -> None:
         """Discard all state pertaining to an instance"""
         raise NotImplementedError
 
+    @traced("create")
+    @within_pass
+    def create(self, defn, check, allow_reboot, allow_recreate) -> None:
+        forget_teardown(self.depl.uuid)
+        super().create(defn, check, allow_reboot, allow_recreate)
+
+    @traced("check")
+    @within_pass
     def _check(self) -> None:
         if self.resource_id is None:
             return
@@ -158,9 +206,22 @@ class HetznerCloudResourceState(DiffEngineResourceState):
     def _destroy(self) -> None:
         if (instance := self.get_instance()) is not None:
             self.logger.log(f"destroying {self.full_name}...")
-            instance.delete()
+            hetznercloud_async.run(
+                self.get_async_client().delete(self._resource_type, instance.id)
+            )
+            self.forget_instance()
+        self.cleanup_state()
+
+    def _destroy_in_bulk(self) -> None:
+        destroy_deployment(self.get_async_client(), self.depl.uuid, self.logger)
+        self.forget_instance()
         self.cleanup_state()
 
+    @traced("destroy")
+    @within_pass
     def destroy(self, wipe: bool = False) -> bool:
-        self._destroy()
+        if bulk_destroy_enabled():
+            self._destroy_in_bulk()
+        else:
+            self._destroy()
         return True
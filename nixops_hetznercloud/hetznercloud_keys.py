@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Deployment-wide registry of the SSH keys servers are created with.
+
+import base64
+import hashlib
+import threading
+
+from hcloud import APIException, Client
+from hcloud.ssh_keys.client import BoundSSHKey
+
+from nixops_hetznercloud.hetznercloud_client import get_client, registry
+from nixops_hetznercloud.hetznercloud_snapshot import get_snapshot
+
+from typing import Dict, Optional, Tuple
+
+
+def get_fingerprint(public_key: str) -> str:
+    """
+    The MD5 fingerprint Hetzner Cloud identifies an SSH public key by.
+    """
+    digest = hashlib.md5(base64.b64decode(public_key.split()[1])).hexdigest()
+    return ":".join(digest[i : i + 2] for i in range(0, len(digest), 2))
+
+
+class SSHKeyRegistry(object):
+    """
+    The Hetzner Cloud SSH keys of a deployment's servers, looked up by the
+    fingerprint of their public key.
+
+    Each public key costs one filtered API call the first time it's looked
+    up, after which it's served from memory, rather than every server
+    creation listing all the keys in the project. Machines asking for the
+    same key at the same time, such as the key shared by a deployment's
+    machines, only create it once.
+    """
+
+    def __init__(self, client: Client, uuid: str) -> None:
+        self._client = client
+        self.uuid = uuid
+        self._lock = threading.Lock()
+        self._locks: Dict[str, threading.Lock] = {}
+        self._keys: Dict[str, BoundSSHKey] = {}
+        # Held while a machine adopts or gives up the deployment's shared key.
+        self.shared_lock = threading.Lock()
+
+    def _lock_for(self, fingerprint: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(fingerprint, threading.Lock())
+
+    def _lookup(self, fingerprint: str) -> Optional[BoundSSHKey]:
+        key = self._keys.get(fingerprint)
+        if key is None:
+            key = self._client.ssh_keys.get_by_fingerprint(fingerprint)
+            if key is not None:
+                self._keys[fingerprint] = key
+        return key
+
+    def get(self, public_key: str) -> Optional[BoundSSHKey]:
+        fingerprint = get_fingerprint(public_key)
+        with self._lock_for(fingerprint):
+            return self._lookup(fingerprint)
+
+    def ensure(self, name: str, public_key: str, labels: Dict[str, str]) -> BoundSSHKey:
+        """
+        Get the key with a public key, creating it under ``name`` if there's
+        none. A key left under that name for another public key is replaced.
+        """
+        fingerprint = get_fingerprint(public_key)
+        with self._lock_for(fingerprint):
+            key = self._lookup(fingerprint)
+            if key is not None:
+                return key
+            snapshot = get_snapshot(self._client, self.uuid)
+            stale = snapshot.get_by_name("ssh_keys", name)
+            if stale is not None:
+                self._client.ssh_keys.delete(stale)
+                snapshot.forget("ssh_keys", stale.id)
+                self.forget(stale.id)
+            key = self._client.ssh_keys.create(
+                name=name, public_key=public_key.strip(), labels=labels
+            )
+            self._keys[fingerprint] = key
+            return key
+
+    def delete(self, name: str) -> None:
+        """
+        Delete the key with a name, if there is one.
+        """
+        snapshot = get_snapshot(self._client, self.uuid)
+        key = snapshot.get_by_name("ssh_keys", name)
+        if key is None:
+            return
+        try:
+            self._client.ssh_keys.delete(key)
+        except APIException as e:
+            if e.code != "not_found":
+                raise
+        snapshot.forget("ssh_keys", key.id)
+        self.forget(key.id)
+
+    def forget(self, id: int) -> None:
+        with self._lock:
+            for fingerprint, key in list(self._keys.items()):
+                if key.id == id:
+                    del self._keys[fingerprint]
+
+
+_registries_lock = threading.Lock()
+_registries: Dict[Tuple[str, str], SSHKeyRegistry] = {}
+
+
+def get_key_registry(client: Client, uuid: str) -> SSHKeyRegistry:
+    """
+    Get the shared SSH key registry of a deployment for a client's token,
+    which is started afresh whenever the registry's client for the token
+    changes.
+    """
+    current = registry.lookup(client.token) or get_client(client.token)
+    with _registries_lock:
+        key = (client.token, uuid)
+        keys = _registries.get(key)
+        if keys is None or keys._client is not current:
+            keys = _registries[key] = SSHKeyRegistry(current, uuid)
+        return keys
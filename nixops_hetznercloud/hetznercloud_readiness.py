@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+# Event-driven waiting for Hetzner Cloud servers to change status and to
+# accept SSH connections.
+
+import errno
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+from hcloud import APIException, Client
+from requests import RequestException
+
+from nixops_hetznercloud.hetznercloud_client import (
+    POLL_INTERVAL,
+    POLL_TIMEOUT,
+    backoff_intervals,
+    is_transient,
+)
+
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+
+# A connection attempt which neither succeeds nor fails within this time is
+# abandoned and retried.
+CONNECT_TIMEOUT = 5.0
+
+W = TypeVar("W", bound="Waiter")
+
+
+class Waiter(object):
+    """
+    A condition some thread is waiting for, resolved by the monitor thread.
+    """
+
+    def __init__(self, description: str, timeout: float) -> None:
+        self.description = description
+        self.deadline = time.monotonic() + timeout
+        self.intervals: Iterator[float] = backoff_intervals(POLL_INTERVAL)
+        self.next_attempt = time.monotonic()
+        self.event = threading.Event()
+        self.error: Optional[Exception] = None
+
+    @property
+    def done(self) -> bool:
+        return self.event.is_set()
+
+    def resolve(self, error: Optional[Exception] = None) -> None:
+        self.error = error
+        self.event.set()
+
+    def retry_later(self) -> None:
+        self.next_attempt = time.monotonic() + next(self.intervals)
+
+
+class PortProbe(Waiter):
+    """
+    Waits for a TCP port to accept connections.
+    """
+
+    def __init__(self, address: str, port: int, timeout: float) -> None:
+        super().__init__(f"port {port} on {address}", timeout)
+        self.address = address
+        self.port = port
+        self.sock: Optional[socket.socket] = None
+        self.connect_deadline = 0.0
+
+
+class StatusWatch(Waiter):
+    """
+    Waits for a server to reach a status.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        server_id: int,
+        status: str,
+        label_selector: Optional[str],
+        timeout: float,
+    ) -> None:
+        super().__init__(f"server {server_id} to be {status}", timeout)
+        self.client = client
+        self.server_id = server_id
+        self.status = status
+        self.label_selector = label_selector
+
+
+class ReadinessMonitor(object):
+    """
+    Resolves port probes and status watches for every machine from a single
+    background thread.
+
+    Ports are probed with non-blocking connects multiplexed over one
+    selector, and the statuses of all watched servers in a deployment are
+    fetched with a single labelled list request per tick, so waiting on a
+    whole fleet costs no more threads and hardly more requests than waiting
+    on one server. Both back off between attempts, and a status poll that
+    fails transiently is retried until its watches time out.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._waiters: List[Waiter] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def probe_port(
+        self, address: str, port: int = 22, timeout: float = POLL_TIMEOUT
+    ) -> PortProbe:
+        return self._add(PortProbe(address, port, timeout))
+
+    def watch_status(
+        self,
+        client: Client,
+        server_id: int,
+        status: str,
+        label_selector: Optional[str] = None,
+        timeout: float = POLL_TIMEOUT,
+    ) -> StatusWatch:
+        return self._add(
+            StatusWatch(client, server_id, status, label_selector, timeout)
+        )
+
+    def wait(
+        self,
+        waiters: Sequence[Waiter],
+        on_tick: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Block until all waiters are resolved, raising the first error.
+        """
+        for waiter in waiters:
+            while not waiter.event.wait(1):
+                if on_tick is not None:
+                    on_tick()
+        for waiter in waiters:
+            if waiter.error is not None:
+                raise waiter.error
+
+    def _add(self, waiter: W) -> W:
+        with self._lock:
+            self._waiters.append(waiter)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="hcloud-readiness", daemon=True
+                )
+                self._thread.start()
+        self._wakeup_w.send(b"\0")
+        return waiter
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self._tick()
+            except Exception:
+                # Failed polls and connections are dealt with by the waiters
+                # they concern, so this is a bug. Rather than failing every
+                # machine's waiter with it, they're left to their deadlines.
+                traceback.print_exc()
+                time.sleep(POLL_INTERVAL)
+
+    def _tick(self) -> None:
+        with self._lock:
+            self._waiters = [x for x in self._waiters if not x.done]
+            waiters = list(self._waiters)
+        now = time.monotonic()
+
+        for waiter in waiters:
+            if now > waiter.deadline:
+                self._close(waiter)
+                waiter.resolve(Exception(f"timed out waiting for {waiter.description}"))
+        probes = [x for x in waiters if isinstance(x, PortProbe) and not x.done]
+        watches = [x for x in waiters if isinstance(x, StatusWatch) and not x.done]
+
+        for probe in probes:
+            if probe.sock is None and probe.next_attempt <= now:
+                self._connect(probe)
+            elif probe.sock is not None and probe.connect_deadline <= now:
+                self._close(probe)
+                probe.retry_later()
+        self._poll_statuses([x for x in watches if x.next_attempt <= now])
+
+        pending = [x for x in probes + watches if not x.done]
+        wakeups = [x.deadline for x in pending]
+        wakeups += [x.next_attempt for x in pending if getattr(x, "sock", None) is None]
+        wakeups += [x.connect_deadline for x in probes if x.sock is not None]
+        timeout = max(min(wakeups, default=now + 60) - time.monotonic(), 0)
+
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is self._wakeup_r:
+                try:
+                    while self._wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                self._connected(key.data)
+
+    def _connect(self, probe: PortProbe) -> None:
+        family = socket.AF_INET6 if ":" in probe.address else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        result = sock.connect_ex((probe.address, probe.port))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            probe.retry_later()
+            return
+        probe.sock = sock
+        probe.connect_deadline = time.monotonic() + CONNECT_TIMEOUT
+        self._selector.register(sock, selectors.EVENT_WRITE, probe)
+
+    def _connected(self, probe: PortProbe) -> None:
+        assert probe.sock is not None
+        error = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self._close(probe)
+        if error == 0:
+            probe.resolve()
+        else:
+            probe.retry_later()
+
+    def _close(self, waiter: Waiter) -> None:
+        if isinstance(waiter, PortProbe) and waiter.sock is not None:
+            self._selector.unregister(waiter.sock)
+            waiter.sock.close()
+            waiter.sock = None
+
+    def _poll_statuses(self, watches: List[StatusWatch]) -> None:
+        groups: Dict[Tuple[int, Optional[str]], List[StatusWatch]] = {}
+        for watch in watches:
+            groups.setdefault((id(watch.client), watch.label_selector), []).append(
+                watch
+            )
+        for group in groups.values():
+            client = group[0].client
+            try:
+                statuses: Dict[int, str] = {}
+                if group[0].label_selector is not None:
+                    statuses = {
+                        x.id: x.status
+                        for x in client.servers.get_all(
+                            label_selector=group[0].label_selector
+                        )
+                    }
+                # Servers missing from the labelled list are fetched on their own.
+                for watch in group:
+                    if watch.server_id not in statuses:
+                        server = client.servers.get_by_id(watch.server_id)
+                        statuses[watch.server_id] = server.status
+            except (APIException, RequestException) as e:
+                for watch in group:
+                    if is_transient(e):
+                        watch.retry_later()
+                    else:
+                        watch.resolve(e)
+                continue
+            for watch in group:
+                if statuses[watch.server_id] == watch.status:
+                    watch.resolve()
+                else:
+                    watch.retry_later()
+
+
+monitor = ReadinessMonitor()
+
+
+def get_readiness_monitor() -> ReadinessMonitor:
+    """
+    Get the process-wide readiness monitor.
+    """
+    return monitor
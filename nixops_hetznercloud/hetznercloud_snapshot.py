@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Deployment-wide snapshot of Hetzner Cloud resources.
+
+import functools
+import threading
+
+from contextlib import contextmanager
+
+from hcloud import Client, APIException
+
+from nixops_hetznercloud.hetznercloud_client import get_client, registry
+
+from typing import Any, Callable, Dict, Iterator, Optional, Set, Tuple, TypeVar
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class DeploymentSnapshot(object):
+    """
+    In-memory view of every Hetzner Cloud resource labelled with a deployment's
+    ‘CharonNetworkUUID’, taken afresh for every deployment pass.
+
+    During a pass, each resource type is fetched with one paginated list call
+    the first time it's looked up, after which lookups by id or name are
+    served from memory. Lookups that miss (e.g. resources not managed by
+    NixOps, or created after the snapshot was taken) fall back to a single API
+    call whose result is cached. Callers which mutate a resource should
+    ``forget`` it so the next lookup fetches it afresh. Outside a pass,
+    nothing is cached and every lookup is its own API call.
+    """
+
+    KINDS = (
+        "servers",
+        "volumes",
+        "floating_ips",
+        "networks",
+        "ssh_keys",
+        "certificates",
+        "images",
+        "load_balancers",
+        "placement_groups",
+    )
+
+    def __init__(self, client: Client, uuid: str, cached: bool = True) -> None:
+        self._client = client
+        # Guards the maps below. Resources are fetched without holding it, and
+        # each kind is listed under its own lock so that threads looking up
+        # the same kind wait for one listing rather than making their own.
+        self._lock = threading.Lock()
+        self._loading = {k: threading.Lock() for k in self.KINDS}
+        self.uuid = uuid
+        self.cached = cached
+        self._loaded: Set[str] = set()
+        self._by_id: Dict[str, Dict[int, Any]] = {k: {} for k in self.KINDS}
+        self._by_name: Dict[str, Dict[str, Any]] = {k: {} for k in self.KINDS}
+
+    def _subclient(self, kind: str) -> Any:
+        return getattr(self._client, kind)
+
+    def _remember(self, kind: str, res: Any) -> Any:
+        with self._lock:
+            self._by_id[kind][res.id] = res
+            if res.name:
+                self._by_name[kind][res.name] = res
+        return res
+
+    def _ensure_loaded(self, kind: str) -> bool:
+        """
+        List the resources of a kind if they haven't been yet, returning
+        whether lookups of it are served from memory.
+        """
+        if not self.cached:
+            return False
+        with self._loading[kind]:
+            if kind in self._loaded:
+                return True
+            resources = self._subclient(kind).get_all(
+                label_selector=f"CharonNetworkUUID={self.uuid}"
+            )
+            with self._lock:
+                self._by_id[kind] = {x.id: x for x in resources}
+                self._by_name[kind] = {x.name: x for x in resources if x.name}
+            self._loaded.add(kind)
+        return True
+
+    def load(self) -> None:
+        """Fetch every resource type up front."""
+        for kind in self.KINDS:
+            self._ensure_loaded(kind)
+
+    def get_by_id(self, kind: str, id: Optional[int]) -> Any:
+        if id is None:
+            return None
+        cached = self._ensure_loaded(kind)
+        if cached:
+            with self._lock:
+                res = self._by_id[kind].get(int(id))
+            if res is not None:
+                return res
+        try:
+            res = self._subclient(kind).get_by_id(id)
+        except APIException as e:
+            if e.code == "not_found":
+                return None
+            else:
+                raise
+        return self._remember(kind, res) if cached else res
+
+    def get_by_name(self, kind: str, name: str) -> Any:
+        cached = self._ensure_loaded(kind)
+        if cached:
+            with self._lock:
+                res = self._by_name[kind].get(name)
+            if res is not None:
+                return res
+        res = self._subclient(kind).get_by_name(name)
+        return self._remember(kind, res) if cached and res is not None else res
+
+    def forget(self, kind: str, id: Optional[int]) -> None:
+        if id is None:
+            return
+        with self._lock:
+            res = self._by_id[kind].pop(int(id), None)
+            if res is not None and res.name:
+                self._by_name[kind].pop(res.name, None)
+
+
+_snapshots_lock = threading.Lock()
+_snapshots: Dict[Tuple[str, str], DeploymentSnapshot] = {}
+_passes: Dict[str, int] = {}
+
+
+@contextmanager
+def deployment_pass(uuid: str) -> Iterator[None]:
+    """
+    Serve a deployment's lookups from its snapshot within the block. The
+    operations running at the same time, such as the resources of a deploy
+    being created, share a pass, and the snapshot is dropped once the last
+    of them has finished, so the next pass takes a fresh one.
+    """
+    with _snapshots_lock:
+        _passes[uuid] = _passes.get(uuid, 0) + 1
+    try:
+        yield
+    finally:
+        with _snapshots_lock:
+            _passes[uuid] -= 1
+            if not _passes[uuid]:
+                del _passes[uuid]
+                for key in [x for x in _snapshots if x[1] == uuid]:
+                    _snapshots.pop(key).cached = False
+
+
+def within_pass(fun: F) -> F:
+    """
+    Decorate a machine or resource state method, such as ``create``, to run
+    it within a pass of its deployment.
+    """
+
+    @functools.wraps(fun)
+    def wrapper(self, *args, **kwargs):
+        with deployment_pass(self.depl.uuid):
+            return fun(self, *args, **kwargs)
+
+    return wrapper  # type: ignore
+
+
+def get_snapshot(client: Client, uuid: str) -> DeploymentSnapshot:
+    """
+    Get the snapshot of a deployment's resources for a client's token, on the
+    registry's client for it. Within a pass the snapshot is shared, and taken
+    afresh whenever that client changes, such as after the registry is
+    cleared or the endpoint changed. Outside a pass it caches nothing.
+    """
+    current = registry.lookup(client.token) or get_client(client.token)
+    with _snapshots_lock:
+        if uuid not in _passes:
+            return DeploymentSnapshot(current, uuid, cached=False)
+        key = (client.token, uuid)
+        snapshot = _snapshots.get(key)
+        if snapshot is None or snapshot._client is not current:
+            snapshot = _snapshots[key] = DeploymentSnapshot(current, uuid)
+        return snapshot
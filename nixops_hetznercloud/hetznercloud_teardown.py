@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Bulk teardown of everything labelled with a deployment's UUID.
+
+import os
+import threading
+import time
+
+from nixops_hetznercloud import hetznercloud_async
+from nixops_hetznercloud.hetznercloud_async import AsyncClient, gather
+from nixops_hetznercloud.hetznercloud_trace import tracer
+
+from typing import Dict, List, Optional, Tuple
+
+# Deleting a server implicitly detaches its volumes, floating IPs and
+# networks, and deleting a load balancer its networks and certificates, so
+# servers and load balancers go first and everything else follows at once.
+TEARDOWN_PHASES: List[List[str]] = [
+    ["servers", "load_balancers"],
+    [
+        "volumes",
+        "floating_ips",
+        "networks",
+        "ssh_keys",
+        "certificates",
+        "images",
+        "placement_groups",
+    ],
+]
+
+
+def bulk_destroy_enabled() -> bool:
+    """
+    Whether ‘nixops destroy’ should tear down the whole deployment at once,
+    set with $HCLOUD_BULK_DESTROY.
+    """
+    return os.environ.get("HCLOUD_BULK_DESTROY", "") not in ("", "0")
+
+
+async def teardown(client: AsyncClient, uuid: str) -> Dict[str, int]:
+    """
+    Delete every resource labelled with a deployment's UUID, returning how
+    many of each kind were deleted.
+    """
+    selector = f"CharonNetworkUUID={uuid}"
+    kinds = [kind for phase in TEARDOWN_PHASES for kind in phase]
+    with tracer.span("list deployment resources", "api"):
+        listed = await gather([client.get_all(kind, selector) for kind in kinds])
+    resources = dict(zip(kinds, listed))
+
+    deleted: Dict[str, int] = {}
+    for phase in TEARDOWN_PHASES:
+        await gather(
+            [client.delete(kind, x["id"]) for kind in phase for x in resources[kind]]
+        )
+        deleted.update({kind: len(resources[kind]) for kind in phase})
+    return deleted
+
+
+class Teardown(object):
+    """
+    A deployment's teardown, run by whichever resource is destroyed first.
+
+    Every other resource of the deployment destroyed meanwhile waits for it
+    to finish instead of deleting its own object. Once it has succeeded,
+    destroying the deployment's other resources is a no-op until the
+    deployment is deployed again.
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.deleted: Dict[str, int] = {}
+        self.error: Optional[Exception] = None
+
+
+_teardowns_lock = threading.Lock()
+_teardowns: Dict[Tuple[str, str], Teardown] = {}
+
+
+def destroy_deployment(client: AsyncClient, uuid: str, logger) -> Dict[str, int]:
+    """
+    Tear down a deployment's resources, sharing a teardown already running
+    for it.
+    """
+    key = (client.endpoint, uuid)
+    with _teardowns_lock:
+        current = _teardowns.get(key)
+        first = current is None
+        if current is None:
+            current = _teardowns[key] = Teardown()
+
+    if first:
+        logger.log(f"deleting everything labelled CharonNetworkUUID={uuid}...")
+        start = time.monotonic()
+        try:
+            current.deleted = hetznercloud_async.run(teardown(client, uuid))
+        except Exception as e:
+            current.error = e
+            with _teardowns_lock:
+                _teardowns.pop(key, None)
+        finally:
+            current.done.set()
+        if current.error is None:
+            summary = ", ".join(
+                f"{kind.replace('_', ' ')}: {n}"
+                for kind, n in current.deleted.items()
+                if n
+            )
+            logger.log(
+                f"deleted {summary or 'nothing'}" f" in {time.monotonic() - start:.1f}s"
+            )
+    else:
+        current.done.wait()
+
+    if current.error is not None:
+        raise current.error
+    return current.deleted
+
+
+def forget_teardown(uuid: str) -> None:
+    """
+    Forget that a deployment was torn down, as it's being deployed again.
+    """
+    with _teardowns_lock:
+        for key, current in list(_teardowns.items()):
+            if key[1] == uuid and current.done.is_set():
+                del _teardowns[key]
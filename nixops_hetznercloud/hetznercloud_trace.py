@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Timing instrumentation for Hetzner Cloud deployments.
+
+import atexit
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+from nixops import util
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Tracer(object):
+    """
+    Records timed spans for API requests, action waits, SSH commands and the
+    phases of each machine and resource.
+
+    Tracing is enabled by setting ``HCLOUD_TRACE`` to a file path. When the
+    process exits the spans are written there in the Chrome trace event
+    format (load it in chrome://tracing or https://ui.perfetto.dev), and a
+    per-phase summary is printed to stderr.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._lock = threading.Lock()
+        self._subject: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+            "subject", default=None
+        )
+        self._start = time.monotonic()
+        self.path = path
+        self.spans: List[Dict[str, Any]] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    @property
+    def subject(self) -> Optional[str]:
+        return self._subject.get()
+
+    @contextmanager
+    def span(self, name: str, category: str, **tags: Any) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        subject = self.subject
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            span = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self._start) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": subject or threading.current_thread().name,
+                "args": tags,
+            }
+            with self._lock:
+                self.spans.append(span)
+
+    @contextmanager
+    def subject_of(self, subject: str) -> Iterator[None]:
+        """
+        Attribute all spans recorded in this context to a machine or resource.
+        Coroutines handed to the shared event loop inherit the context, as do
+        threads started with ``copy_context().run``.
+        """
+        token = self._subject.set(subject)
+        try:
+            yield
+        finally:
+            self._subject.reset(token)
+
+    def summary(self) -> str:
+        phases: Dict[str, List[float]] = {}
+        with self._lock:
+            for span in self.spans:
+                # Break machine and resource phases down by name.
+                phase = span["name"] if span["cat"] == "phase" else span["cat"]
+                phases.setdefault(phase, []).append(span["dur"] / 1e6)
+        lines = [f"{'phase':<12} {'count':>7} {'total':>10} {'mean':>9} {'max':>9}"]
+        for phase, durations in sorted(
+            phases.items(), key=lambda x: sum(x[1]), reverse=True
+        ):
+            lines.append(
+                f"{phase:<12} {len(durations):>7} {sum(durations):>9.2f}s"
+                f" {sum(durations) / len(durations):>8.3f}s {max(durations):>8.3f}s"
+            )
+        return "\n".join(lines)
+
+    def write(self) -> None:
+        if self.path is None:
+            return
+        with self._lock:
+            spans = list(self.spans)
+        # The trace viewers expect numeric thread ids, so give every machine
+        # or resource its own lane and name it with a metadata event.
+        lanes: Dict[str, int] = {}
+        events: List[Dict[str, Any]] = []
+        for span in spans:
+            if span["tid"] not in lanes:
+                lanes[span["tid"]] = len(lanes) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": span["pid"],
+                        "tid": lanes[span["tid"]],
+                        "args": {"name": span["tid"]},
+                    }
+                )
+            events.append({**span, "tid": lanes[span["tid"]]})
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+tracer = Tracer(os.environ.get("HCLOUD_TRACE") or None)
+
+
+@atexit.register
+def _write_trace() -> None:
+    if tracer.enabled and tracer.spans:
+        tracer.write()
+        sys.stderr.write(f"hetznercloud: trace written to {tracer.path}\n")
+        sys.stderr.write(tracer.summary() + "\n")
+
+
+def traced(phase: str) -> Callable[[F], F]:
+    """
+    Decorate a machine or resource state method to record it as a phase
+    of that machine or resource.
+    """
+
+    def decorator(fun: F) -> F:
+        @functools.wraps(fun)
+        def wrapper(self, *args, **kwargs):
+            with tracer.subject_of(self.name), tracer.span(phase, "phase"):
+                return fun(self, *args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def check_wait(test: Callable[[], bool], *args, **kwargs) -> bool:
+    """Like nixops.util.check_wait, recorded as a wait span."""
+    with tracer.span(getattr(test, "__name__", "check_wait"), "check_wait"):
+        return util.check_wait(test, *args, **kwargs)
@@ -10,8 +10,10 @@
   resources = { evalResources, zipAttrs, resourcesByType, ... }: {
     hetznerCloudCertificates = evalResources ./certificate.nix (zipAttrs resourcesByType.hetznerCloudCertificates or []);
     hetznerCloudFloatingIPs = evalResources ./floating-ip.nix (zipAttrs resourcesByType.hetznerCloudFloatingIPs or []);
+    hetznerCloudImages = evalResources ./image.nix (zipAttrs resourcesByType.hetznerCloudImages or []);
     hetznerCloudLoadBalancers = evalResources ./load-balancer.nix (zipAttrs resourcesByType.hetznerCloudLoadBalancers or []);
     hetznerCloudNetworks = evalResources ./network.nix (zipAttrs resourcesByType.hetznerCloudNetworks or []);
+    hetznerCloudPlacementGroups = evalResources ./placement-group.nix (zipAttrs resourcesByType.hetznerCloudPlacementGroups or []);
     hetznerCloudVolumes = evalResources ./volume.nix (zipAttrs resourcesByType.hetznerCloudVolumes or []);
   };
 }
@@ -27,10 +27,13 @@ let
           '';
         };
         privateIpAddress = mkOption {
+          default = null;
           example = "10.1.0.2";
-          type = types.str;
+          type = with types; nullOr str;
           description = ''
             The Hetzner Cloud instance's private IP address for this network.
+            If null, Hetzner Cloud assigns one, and a new instance is attached
+            to the network when it's created rather than afterwards.
           '';
         };
         aliasIpAddresses = mkOption {
@@ -133,6 +136,19 @@ in
       '';
     };
 
+    deployment.hetznerCloud.image = mkOption {
+      default = null;
+      example = literalExample "resources.hetznerCloudImages.nixos";
+      type = with types; nullOr (resource "hetznercloud-image");
+      apply = x: if x == null then null else "nixops-${uuid}-${x._name}";
+      description = ''
+        A NixOS snapshot image resource to boot the server from. This skips
+        running nixos-infect on a freshly created Ubuntu server, so that
+        provisioning only takes as long as the server takes to boot. The image
+        must have been built for the same architecture as ``serverType``.
+      '';
+    };
+
     deployment.hetznerCloud.volumes = mkOption {
       default = [ ];
       example = literalExample ''
@@ -170,6 +186,42 @@ in
       '';
     };
 
+    deployment.hetznerCloud.placementGroup = mkOption {
+      default = [];
+      example = literalExample ''
+        [ resources.hetznerCloudPlacementGroups.replicas1
+          resources.hetznerCloudPlacementGroups.replicas2
+        ]
+      '';
+      type = with types;
+        let group = either str (resource "hetznercloud-placement-group");
+        in nullOr (either group (listOf group));
+      apply = x:
+        let name = x: if builtins.isString x then x else "nixops-${uuid}-${x._name}";
+        in if x == null then [] else map name (toList x);
+      description = ''
+        A Hetzner Cloud Placement Group resource, or the name of one not
+        managed by NixOps, to create the server in. Given several groups,
+        the server goes to whichever of them holds the fewest servers, so
+        machines listing the same groups are spread evenly across them.
+        Moving an existing server to another group requires
+        <option>--allow-reboot</option>.
+      '';
+    };
+
+    deployment.hetznerCloud.sharedSSHKey = mkOption {
+      default = false;
+      example = true;
+      type = types.bool;
+      description = ''
+        Whether to give the server the SSH key pair shared by every machine
+        of the deployment with this option set, rather than a key pair of its
+        own. Hetzner Cloud then holds one SSH key for all of these machines,
+        so creating many of them doesn't create and delete a key for each.
+        Only takes effect when the server is created.
+      '';
+    };
+
     deployment.hetznerCloud.labels = commonHetznerCloudOptions.labels;
 
     fileSystems = mkOption {
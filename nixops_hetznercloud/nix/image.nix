@@ -0,0 +1,35 @@
+# Configuration specific to Hetzner Cloud Image Resource.
+{ config, lib, name, uuid, ... }:
+
+with import ./lib.nix { inherit lib; };
+with lib;
+
+{
+
+  options = {
+
+    location = mkOption {
+      example = "nbg1";
+      type = types.enum ["nbg1" "fsn1" "hel1" "ash" "hil"];
+      description = ''
+        The ID of the location to build the snapshot image in.
+        Choices are ``nbg1``, ``fsn1``, ``hel1``, ``ash`` or ``hil``.
+      '';
+    };
+
+    serverType = mkOption {
+      default = "cx11";
+      example = "cax11";
+      type = types.str;
+      description = ''
+        The Hetzner Cloud Server type used to build the snapshot image. This
+        determines the architecture of the servers which can boot from it, so
+        use e.g. ``cax11`` to build an image for Arm64 servers.
+      '';
+    };
+
+  } // import ./common-hetznercloud-options.nix { inherit lib; };
+
+  config._type = "hetznercloud-image";
+
+}
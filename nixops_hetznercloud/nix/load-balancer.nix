@@ -158,9 +158,14 @@ let
           });
         };
         certificates = mkOption {
-          type = types.listOf (resource "hetznercloud-certificate");
+          default = [];
+          example = literalExample "[ resources.hetznerCloudCertificates.cert1 ]";
+          type = with types; listOf (either str (resource "hetznercloud-certificate"));
+          apply = map (x: if builtins.isString x then x else "nixops-${uuid}-${x._name}");
           description = ''
-            TODO Valid only for https services.
+            Certificate resources, or names of certificates not managed by
+            NixOps, which are served by this service. Valid only for HTTPS
+            services.
           '';
         };
         redirectHttp = mkOption {
@@ -192,8 +197,8 @@ in {
       example = "lb11";
       type = types.str;
       description = ''
-        Hetner Cloud load balancer type.
-        See TODO for a list of valid load balancer types.
+        Hetzner Cloud load balancer type.
+        Options are ``lb11``, ``lb21`` or ``lb31``.
       '';
     };
 
@@ -201,6 +206,7 @@ in {
       default = null;
       example = "resources.hetznerCloudNetwork.myPrivateNet";
       type = types.nullOr (resource "hetznercloud-network");
+      apply = x: if x == null then null else "nixops-${uuid}-${x._name}";
       description = ''
         The Network Resource to attach this Load Balancer to.
         Targets must be a part of the same network as the Load Balancer.
@@ -209,10 +215,56 @@ in {
 
     targets = mkOption {
       default = [];
-      example = [ "machines.httpserver1" "machines.httpserver2" ];
-      type = types.listOf machine;
+      example = literalExample "[ resources.machines.httpserver1 \"external-server\" ]";
+      type = with types; listOf (either str machine);
+      apply = map (x: if builtins.isString x then x else x.hetznerCloud.serverName);
+      description = ''
+        The machines, or names of servers not managed by NixOps, to use as
+        targets for this Load Balancer. Changes are applied incrementally by
+        adding and removing individual targets.
+      '';
+    };
+
+    labelSelectors = mkOption {
+      default = [];
+      example = [ "role=web" ];
+      type = with types; listOf str;
       description = ''
-        The list of machine resources to use as targets for this Load Balancer.
+        Label selectors whose matching servers are targets of this Load
+        Balancer. Servers created later which match a selector join the
+        pool without any further API calls.
+      '';
+    };
+
+    targetsByLabel = mkOption {
+      default = false;
+      type = types.bool;
+      description = ''
+        Target the machines of this deployment in <option>targets</option>
+        through a single label selector on the ``CharonNetworkUUID`` and
+        ``CharonInstanceName`` labels NixOps puts on their servers, rather
+        than one target per server. Adding or removing machines then takes
+        at most two actions whatever the size of the pool, and recreated
+        machines stay targets without any.
+      '';
+    };
+
+    targetAllMachines = mkOption {
+      default = false;
+      type = types.bool;
+      description = ''
+        Target every machine of this deployment, including ones added later,
+        through a label selector on the ``CharonNetworkUUID`` label. New
+        machines join the pool without any API calls.
+      '';
+    };
+
+    usePrivateIp = mkOption {
+      default = false;
+      type = types.bool;
+      description = ''
+        Send traffic to the targets' private IP addresses in
+        <option>network</option> rather than their public ones.
       '';
     };
 
@@ -232,14 +284,6 @@ in {
       description = "Algorithm used to direct incoming requests.";
     };
 
-    loadBalancerId = mkOption {
-      default = "";
-      type = types.str;
-      description = ''
-        The Load Balancer ID generated from Hetzner Cloud. This is set by NixOps
-      '';
-    };
-
   } // import ./common-hetznercloud-options.nix { inherit lib; };
 
   config._type = "hetznercloud-load-balancer";
@@ -0,0 +1,25 @@
+# Configuration specific to Hetzner Cloud Placement Group Resource.
+{ config, lib, name, uuid, ... }:
+
+with import ./lib.nix { inherit lib; };
+with lib;
+
+{
+
+  options = {
+
+    groupType = mkOption {
+      default = "spread";
+      type = types.enum [ "spread" ];
+      description = ''
+        The placement strategy of the group. Servers in a ``spread`` group
+        are kept on different physical hosts, so that one host failure takes
+        down at most one of them. A spread group holds up to 10 servers.
+      '';
+    };
+
+  } // import ./common-hetznercloud-options.nix { inherit lib; };
+
+  config._type = "hetznercloud-placement-group";
+
+}
@@ -1,8 +1,17 @@
+from argparse import ArgumentParser, Namespace, _SubParsersAction
 from os.path import dirname, abspath
 from nixops.plugins import Plugin, hookimpl
 from typing import List
 
 
+def op_failover(args: Namespace) -> None:
+    from nixops.script_defs import deployment
+    from nixops_hetznercloud.backends.failover import failover
+
+    with deployment(args, True, "nixops hetzner-failover") as depl:
+        failover(depl, args.machine, args.floating_ips)
+
+
 class NixopsHetznerCloudPlugin(Plugin):
     @staticmethod
     def nixexprs() -> List[str]:
@@ -15,6 +24,24 @@ class NixopsHetznerCloudPlugin(Plugin):
             "nixops_hetznercloud.backends.hetznercloud",
         ]
 
+    @staticmethod
+    def parser(parser: ArgumentParser, subparsers: _SubParsersAction) -> None:
+        from nixops.script_defs import add_subparser
+
+        subparser = add_subparser(
+            subparsers,
+            "hetzner-failover",
+            help="assign Hetzner Cloud floating IPs to a standby machine",
+        )
+        subparser.set_defaults(op=op_failover)
+        subparser.add_argument("machine", metavar="MACHINE", help="standby machine")
+        subparser.add_argument(
+            "floating_ips",
+            nargs="+",
+            metavar="FLOATING-IP",
+            help="floating IP resources to assign to it",
+        )
+
 
 @hookimpl
 def plugin() -> Plugin:
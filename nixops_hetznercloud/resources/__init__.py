@@ -1,15 +1,19 @@
 __all__ = (
     "certificate",
     "floating_ip",
+    "image",
     "load_balancer",
     "network",
+    "placement_group",
     "volume",
     "ssh_key",
 )
 
 from . import certificate
 from . import floating_ip
+from . import image
 from . import load_balancer
 from . import network
+from . import placement_group
 from . import volume
 from . import ssh_key
@@ -3,7 +3,7 @@
 # Automatic provisioning of Hetzner Cloud Floating IPs.
 
 from hcloud.floating_ips.domain import CreateFloatingIPResponse, FloatingIP
-from hcloud.locations.client import BoundLocation
+from hcloud.locations.domain import Location
 
 from nixops.diff import Handler
 from nixops.util import attr_property
@@ -113,16 +113,17 @@ class FloatingIPState(HetznerCloudResourceState):
             self._destroy()
             self._client = None
 
-        location: BoundLocation = self.get_client().locations.get_by_name(defn.location)
+        location = self.get_catalogue().location(defn.location)
 
-        self.logger.log(f"creating floating IP at {location.description}...")
+        self.logger.log(f"creating floating IP at {location['description']}...")
         response: CreateFloatingIPResponse = self.get_client().floating_ips.create(
             name=self.get_default_name(),
             type=defn.ipType,
-            home_location=location,
+            home_location=Location(name=defn.location),
         )
 
-        response.action and response.action.wait_until_finished()
+        if response.action:
+            self.wait_on_action(response.action)
 
         self.resource_id = response.floating_ip.id
         self.address = response.floating_ip.ip
@@ -143,6 +144,7 @@ class FloatingIPState(HetznerCloudResourceState):
             floating_ip=FloatingIP(self.resource_id),
             description=defn.description,
         )
+        self.forget_instance()
 
         with self.depl._db:
             self._state["description"] = defn.description
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# Automatic provisioning of Hetzner Cloud NixOS snapshot images.
+
+import os
+import tempfile
+
+from hcloud.images.domain import Image
+from hcloud.locations.domain import Location
+from hcloud.server_types.domain import ServerType
+from hcloud.servers.client import BoundServer
+from hcloud.ssh_keys.client import BoundSSHKey
+
+from nixops.diff import Handler
+from nixops.util import attr_property, create_key_pair, logged_exec
+from nixops.resources import ResourceDefinition
+from nixops_hetznercloud.hetznercloud_common import (
+    INFECT_PATH,
+    HetznerCloudResourceState,
+)
+from nixops_hetznercloud.hetznercloud_readiness import get_readiness_monitor
+from nixops_hetznercloud.hetznercloud_trace import tracer
+
+from typing import Any, Dict, Optional, Sequence
+
+from .types.image import ImageOptions
+
+
+def get_architecture(server_type: str) -> str:
+    """Hetzner Cloud's Arm64 server types are the ‘cax’ family."""
+    return "arm" if server_type.startswith("cax") else "x86"
+
+
+class ImageDefinition(ResourceDefinition):
+    """
+    Definition of a Hetzner Cloud NixOS snapshot image.
+    """
+
+    config: ImageOptions
+
+    @classmethod
+    def get_type(cls):
+        return "hetznercloud-image"
+
+    @classmethod
+    def get_resource_type(cls):
+        return "hetznerCloudImages"
+
+
+class ImageState(HetznerCloudResourceState):
+    """
+    State of a Hetzner Cloud NixOS snapshot image.
+
+    The image is built once by lustrating a temporary Ubuntu server with
+    nixos-infect and snapshotting its disk, so that servers booted from it
+    skip nixos-infect entirely.
+    """
+
+    definition_type = ImageDefinition
+
+    _resource_type = "images"
+    _reserved_keys = HetznerCloudResourceState.COMMON_HCLOUD_RESERVED + [
+        "architecture",
+    ]
+
+    architecture = attr_property("architecture", None)
+
+    @classmethod
+    def get_type(cls):
+        return "hetznercloud-image"
+
+    def __init__(self, depl, name, id):
+        super(HetznerCloudResourceState, self).__init__(depl, name, id)
+        self.handle_create_image = Handler(
+            ["location", "serverType"],
+            handle=self.realise_create_image,
+        )
+        self.handle_modify_labels = Handler(
+            ["labels"],
+            after=[self.handle_create_image],
+            handle=super().realise_modify_labels,
+        )
+
+    def show_type(self):
+        s = f"{super(ImageState, self).show_type()}"
+        if self.state == self.UP:
+            s += f" [{self._state.get('location', None)}; {self.architecture}]"
+        return s
+
+    @property
+    def full_name(self) -> str:
+        return f"Hetzner Cloud Image {self.resource_id}"
+
+    def prefix_definition(self, attr: Any) -> Dict[Sequence[str], Any]:
+        return {("resources", "hetznerCloudImages"): attr}
+
+    def get_definition_prefix(self) -> str:
+        return "resources.hetznerCloudImages."
+
+    def cleanup_state(self) -> None:
+        with self.depl._db:
+            self.state = self.MISSING
+            self.resource_id = None
+            self.architecture = None
+            self._state["location"] = None
+            self._state["serverType"] = None
+            self._state["labels"] = None
+
+    def _run_infect(self, address: str, private_key: str) -> None:
+        fd, key_file = tempfile.mkstemp(prefix="nixops-hetznercloud-image-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(private_key)
+            with open(INFECT_PATH) as infect:
+                logged_exec(
+                    [
+                        "ssh",
+                        "-i",
+                        key_file,
+                        "-o",
+                        "StrictHostKeyChecking=no",
+                        "-o",
+                        "UserKnownHostsFile=/dev/null",
+                        f"root@{address}",
+                        "NIXOS_INFECT_SNAPSHOT=1 bash </dev/stdin 2>&1 && sync",
+                    ],
+                    self.logger,
+                    stdin=infect,
+                )
+        finally:
+            os.remove(key_file)
+
+    def _build_image(self, defn: ImageOptions, location: Dict[str, Any]) -> None:
+        name = self.get_default_name()
+        labels = self.get_common_labels()
+        (private, public) = create_key_pair(type="ed25519")
+
+        ssh_key: BoundSSHKey = self.get_client().ssh_keys.create(
+            name=name, public_key=public, labels=labels
+        )
+        server: Optional[BoundServer] = None
+        try:
+            self.logger.log_start(
+                f"creating {defn.serverType} builder at {location['description']}..."
+            )
+            response = self.get_client().servers.create(
+                name=name,
+                labels=labels,
+                location=Location(name=defn.location),
+                server_type=ServerType(defn.serverType),
+                ssh_keys=[ssh_key],
+                image=Image(name="ubuntu-20.04"),  # for lustration
+                start_after_create=True,
+            )
+            server = response.server
+            self.wait_on_action(response.action)
+
+            address = server.public_net.ipv4.ip
+            self.logger.log_start(f"waiting for SSH on {address}...")
+            monitor = get_readiness_monitor()
+            monitor.wait(
+                [monitor.probe_port(address, 22)],
+                on_tick=lambda: self.logger.log_continue("."),
+            )
+            self.logger.log_end("")
+
+            self.logger.log("running nixos-infect")
+            with tracer.span("nixos-infect", "provision"):
+                self._run_infect(address, private)
+
+            self.logger.log_start("shutting down builder...")
+            self.wait_on_action(server.power_off())
+
+            self.logger.log_start("creating snapshot image...")
+            response = server.create_image(
+                description=f"NixOS for {get_architecture(defn.serverType)}"
+                f" [{self.get_default_name_label()}]",
+                type="snapshot",
+                labels=labels,
+            )
+            self.wait_on_action(response.action)
+            self.resource_id = response.image.id
+        finally:
+            if server is not None:
+                server.delete()
+            ssh_key.delete()
+
+    def realise_create_image(self, allow_recreate: bool) -> None:
+        defn: ImageOptions = self.get_defn().config
+
+        # Checked before an outdated image is destroyed. While the catalogue
+        # is cached, this makes no API calls.
+        catalogue = self.get_catalogue()
+        catalogue.validate(defn.serverType, defn.location)
+
+        if self.state == self.UP:
+            if not allow_recreate:
+                raise Exception(
+                    f"{self.full_name} definition changed and it needs to be "
+                    "recreated use --allow-recreate if you want to create a new one"
+                )
+            self.warn("image definition changed, rebuilding...")
+            self._destroy()
+            self._client = None
+
+        self._build_image(defn, catalogue.location(defn.location))
+
+        with self.depl._db:
+            self.state = self.STARTING
+            self._state["location"] = defn.location
+            self._state["serverType"] = defn.serverType
+            self.architecture = get_architecture(defn.serverType)
+
+        self.wait_for_resource_available(self.resource_id)
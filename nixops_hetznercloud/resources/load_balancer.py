@@ -2,13 +2,115 @@
 
 # Automatic provisioning of Hetzner Cloud Load Balancers.
 
-# import hcloud
-
-# from nixops.diff import Handler
-from nixops.resources import ResourceDefinition
+from nixops.diff import Handler
+from nixops.resources import ResourceDefinition, ResourceState
+from nixops.util import attr_property
+from nixops_hetznercloud import hetznercloud_async
 from nixops_hetznercloud.hetznercloud_common import HetznerCloudResourceState
 
-from .types.load_balancer import LoadBalancerOptions
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from .certificate import CertificateState
+from .network import NetworkState
+from .types.load_balancer import (
+    HealthCheckOptions,
+    LoadBalancerOptions,
+    ServiceOptions,
+)
+
+# A target as the API identifies it: its type, the server ID or label
+# selector it refers to, and whether traffic goes to private IPs.
+Target = Tuple[str, Any, bool]
+
+
+def health_check_body(check: HealthCheckOptions) -> Dict[str, Any]:
+    body: Dict[str, Any] = {
+        "protocol": check.protocol,
+        "port": check.port,
+        "interval": check.interval,
+        "timeout": check.timeout,
+        "retries": check.retries,
+    }
+    if check.http is not None:
+        body["http"] = {
+            "domain": check.http.domain,
+            "path": check.http.path,
+            "response": check.http.response,
+            "status_codes": list(check.http.statusCodes),
+            "tls": check.http.tls,
+        }
+    return body
+
+
+def service_body(service: ServiceOptions, certificates: List[int]) -> Dict[str, Any]:
+    """
+    The API representation of a service, as taken by ``add_service`` and
+    ``update_service``.
+    """
+    body: Dict[str, Any] = {
+        "protocol": service.protocol,
+        "listen_port": service.listenPort,
+        "destination_port": service.destinationPort,
+        "proxyprotocol": service.proxyProtocol,
+    }
+    if service.healthCheck is not None:
+        body["health_check"] = health_check_body(service.healthCheck)
+    else:
+        # The API's own default, spelled out so that it can be compared.
+        body["health_check"] = {
+            "protocol": "tcp",
+            "port": service.destinationPort,
+            "interval": 15,
+            "timeout": 10,
+            "retries": 3,
+        }
+    if service.protocol != "tcp":
+        http: Dict[str, Any] = {
+            "sticky_sessions": service.stickySessions is not None,
+        }
+        if service.stickySessions is not None:
+            http["cookie_name"] = service.stickySessions.cookieName
+            http["cookie_lifetime"] = service.stickySessions.cookieLifetime
+        if service.protocol == "https":
+            http["certificates"] = certificates
+            http["redirect_http"] = service.redirectHttp
+        body["http"] = http
+    return body
+
+
+def differs(wanted: Any, live: Any) -> bool:
+    """
+    Whether a live service lacks any of the settings in ``wanted``. Settings
+    left to the API's defaults aren't compared.
+    """
+    if isinstance(wanted, dict):
+        if not isinstance(live, dict):
+            return True
+        return any(differs(v, live.get(k)) for k, v in wanted.items())
+    return wanted != live
+
+
+def live_targets(load_balancer: Dict[str, Any]) -> Set[Target]:
+    """
+    The server and label selector targets of a load balancer. Servers which
+    are only targets through a label selector aren't included.
+    """
+    targets: Set[Target] = set()
+    for target in load_balancer["targets"]:
+        private = bool(target.get("use_private_ip"))
+        if target["type"] == "server":
+            targets.add(("server", target["server"]["id"], private))
+        elif target["type"] == "label_selector":
+            targets.add(
+                ("label_selector", target["label_selector"]["selector"], private)
+            )
+    return targets
+
+
+def target_body(target: Target) -> Dict[str, Any]:
+    kind, ref, private = target
+    key = "id" if kind == "server" else "selector"
+    return {"type": kind, kind: {key: ref}, "use_private_ip": private}
 
 
 class LoadBalancerDefinition(ResourceDefinition):
@@ -33,9 +135,377 @@ class LoadBalancerDefinition(ResourceDefinition):
 class LoadBalancerState(HetznerCloudResourceState):
     """
     State of a Hetzner Cloud Load Balancer.
+
+    Services and targets are compared with the live load balancer as sets
+    and only the difference is applied, each change being a single action
+    on the load balancer. Every action locks the load balancer, so they're
+    made one after another.
     """
 
     definition_type = LoadBalancerDefinition
 
     _resource_type = "load_balancers"
-    _reserved_keys = HetznerCloudResourceState.COMMON_HCLOUD_RESERVED
+    _reserved_keys = HetznerCloudResourceState.COMMON_HCLOUD_RESERVED + [
+        "address",
+    ]
+
+    address = attr_property("address", None)
+
+    @classmethod
+    def get_type(cls):
+        return "hetznercloud-load-balancer"
+
+    def __init__(self, depl, name, id):
+        super(HetznerCloudResourceState, self).__init__(depl, name, id)
+        self.handle_create_load_balancer = Handler(
+            ["location"],
+            handle=self.realise_create_load_balancer,
+        )
+        self.handle_modify_type = Handler(
+            ["balancerType"],
+            after=[self.handle_create_load_balancer],
+            handle=self.realise_modify_type,
+        )
+        self.handle_modify_algorithm = Handler(
+            ["algorithm"],
+            after=[self.handle_create_load_balancer],
+            handle=self.realise_modify_algorithm,
+        )
+        self.handle_modify_network = Handler(
+            ["network"],
+            after=[self.handle_create_load_balancer],
+            handle=self.realise_modify_network,
+        )
+        self.handle_modify_services = Handler(
+            ["services"],
+            after=[self.handle_modify_type, self.handle_modify_algorithm],
+            handle=self.realise_modify_services,
+        )
+        self.handle_modify_targets = Handler(
+            [
+                "targets",
+                "labelSelectors",
+                "targetsByLabel",
+                "targetAllMachines",
+                "usePrivateIp",
+            ],
+            after=[self.handle_modify_network],
+            handle=self.realise_modify_targets,
+        )
+        self.handle_modify_labels = Handler(
+            ["labels"],
+            after=[self.handle_modify_services, self.handle_modify_targets],
+            handle=super().realise_modify_labels,
+        )
+
+    def show_type(self):
+        s = f"{super(LoadBalancerState, self).show_type()}"
+        if self.state == self.UP:
+            s += f" [{self._state.get('location', None)}]"
+        return s
+
+    @property
+    def full_name(self) -> str:
+        address = self._state.get("address", None)
+        return f"Hetzner Cloud Load Balancer {self.resource_id} [{address}]"
+
+    def prefix_definition(self, attr: Any) -> Dict[Sequence[str], Any]:
+        return {("resources", "hetznerCloudLoadBalancers"): attr}
+
+    def get_definition_prefix(self) -> str:
+        return "resources.hetznerCloudLoadBalancers."
+
+    def create_after(
+        self, resources, defn: Optional[ResourceDefinition]
+    ) -> Set[ResourceState[ResourceDefinition]]:
+        return {
+            r
+            for r in resources
+            if isinstance(r, CertificateState)
+            or isinstance(r, NetworkState)
+            or r.get_type() == "hetznercloud"
+        }
+
+    def cleanup_state(self) -> None:
+        with self.depl._db:
+            self.state = self.MISSING
+            self.resource_id = None
+            self._state["address"] = None
+            self._state["location"] = None
+            self._state["balancerType"] = None
+            self._state["algorithm"] = None
+            self._state["network"] = None
+            self._state["services"] = None
+            self._state["targets"] = None
+            self._state["labelSelectors"] = None
+            self._state["targetsByLabel"] = None
+            self._state["targetAllMachines"] = None
+            self._state["usePrivateIp"] = None
+            self._state["labels"] = None
+
+    def _get_id(self, kind: str, type_name: str, state_type: Any, name: str) -> int:
+        """
+        The ID of a resource of this deployment, or of one outside it by name.
+        """
+        if name.startswith("nixops-" + self.depl.uuid):
+            res = self.get_hetznercloud_resource(name, type_name, state_type)
+            if res.resource_id is None:
+                raise Exception(f"{res.full_name} hasn't been created yet")
+            return int(res.resource_id)
+        instance = self.get_snapshot().get_by_name(kind, name)
+        if instance is None:
+            raise Exception(f"{kind[:-1].replace('_', ' ')} ‘{name}’ doesn't exist")
+        return instance.id
+
+    def _get_machine(self, server_name: str) -> Optional[Any]:
+        for res in self.depl.resources.values():
+            if res.get_type() == "hetznercloud" and res.server_name == server_name:
+                return res
+        return None
+
+    def _get_server_id(self, name: str) -> int:
+        res = self._get_machine(name)
+        if res is not None:
+            if res.vm_id is None:
+                raise Exception(f"machine ‘{res.name}’ hasn't been created yet")
+            return res.vm_id
+        server = self.get_snapshot().get_by_name("servers", name)
+        if server is None:
+            raise Exception(f"load balancer target ‘{name}’ doesn't exist")
+        return server.id
+
+    def _get_services(self, defn: LoadBalancerOptions) -> Dict[int, Dict[str, Any]]:
+        return {
+            service.listenPort: service_body(
+                service,
+                [
+                    self._get_id(
+                        "certificates",
+                        "hetznercloud-certificate",
+                        CertificateState,
+                        name,
+                    )
+                    for name in service.certificates
+                ],
+            )
+            for service in defn.services
+        }
+
+    def _get_targets(self, defn: LoadBalancerOptions) -> Set[Target]:
+        private = defn.usePrivateIp
+        uuid = f"CharonNetworkUUID={self.depl.uuid}"
+        selectors = set(defn.labelSelectors)
+        if defn.targetAllMachines:
+            selectors.add(uuid)
+
+        # Machines are picked out by the labels every server of the
+        # deployment carries, so that their server IDs don't matter.
+        servers: Set[int] = set()
+        machines: Set[str] = set()
+        for name in defn.targets:
+            res = self._get_machine(name)
+            if res is not None and defn.targetAllMachines:
+                continue
+            if res is not None and defn.targetsByLabel:
+                machines.add(res.name)
+            else:
+                servers.add(self._get_server_id(name))
+        if machines:
+            selectors.add(
+                f"{uuid},CharonInstanceName in ({','.join(sorted(machines))})"
+            )
+
+        return {("server", x, private) for x in servers} | {
+            ("label_selector", x, private) for x in selectors
+        }
+
+    def _get_live(self) -> Dict[str, Any]:
+        live = hetznercloud_async.run(
+            self.get_async_client().get(self._resource_type, self.resource_id)
+        )
+        if live is None:
+            raise Exception(f"{self.full_name} no longer exists")
+        return live
+
+    def _run_actions(self, calls: Sequence[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Run actions on the load balancer one after another, each once the
+        last has finished. Every action, target changes included, locks the
+        load balancer until it has finished, so making them at once would
+        only have all but one of them fail and be retried.
+        """
+        client = self.get_async_client()
+
+        async def run() -> None:
+            for command, body in calls:
+                await client.action(
+                    self._resource_type, self.resource_id, command, body
+                )
+
+        hetznercloud_async.run(run())
+
+    def realise_create_load_balancer(self, allow_recreate: bool) -> None:
+        defn: LoadBalancerOptions = self.get_defn().config
+
+        if self.state == self.UP:
+            if not allow_recreate:
+                raise Exception(
+                    f"{self.full_name} definition changed and it needs to be "
+                    "recreated use --allow-recreate if you want to create a new one"
+                )
+            self.warn("load balancer definition changed, recreating...")
+            self._destroy()
+            self._client = None
+
+        location = self.get_catalogue().location(defn.location)
+
+        # Services and targets are created along with the load balancer
+        # rather than one action at a time.
+        body: Dict[str, Any] = {
+            "name": self.get_default_name(),
+            "load_balancer_type": defn.balancerType,
+            "location": defn.location,
+            "algorithm": {"type": defn.algorithm},
+            "labels": {**self.get_common_labels(), **dict(defn.labels)},
+            "services": list(self._get_services(defn).values()),
+            "targets": [target_body(x) for x in self._get_targets(defn)],
+            "public_interface": True,
+        }
+        if defn.network is not None:
+            body["network"] = self._get_id(
+                "networks", "hetznercloud-network", NetworkState, defn.network
+            )
+
+        self.logger.log(
+            f"creating load balancer at {location['description']} with"
+            f" {len(body['services'])} services and {len(body['targets'])} targets..."
+        )
+        client = self.get_async_client()
+
+        async def create() -> Dict[str, Any]:
+            response = await client.request("POST", "/load_balancers", json_body=body)
+            await client.wait_for_actions([response["action"]])
+            return response["load_balancer"]
+
+        load_balancer = hetznercloud_async.run(create())
+        self.resource_id = load_balancer["id"]
+        self.address = load_balancer["public_net"]["ipv4"]["ip"]
+        self.logger.log(f"IP address is {self.address}")
+
+        with self.depl._db:
+            self.state = self.STARTING
+            self._state["location"] = defn.location
+            self._state["balancerType"] = defn.balancerType
+            self._state["algorithm"] = defn.algorithm
+            self._state["network"] = defn.network
+            self._state["services"] = list(defn.services)
+            self._state["targets"] = list(defn.targets)
+            self._state["labelSelectors"] = list(defn.labelSelectors)
+            self._state["targetsByLabel"] = defn.targetsByLabel
+            self._state["targetAllMachines"] = defn.targetAllMachines
+            self._state["usePrivateIp"] = defn.usePrivateIp
+
+        self.wait_for_resource_available(self.resource_id)
+
+    def realise_modify_type(self, allow_recreate: bool) -> None:
+        defn: LoadBalancerOptions = self.get_defn().config
+
+        self.logger.log(f"changing load balancer type to {defn.balancerType}")
+        self._run_actions([("change_type", {"load_balancer_type": defn.balancerType})])
+
+        with self.depl._db:
+            self._state["balancerType"] = defn.balancerType
+
+    def realise_modify_algorithm(self, allow_recreate: bool) -> None:
+        defn: LoadBalancerOptions = self.get_defn().config
+
+        self.logger.log(f"changing load balancing algorithm to {defn.algorithm}")
+        self._run_actions([("change_algorithm", {"type": defn.algorithm})])
+
+        with self.depl._db:
+            self._state["algorithm"] = defn.algorithm
+
+    def realise_modify_network(self, allow_recreate: bool) -> None:
+        defn: LoadBalancerOptions = self.get_defn().config
+
+        attached = {x["network"] for x in self._get_live()["private_net"]}
+        wanted = (
+            {
+                self._get_id(
+                    "networks", "hetznercloud-network", NetworkState, defn.network
+                )
+            }
+            if defn.network is not None
+            else set()
+        )
+        for network_id in attached - wanted:
+            self.logger.log(f"detaching load balancer from network {network_id}")
+            self._run_actions([("detach_from_network", {"network": network_id})])
+        for network_id in wanted - attached:
+            self.logger.log(f"attaching load balancer to network {network_id}")
+            self._run_actions([("attach_to_network", {"network": network_id})])
+
+        with self.depl._db:
+            self._state["network"] = defn.network
+
+    def realise_modify_services(self, allow_recreate: bool) -> None:
+        defn: LoadBalancerOptions = self.get_defn().config
+
+        live = {x["listen_port"]: x for x in self._get_live()["services"]}
+        wanted = self._get_services(defn)
+        calls: List[Tuple[str, Dict[str, Any]]] = [
+            ("delete_service", {"listen_port": port})
+            for port in sorted(live.keys() - wanted.keys())
+        ]
+        for port, body in sorted(wanted.items()):
+            if port not in live:
+                calls.append(("add_service", body))
+            elif differs(body, live[port]):
+                calls.append(("update_service", body))
+
+        if calls:
+            commands = [command for command, _ in calls]
+            self.logger.log(
+                f"updating services: {commands.count('add_service')} to add,"
+                f" {commands.count('update_service')} to update,"
+                f" {commands.count('delete_service')} to remove"
+            )
+            self._run_actions(calls)
+            self.forget_instance()
+
+        with self.depl._db:
+            self._state["services"] = list(defn.services)
+
+    def realise_modify_targets(self, allow_recreate: bool) -> None:
+        defn: LoadBalancerOptions = self.get_defn().config
+
+        live = live_targets(self._get_live())
+        wanted = self._get_targets(defn)
+        removed, added = live - wanted, wanted - live
+
+        if removed or added:
+            self.logger.log(
+                f"updating targets: {len(added)} to add, {len(removed)} to remove,"
+                f" {len(live & wanted)} unchanged"
+            )
+            # New targets are added before old ones are removed, so that a
+            # machine moving from one label selector to another stays in the
+            # pool. Only a target whose use of private IPs changes has to be
+            # removed before it can be added again.
+            readded = {x for x in removed if (x[0], x[1], not x[2]) in added}
+            for phase, command in [
+                (readded, "remove_target"),
+                (added, "add_target"),
+                (removed - readded, "remove_target"),
+            ]:
+                self._run_actions(
+                    [(command, target_body(x)) for x in sorted(phase, key=str)]
+                )
+            self.forget_instance()
+
+        with self.depl._db:
+            self._state["targets"] = list(defn.targets)
+            self._state["labelSelectors"] = list(defn.labelSelectors)
+            self._state["targetsByLabel"] = defn.targetsByLabel
+            self._state["targetAllMachines"] = defn.targetAllMachines
+            self._state["usePrivateIp"] = defn.usePrivateIp
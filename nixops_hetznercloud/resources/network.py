@@ -2,14 +2,74 @@
 
 # Automatic provisioning of Hetzner Cloud Networks.
 
-from hcloud.networks.domain import Network, NetworkSubnet, NetworkRoute
+from hcloud.actions.client import BoundAction
+
 from nixops.diff import Handler
 from nixops.resources import ResourceDefinition
+from nixops_hetznercloud import hetznercloud_async
+from nixops_hetznercloud.hetznercloud_client import get_action_waiter
 from nixops_hetznercloud.hetznercloud_common import HetznerCloudResourceState
 
-from typing import Any, Dict, Sequence
+from typing import Any, Dict, Iterable, List, Mapping, Sequence, Set, Tuple
+
+from .types.network import NetworkOptions
+
+# A route's destination and gateway.
+Route = Tuple[str, str]
+
+
+def to_route(route: Mapping[str, str]) -> Route:
+    x = dict(route)
+    return (x["destination"], x["gateway"])
+
+
+def live_subnets(network: Dict[str, Any]) -> Set[str]:
+    """
+    The IP ranges of a live network's cloud subnets, leaving out subnets
+    of other types (such as vSwitch connections) which NixOps doesn't manage.
+    """
+    return {x["ip_range"] for x in network["subnets"] if x["type"] == "cloud"}
 
-from .types.network import NetworkOptions, RouteOptions
+
+def live_routes(network: Dict[str, Any]) -> Set[Route]:
+    return {to_route(x) for x in network["routes"]}
+
+
+def plan_routing(
+    subnets: Set[str],
+    routes: Set[Route],
+    wanted_subnets: Iterable[str],
+    wanted_routes: Iterable[Mapping[str, str]],
+    zone: str,
+) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    The fewest actions which take a network from the subnets and routes it
+    has to those wanted, in an order Hetzner Cloud accepts: routes are
+    deleted before the subnets holding their gateways, and added after.
+    """
+    final_subnets = set(wanted_subnets)
+    final_routes = {to_route(x) for x in wanted_routes}
+    return (
+        [
+            ("delete_route", {"destination": d, "gateway": g})
+            for d, g in sorted(routes - final_routes)
+        ]
+        + [("delete_subnet", {"ip_range": x}) for x in sorted(subnets - final_subnets)]
+        + [
+            ("add_subnet", {"type": "cloud", "ip_range": x, "network_zone": zone})
+            for x in sorted(final_subnets - subnets)
+        ]
+        + [
+            ("add_route", {"destination": d, "gateway": g})
+            for d, g in sorted(final_routes - routes)
+        ]
+    )
+
+
+def describe(command: str, body: Dict[str, Any]) -> str:
+    if command.endswith("_subnet"):
+        return body["ip_range"]
+    return f"{body['destination']} via {body['gateway']}"
 
 
 class NetworkDefinition(ResourceDefinition):
@@ -48,19 +108,14 @@ class NetworkState(HetznerCloudResourceState):
             ["ipRange", "zone"],
             handle=self.realise_create_network,
         )
-        self.handle_modify_subnets = Handler(
-            ["subnets"],
+        self.handle_modify_routing = Handler(
+            ["subnets", "routes"],
             after=[self.handle_create_network],
-            handle=self.realise_modify_subnets,
-        )
-        self.handle_modify_routes = Handler(
-            ["routes"],
-            after=[self.handle_modify_subnets],
-            handle=self.realise_modify_routes,
+            handle=self.realise_modify_routing,
         )
         self.handle_modify_labels = Handler(
             ["labels"],
-            after=[self.handle_modify_subnets, self.handle_modify_routes],
+            after=[self.handle_modify_routing],
             handle=super().realise_modify_labels,
         )
 
@@ -101,10 +156,28 @@ class NetworkState(HetznerCloudResourceState):
             self._destroy()
             self._client = None
 
+        # Subnets and routes are created along with the network rather than
+        # one action at a time.
         self.log_start(f"creating virtual network '{name}'...")
-        self.resource_id = (
-            self.get_client().networks.create(name=name, ip_range=defn.ipRange).id
+        response = hetznercloud_async.run(
+            self.get_async_client().request(
+                "POST",
+                "/networks",
+                json_body={
+                    "name": name,
+                    "ip_range": defn.ipRange,
+                    "subnets": [
+                        {"type": "cloud", "ip_range": x, "network_zone": defn.zone}
+                        for x in defn.subnets
+                    ],
+                    "routes": [
+                        {"destination": d, "gateway": g}
+                        for d, g in map(to_route, defn.routes)
+                    ],
+                },
+            )
         )
+        self.resource_id = response["network"]["id"]
 
         with self.depl._db:
             self.state = self.STARTING
@@ -113,61 +186,64 @@ class NetworkState(HetznerCloudResourceState):
 
         self.wait_for_resource_available(self.resource_id)
 
-    def realise_modify_subnets(self, allow_recreate: bool) -> None:
-        defn: NetworkOptions = self.get_defn().config
-
-        prev_subnets = set(self._state.get("subnets", ()))
-        final_subnets = set(defn.subnets)
-
-        for ip_range in prev_subnets - final_subnets:
-            self.logger.log(f"deleting subnet {ip_range}")
-            self.wait_on_action(
-                self.get_client().networks.delete_subnet(
-                    network=Network(self.resource_id),
-                    subnet=NetworkSubnet(ip_range, "cloud", defn.zone),
-                )
+    def _get_live(self) -> Dict[str, Any]:
+        live = hetznercloud_async.run(
+            self.get_async_client().get(self._resource_type, self.resource_id)
+        )
+        if live is None:
+            raise Exception(f"{self.full_name} no longer exists")
+        return live
+
+    def _run_actions(self, calls: Sequence[Tuple[str, Dict[str, Any]]]) -> int:
+        """
+        Run actions on the network one at a time. Each of them locks the
+        network until it has finished, so the next is only issued once the
+        shared action waiter has seen the last one finish. Returns how many
+        requests were made, counting the polls made while waiting.
+        """
+        client = self.get_client()
+        waiter = get_action_waiter(client)
+        requests = 0
+        for command, body in calls:
+            response = client.request(
+                url=f"/{self._resource_type}/{self.resource_id}/actions/{command}",
+                method="POST",
+                json=body,
             )
+            polls = waiter.requests
+            self.wait_on_action(BoundAction(client.actions, response["action"]))
+            requests += 1 + waiter.requests - polls
+        return requests
 
-        for ip_range in final_subnets - prev_subnets:
-            self.logger.log(f"adding subnet {ip_range}")
-            self.wait_on_action(
-                self.get_client().networks.add_subnet(
-                    network=Network(self.resource_id),
-                    subnet=NetworkSubnet(ip_range, "cloud", defn.zone),
-                )
-            )
+    def realise_modify_routing(self, allow_recreate: bool) -> None:
+        defn: NetworkOptions = self.get_defn().config
 
-        with self.depl._db:
-            self._state["subnets"] = list(defn.subnets)
+        live = self._get_live()
+        calls = plan_routing(
+            live_subnets(live), live_routes(live), defn.subnets, defn.routes, defn.zone
+        )
 
-    def realise_modify_routes(self, allow_recreate: bool) -> None:
-        defn: NetworkOptions = self.get_defn().config
+        # What diffing against the last deployed state alone would have done.
+        naive = len(set(self._state.get("subnets") or ()) ^ set(defn.subnets)) + len(
+            {to_route(x) for x in self._state.get("routes") or ()}
+            ^ {to_route(x) for x in defn.routes}
+        )
 
-        # workaround to get hashable types
-        # TODO patch nixops StateDict getter for dicts (if appropriate)
-        prev_routes = {RouteOptions(**x) for x in self._state.get("routes", ())}
-        final_routes = set(defn.routes)
-
-        for route in prev_routes - final_routes:
-            self.logger.log(f"deleting route for {route.gateway}")
-            self.wait_on_action(
-                self.get_client().networks.delete_route(
-                    network=Network(self.resource_id),
-                    route=NetworkRoute(route.destination, route.gateway),
-                )
+        for command, body in calls:
+            self.logger.log(f"{command.replace('_', ' ')} {describe(command, body)}")
+        requests = self._run_actions(calls)
+        if naive > len(calls):
+            self.logger.log(
+                f"reconciled subnets and routes in {len(calls)} action"
+                f"{'s' if len(calls) != 1 else ''} and {requests} requests,"
+                f" saving {naive - len(calls)} actions"
             )
 
-        for route in final_routes - prev_routes:
-            self.logger.log(f"adding route to {route.gateway}")
-            self.wait_on_action(
-                self.get_client().networks.add_route(
-                    network=Network(self.resource_id),
-                    route=NetworkRoute(route.destination, route.gateway),
-                )
-            )
+        self.forget_instance()
 
         # Why must we insert as a list when the original type (tuple) is json encodable?
         # StateDict setter accepts inserting lists and dicts for legacy reasons.
         # TODO patch nixops to encode tuples (in addition, for backwards compat)
         with self.depl._db:
+            self._state["subnets"] = list(defn.subnets)
             self._state["routes"] = list(defn.routes)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Automatic provisioning of Hetzner Cloud Placement Groups.
+
+from nixops.diff import Handler
+from nixops.resources import ResourceDefinition
+from nixops_hetznercloud.hetznercloud_common import HetznerCloudResourceState
+
+from typing import Any, Dict, Sequence
+
+from .types.placement_group import PlacementGroupOptions
+
+
+class PlacementGroupDefinition(ResourceDefinition):
+    """
+    Definition of a Hetzner Cloud placement group.
+    """
+
+    config: PlacementGroupOptions
+
+    @classmethod
+    def get_type(cls):
+        return "hetznercloud-placement-group"
+
+    @classmethod
+    def get_resource_type(cls):
+        return "hetznerCloudPlacementGroups"
+
+
+class PlacementGroupState(HetznerCloudResourceState):
+    """
+    State of a Hetzner Cloud Placement Group.
+    """
+
+    definition_type = PlacementGroupDefinition
+
+    _resource_type = "placement_groups"
+    _reserved_keys = HetznerCloudResourceState.COMMON_HCLOUD_RESERVED
+
+    @classmethod
+    def get_type(cls):
+        return "hetznercloud-placement-group"
+
+    def __init__(self, depl, name, id):
+        super(HetznerCloudResourceState, self).__init__(depl, name, id)
+        self.handle_create_placement_group = Handler(
+            ["groupType"],
+            handle=self.realise_create_placement_group,
+        )
+        self.handle_modify_labels = Handler(
+            ["labels"],
+            after=[self.handle_create_placement_group],
+            handle=super().realise_modify_labels,
+        )
+
+    def show_type(self):
+        s = f"{super(PlacementGroupState, self).show_type()}"
+        if self.state == self.UP:
+            s += f" [{self._state.get('groupType', None)}]"
+        return s
+
+    @property
+    def full_name(self) -> str:
+        return f"Hetzner Cloud Placement Group {self.resource_id}"
+
+    def prefix_definition(self, attr: Any) -> Dict[Sequence[str], Any]:
+        return {("resources", "hetznerCloudPlacementGroups"): attr}
+
+    def get_definition_prefix(self) -> str:
+        return "resources.hetznerCloudPlacementGroups."
+
+    def cleanup_state(self) -> None:
+        with self.depl._db:
+            self.state = self.MISSING
+            self.resource_id = None
+            self._state["groupType"] = None
+            self._state["labels"] = None
+
+    def realise_create_placement_group(self, allow_recreate: bool) -> None:
+        defn: PlacementGroupOptions = self.get_defn().config
+
+        if self.state == self.UP:
+            if not allow_recreate:
+                raise Exception(
+                    f"{self.full_name} definition changed and it needs to be "
+                    "recreated use --allow-recreate if you want to create a new one"
+                )
+            self.warn("placement group definition changed, recreating...")
+            self._destroy()
+            self._client = None
+
+        name = self.get_default_name()
+        self.logger.log_start(f"creating {defn.groupType} placement group '{name}'...")
+        self.resource_id = (
+            self.get_client()
+            .placement_groups.create(
+                name=name, type=defn.groupType, labels=self.get_common_labels()
+            )
+            .placement_group.id
+        )
+
+        with self.depl._db:
+            self.state = self.STARTING
+            self._state["groupType"] = defn.groupType
+
+        self.wait_for_resource_available(self.resource_id)
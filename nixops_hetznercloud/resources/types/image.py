@@ -0,0 +1,9 @@
+from nixops.resources import ResourceOptions
+from typing import Mapping
+
+
+class ImageOptions(ResourceOptions):
+    apiToken: str
+    location: str
+    serverType: str
+    labels: Mapping[str, str]
@@ -1,8 +1,50 @@
 from nixops.resources import ResourceOptions
-from typing import Mapping
+from typing import Mapping, Optional, Sequence
+
+
+class HttpHealthCheckOptions(ResourceOptions):
+    domain: str
+    path: str
+    response: str
+    statusCodes: Sequence[str]
+    tls: bool
+
+
+class HealthCheckOptions(ResourceOptions):
+    protocol: str
+    port: int
+    interval: int
+    timeout: int
+    retries: int
+    http: Optional[HttpHealthCheckOptions]
+
+
+class StickySessionsOptions(ResourceOptions):
+    cookieName: str
+    cookieLifetime: int
+
+
+class ServiceOptions(ResourceOptions):
+    protocol: str
+    listenPort: int
+    destinationPort: int
+    healthCheck: Optional[HealthCheckOptions]
+    proxyProtocol: bool
+    stickySessions: Optional[StickySessionsOptions]
+    certificates: Sequence[str]
+    redirectHttp: bool
 
 
 class LoadBalancerOptions(ResourceOptions):
     apiToken: str
     labels: Mapping[str, str]
     location: str
+    balancerType: str
+    network: Optional[str]
+    targets: Sequence[str]
+    labelSelectors: Sequence[str]
+    targetsByLabel: bool
+    targetAllMachines: bool
+    usePrivateIp: bool
+    services: Sequence[ServiceOptions]
+    algorithm: str
@@ -0,0 +1,8 @@
+from nixops.resources import ResourceOptions
+from typing import Mapping
+
+
+class PlacementGroupOptions(ResourceOptions):
+    apiToken: str
+    groupType: str
+    labels: Mapping[str, str]
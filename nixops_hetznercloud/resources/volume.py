@@ -4,13 +4,16 @@
 
 from hcloud import APIException
 from hcloud.volumes.domain import CreateVolumeResponse, Volume
-from hcloud.locations.client import BoundLocation
+from hcloud.locations.domain import Location
 from hcloud.actions.domain import ActionFailedException, ActionTimeoutException
 
 from nixops.diff import Handler
-from nixops.util import attr_property, check_wait
+from nixops.util import attr_property
 from nixops.resources import ResourceDefinition
 from nixops_hetznercloud.hetznercloud_common import HetznerCloudResourceState
+from nixops_hetznercloud.hetznercloud_snapshot import within_pass
+from nixops_hetznercloud.hetznercloud_teardown import bulk_destroy_enabled
+from nixops_hetznercloud.hetznercloud_trace import check_wait, traced
 
 from typing import Any, Dict, Sequence
 
@@ -102,7 +105,7 @@ class VolumeState(HetznerCloudResourceState):
         def detach_volume() -> bool:
             self.logger.log(f"detaching {self.full_name}...")
             try:
-                instance.detach().wait_until_finished()
+                self.wait_on_action(instance.detach())
             except APIException as e:
                 if e.code == "locked":
                     return False
@@ -125,9 +128,12 @@ class VolumeState(HetznerCloudResourceState):
 
         if instance is not None:
             # can't trust api for volume attach status, have to check server api
-            if instance.server and self.get_client().servers.get_by_id(instance.server):
+            if instance.server and self.get_snapshot().get_by_id(
+                "servers", instance.server.id
+            ):
                 check_wait(detach_volume)
             check_wait(destroy_volume)
+            self.forget_instance()
 
         self.cleanup_state()
 
@@ -148,13 +154,15 @@ class VolumeState(HetznerCloudResourceState):
             self._destroy()
             self._client = None
 
-        location: BoundLocation = self.get_client().locations.get_by_name(defn.location)
+        location = self.get_catalogue().location(defn.location)
         name: str = self.get_default_name()
 
-        self.logger.log(f"creating {defn.size}GB volume at {location.description}...")
+        self.logger.log(
+            f"creating {defn.size}GB volume at {location['description']}..."
+        )
         try:
             response: CreateVolumeResponse = self.get_client().volumes.create(
-                location=location,
+                location=Location(name=defn.location),
                 name=name,
                 size=defn.size,
                 format=defn.fsType,
@@ -189,16 +197,24 @@ class VolumeState(HetznerCloudResourceState):
             self.logger.log(
                 f"increasing volume size from {size} GiB to {defn.size} GiB"
             )
-            self.get_client().volumes.resize(
-                volume=Volume(self.resource_id), size=defn.size
-            ).wait_until_finished()
+            self.wait_on_action(
+                self.get_client().volumes.resize(
+                    volume=Volume(self.resource_id), size=defn.size
+                )
+            )
+            self.forget_instance()
             with self.depl._db:
                 self._state["size"] = defn.size
                 self.needsFSResize = True
 
+    @traced("destroy")
+    @within_pass
     def destroy(self, wipe: bool = False) -> bool:
         question = f"are you sure you want to destroy {self.full_name}?"
         if not self.depl.logger.confirm(question):
             return False
-        self._destroy()
+        if bulk_destroy_enabled():
+            self._destroy_in_bulk()
+        else:
+            self._destroy()
         return True
@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from os.path import dirname
+from unittest import mock
+
+import pytest
+
+from tests.offline import OfflineDeploymentTest
+
+from typing import Any, Callable, Dict, List
+
+# Fleet sizes to benchmark. The 200 machine fleet takes minutes, so it only
+# runs when asked for, e.g. HCLOUD_BENCHMARK_SIZES=1,10,50,200.
+SIZES = [int(x) for x in os.environ.get("HCLOUD_BENCHMARK_SIZES", "1,10,50").split(",")]
+
+# Simulated API round trip time.
+LATENCY = float(os.environ.get("HCLOUD_BENCHMARK_LATENCY", 0.01))
+
+# Results are written here as one JSON file per fleet size.
+RESULTS_DIR = os.environ.get("HCLOUD_BENCHMARK_RESULTS") or os.path.join(
+    tempfile.gettempdir(), "nixops-hetznercloud-benchmark"
+)
+
+# Round trips recorded by a known good run, one JSON file per fleet size.
+# Rerun with HCLOUD_BENCHMARK_UPDATE=1 to record them after an intended change.
+BASELINE_DIR = os.path.join(dirname(__file__), "baseline")
+UPDATE_BASELINE = bool(os.environ.get("HCLOUD_BENCHMARK_UPDATE"))
+
+# How far round trips may exceed the baseline before the benchmark fails.
+TOLERANCE = 0.02
+
+PHASES = ["create", "check", "destroy"]
+
+# How often actions are polled depends on timing, so polls aren't counted as
+# round trips.
+POLL = re.compile(r"^/actions(/\d+)?$")
+
+
+def endpoint(method: str, path: str) -> str:
+    return f"{method} {re.sub(r'/[0-9]+', '/{id}', path)}"
+
+
+class SleepMeter(object):
+    """
+    Stand-in for time.sleep adding up how long every thread slept.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sleep = time.sleep
+        self.seconds = 0.0
+
+    def sleep(self, seconds: float) -> None:
+        with self._lock:
+            self.seconds += seconds
+        self._sleep(seconds)
+
+
+class FleetBenchmark(OfflineDeploymentTest):
+    """
+    Deploys, checks and destroys fleets of machines with a volume each, all
+    attached to one network, and measures each phase's wall time, API
+    requests and time spent sleeping.
+    """
+
+    nix_expr = f"{dirname(__file__)}/fleet.nix"
+    latency = LATENCY
+
+    def measure(self, run: Callable[[], Any]) -> Dict[str, Any]:
+        meter = SleepMeter()
+        self.api.reset_requests()
+        start = time.monotonic()
+        with mock.patch("time.sleep", meter.sleep):
+            run()
+        seconds = time.monotonic() - start
+        with self.api.lock:
+            requests = list(self.api.requests)
+
+        endpoints: Dict[str, int] = {}
+        for method, path, status in requests:
+            if status < 400 and not POLL.match(path):
+                key = endpoint(method, path)
+                endpoints[key] = endpoints.get(key, 0) + 1
+        return {
+            "seconds": round(seconds, 3),
+            "requests": len(requests),
+            "roundTrips": sum(endpoints.values()),
+            "polls": sum(1 for _, path, _ in requests if POLL.match(path)),
+            "failedRequests": sum(1 for _, _, status in requests if status >= 400),
+            "sleepSeconds": round(meter.seconds, 3),
+            "endpoints": dict(sorted(endpoints.items())),
+        }
+
+    def run_benchmark(self, machines: int) -> None:
+        self.depl.set_arg("machines", str(machines))
+
+        results: Dict[str, Any] = {"machines": machines, "latency": self.latency}
+        results["create"] = self.measure(self.deploy)
+        assert len(self.api.resources["servers"]) == machines
+        results["check"] = self.measure(lambda: self.deploy(check=True))
+        results["destroy"] = self.measure(self.depl.destroy_resources)
+        assert not self.api.resources["servers"]
+
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{machines}.json")
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        sys.stderr.write(f"benchmark results written to {path}\n")
+
+        self.compare_to_baseline(results)
+
+    def compare_to_baseline(self, results: Dict[str, Any]) -> None:
+        path = os.path.join(BASELINE_DIR, f"{results['machines']}.json")
+        if UPDATE_BASELINE:
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            with open(path, "w") as f:
+                baseline = {
+                    phase: {
+                        "roundTrips": results[phase]["roundTrips"],
+                        "endpoints": results[phase]["endpoints"],
+                    }
+                    for phase in PHASES
+                }
+                json.dump(baseline, f, indent=2)
+                f.write("\n")
+            return
+        if not os.path.exists(path):
+            pytest.fail(
+                f"no baseline at {path}; record one with HCLOUD_BENCHMARK_UPDATE=1"
+            )
+
+        with open(path) as f:
+            baseline = json.load(f)
+        regressions: List[str] = []
+        for phase in PHASES:
+            expected, actual = baseline[phase], results[phase]
+            if actual["roundTrips"] <= expected["roundTrips"] * (1 + TOLERANCE):
+                continue
+            grown = [
+                f"{k}: {expected['endpoints'].get(k, 0)} -> {n}"
+                for k, n in actual["endpoints"].items()
+                if n > expected["endpoints"].get(k, 0)
+            ]
+            regressions.append(
+                f"{phase} made {actual['roundTrips']} round trips, up from"
+                f" {expected['roundTrips']} ({'; '.join(grown)})"
+            )
+        assert not regressions, "\n".join(regressions)
@@ -0,0 +1,40 @@
+# A fleet of identical machines, each with its own volume, all attached to
+# one network.
+{ machines ? 1 }:
+
+let
+  indices = builtins.genList (i: i) machines;
+
+  machine = i:
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        location = "nbg1";
+        serverType = "cx11";
+        serverNetworks = [
+          { network = resources.hetznerCloudNetworks.network1;
+            privateIpAddress = "10.1.0.${toString (i + 2)}";
+          }
+        ];
+      };
+      fileSystems."/data".hetznerCloud.volume =
+        resources.hetznerCloudVolumes."data${toString i}";
+    };
+
+  forEach = f: builtins.listToAttrs (map f indices);
+in
+{
+  network.description = "NixOps HetznerCloud Benchmark";
+
+  resources.hetznerCloudNetworks.network1 = {
+    ipRange = "10.1.0.0/16";
+    subnets = [ "10.1.0.0/24" ];
+  };
+
+  resources.hetznerCloudVolumes = forEach (i: {
+    name = "data${toString i}";
+    value = { location = "nbg1"; size = 10; };
+  });
+}
+// forEach (i: { name = "machine${toString i}"; value = machine i; })
@@ -0,0 +1,9 @@
+import pytest
+
+from tests.benchmark import SIZES, FleetBenchmark
+
+
+class TestFleet(FleetBenchmark):
+    @pytest.mark.parametrize("machines", SIZES)
+    def test_fleet(self, machines: int) -> None:
+        self.run_benchmark(machines)
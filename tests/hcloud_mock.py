@@ -0,0 +1,1648 @@
+# -*- coding: utf-8 -*-
+
+# In-memory stand-in for the subset of the Hetzner Cloud API used by the
+# plugin, so deployments can be exercised without a Hetzner account.
+
+import base64
+import hashlib
+import ipaddress
+import itertools
+import json
+import re
+import threading
+import time
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+
+
+# Kept apart from time.sleep so that the mock's simulated latency doesn't show
+# up when tests measure how long the plugin sleeps.
+_sleep = time.sleep
+
+LOCATIONS = [
+    {
+        "id": 1,
+        "name": "fsn1",
+        "description": "Falkenstein DC Park 1",
+        "country": "DE",
+        "city": "Falkenstein",
+        "latitude": 50.47612,
+        "longitude": 12.370071,
+        "network_zone": "eu-central",
+    },
+    {
+        "id": 2,
+        "name": "nbg1",
+        "description": "Nuremberg DC Park 1",
+        "country": "DE",
+        "city": "Nuremberg",
+        "latitude": 49.452102,
+        "longitude": 11.076665,
+        "network_zone": "eu-central",
+    },
+    {
+        "id": 3,
+        "name": "hel1",
+        "description": "Helsinki DC Park 1",
+        "country": "FI",
+        "city": "Helsinki",
+        "latitude": 60.169855,
+        "longitude": 24.938379,
+        "network_zone": "eu-central",
+    },
+    {
+        "id": 4,
+        "name": "ash",
+        "description": "Ashburn, VA",
+        "country": "US",
+        "city": "Ashburn, VA",
+        "latitude": 39.045821,
+        "longitude": -77.487073,
+        "network_zone": "us-east",
+    },
+]
+
+
+def _server_type(id: int, name: str, cores: int, memory: float, disk: int) -> Dict:
+    return {
+        "id": id,
+        "name": name,
+        "description": name.upper(),
+        "cores": cores,
+        "memory": memory,
+        "disk": disk,
+        "deprecated": False,
+        "prices": [
+            {
+                "location": x["name"],
+                "price_hourly": {"net": "0.0050", "gross": "0.0060"},
+                "price_monthly": {"net": "3.2900", "gross": "3.9200"},
+            }
+            for x in LOCATIONS
+        ],
+        "storage_type": "local",
+        "cpu_type": "shared",
+    }
+
+
+SERVER_TYPES = [
+    _server_type(1, "cx11", 1, 2, 20),
+    _server_type(3, "cx21", 2, 4, 40),
+    _server_type(5, "cx31", 2, 8, 80),
+    _server_type(7, "cx41", 4, 16, 160),
+    _server_type(22, "cpx11", 2, 2, 40),
+    _server_type(23, "cpx21", 3, 4, 80),
+    _server_type(45, "cax11", 2, 4, 40),
+]
+
+SYSTEM_IMAGES = [
+    {
+        "id": 15512617,
+        "type": "system",
+        "status": "available",
+        "name": "ubuntu-20.04",
+        "description": "Ubuntu 20.04",
+        "image_size": None,
+        "disk_size": 5,
+        "created": "2020-04-23T00:00:00+00:00",
+        "created_from": None,
+        "bound_to": None,
+        "os_flavor": "ubuntu",
+        "os_version": "20.04",
+        "rapid_deploy": True,
+        "protection": {"delete": False},
+        "deprecated": None,
+        "labels": {},
+    }
+]
+
+LOAD_BALANCER_TYPES = [
+    {
+        "id": id,
+        "name": name,
+        "description": name.upper(),
+        "max_connections": connections,
+        "max_services": services,
+        "max_targets": targets,
+        "max_assigned_certificates": 10,
+        "deprecated": None,
+        "prices": [],
+    }
+    for id, name, connections, services, targets in [
+        (1, "lb11", 10000, 5, 25),
+        (2, "lb21", 20000, 15, 75),
+        (3, "lb31", 40000, 30, 150),
+    ]
+]
+
+# The most servers a spread placement group holds.
+PLACEMENT_GROUP_SIZE = 10
+
+# Collections which can be listed, fetched, updated and deleted generically,
+# with the key each item is wrapped in.
+KINDS = {
+    "servers": "server",
+    "volumes": "volume",
+    "floating_ips": "floating_ip",
+    "networks": "network",
+    "ssh_keys": "ssh_key",
+    "certificates": "certificate",
+    "images": "image",
+    "load_balancers": "load_balancer",
+    "placement_groups": "placement_group",
+    "locations": "location",
+    "server_types": "server_type",
+}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _match_labels(labels: Dict[str, str], selector: str) -> bool:
+    """
+    Evaluate the ``key=value``, ``key!=value``, ``key``, ``!key``,
+    ``key in (a,b)`` and ``key notin (a,b)`` forms.
+    """
+    terms = re.findall(r"(?:[^,(]|\([^)]*\))+", selector)
+    for term in filter(None, (x.strip() for x in terms)):
+        if match := re.fullmatch(r"(\S+)\s+(in|notin)\s*\((.*)\)", term):
+            k, op, values = match.groups()
+            if (labels.get(k) in {x.strip() for x in values.split(",")}) != (
+                op == "in"
+            ):
+                return False
+        elif "!=" in term:
+            k, v = term.split("!=", 1)
+            if labels.get(k) == v:
+                return False
+        elif "=" in term:
+            k, v = term.split("=", 1)
+            if labels.get(k.rstrip("=")) != v:
+                return False
+        elif term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+class MockAPIError(Exception):
+    """An error response in the API's ``{"error": {...}}`` format."""
+
+    def __init__(self, status: int, code: str, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class ErrorRule(object):
+    """An injected error, returned for matching requests."""
+
+    def __init__(
+        self,
+        method: str,
+        path: str,
+        status: int,
+        code: str,
+        message: str,
+        times: Optional[int],
+    ) -> None:
+        self.method = method.upper()
+        self.path: Pattern = re.compile(path)
+        self.status = status
+        self.code = code
+        self.message = message
+        self.times = times
+
+    def matches(self, method: str, path: str) -> bool:
+        return (
+            (self.times is None or self.times > 0)
+            and self.method in ("*", method)
+            and self.path.search(path) is not None
+        )
+
+
+class MockHetznerCloud(object):
+    """
+    In-memory Hetzner Cloud project served over HTTP on localhost.
+
+    Actions progress asynchronously: they're reported as running for
+    ``action_duration`` seconds, during which the resources they act on are
+    locked. Every request is delayed by ``latency`` seconds, counted against
+    a rate limit reported in the usual ``RateLimit-*`` headers, and can be
+    made to fail with :meth:`inject_error`.
+
+    Point a client at it through ``HCLOUD_ENDPOINT`` or with
+    ``Client(token, api_endpoint=mock.endpoint)``.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        action_duration: float = 0.0,
+        rate_limit: int = 3600,
+        lock_resources: bool = True,
+    ) -> None:
+        self.latency = latency
+        self.action_duration = action_duration
+        self.rate_limit = rate_limit
+        self.lock_resources = lock_resources
+        self.lock = threading.RLock()
+        self.resources: Dict[str, Dict[int, Dict[str, Any]]] = {
+            kind: {} for kind in KINDS
+        }
+        self.resources["locations"] = {x["id"]: dict(x) for x in LOCATIONS}
+        self.resources["server_types"] = {x["id"]: dict(x) for x in SERVER_TYPES}
+        self.resources["images"] = {x["id"]: dict(x) for x in SYSTEM_IMAGES}
+        self.actions: Dict[int, Dict[str, Any]] = {}
+        # Snapshots still being taken, and the actions taking them.
+        self._creating: Dict[int, int] = {}
+        self.requests: List[Tuple[str, str, int]] = []
+        self.errors: List[ErrorRule] = []
+        self._ids = itertools.count(1000)
+        self._addresses = itertools.count(1)
+        self._tokens = float(rate_limit)
+        self._refilled = time.monotonic()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._routes: List[Tuple[str, Pattern, Callable]] = [
+            (m, re.compile(f"^{p}$"), f) for m, p, f in self._route_table()
+        ]
+
+    # Serving
+
+    @property
+    def endpoint(self) -> str:
+        assert self._server is not None, "mock API server isn't running"
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockHetznerCloud":
+        mock = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _dispatch(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                status, payload, headers = mock.handle(self.command, self.path, body)
+                content = json.dumps(payload).encode() if payload is not None else b""
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            # Every machine of a large fleet may connect at once.
+            request_queue_size = 1024
+
+        self._server = Server(("127.0.0.1", 0), RequestHandler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="hcloud-mock", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "MockHetznerCloud":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    # Test controls
+
+    def inject_error(
+        self,
+        method: str,
+        path: str,
+        status: int = 500,
+        code: str = "server_error",
+        message: str = "injected error",
+        times: Optional[int] = 1,
+    ) -> ErrorRule:
+        """
+        Fail the next ``times`` requests (or all of them, if None) whose method
+        and path match, where ``path`` is a regular expression searched for in
+        the path below ``/v1``.
+        """
+        rule = ErrorRule(method, path, status, code, message, times)
+        with self.lock:
+            self.errors.append(rule)
+        return rule
+
+    def request_count(
+        self, method: str = "*", path: str = "", ok: Optional[bool] = None
+    ) -> int:
+        """
+        Count the requests made so far whose method and path match, optionally
+        only those which succeeded (or failed).
+        """
+        pattern = re.compile(path)
+        with self.lock:
+            return sum(
+                1
+                for m, p, status in self.requests
+                if method in ("*", m)
+                and pattern.search(p) is not None
+                and (ok is None or ok == (status < 400))
+            )
+
+    def reset_requests(self) -> None:
+        with self.lock:
+            self.requests = []
+
+    def add(self, kind: str, **attrs: Any) -> Dict[str, Any]:
+        """Create a resource behind the plugin's back."""
+        with self.lock:
+            return getattr(self, f"_new_{KINDS[kind]}")(**attrs)
+
+    def delete(self, kind: str, id: int) -> None:
+        """Delete a resource behind the plugin's back."""
+        with self.lock:
+            self._delete(kind, id)
+
+    # Request handling
+
+    def handle(self, method: str, url: str, body: Any) -> Tuple[int, Any, Dict]:
+        if self.latency:
+            _sleep(self.latency)
+        parts = urlsplit(url)
+        path = parts.path[3:] if parts.path.startswith("/v1") else parts.path
+        query = parse_qs(parts.query)
+        with self.lock:
+            headers = self._take_rate_limit()
+            status, payload = self._respond(method, path, query, body)
+            self.requests.append((method, path, status))
+            return status, payload, headers
+
+    def _respond(
+        self, method: str, path: str, query: Dict, body: Any
+    ) -> Tuple[int, Any]:
+        try:
+            if self._tokens < 0:
+                raise MockAPIError(
+                    429, "rate_limit_exceeded", "limit of requests reached"
+                )
+            for rule in self.errors:
+                if rule.matches(method, path):
+                    if rule.times is not None:
+                        rule.times -= 1
+                    raise MockAPIError(rule.status, rule.code, rule.message)
+            for m, pattern, fun in self._routes:
+                if m == method and (match := pattern.match(path)):
+                    return fun(query, body, *match.groups())
+            raise MockAPIError(404, "not_found", f"no route for {method} {path}")
+        except MockAPIError as e:
+            error = {"code": e.code, "message": e.message, "details": {}}
+            return e.status, {"error": error}
+
+    def _take_rate_limit(self) -> Dict[str, str]:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.rate_limit), self._tokens + (now - self._refilled)
+        )
+        self._refilled = now
+        self._tokens -= 1
+        remaining = max(int(self._tokens), 0)
+        return {
+            "RateLimit-Limit": str(self.rate_limit),
+            "RateLimit-Remaining": str(remaining),
+            "RateLimit-Reset": str(int(time.time() + self.rate_limit - remaining)),
+        }
+
+    def _route_table(self) -> List[Tuple[str, str, Callable]]:
+        kinds = "|".join(KINDS)
+        return [
+            ("GET", "/actions", self._list_actions),
+            ("GET", r"/actions/(\d+)", self._get_action),
+            ("GET", f"/({kinds})", self._list),
+            ("GET", f"/({kinds})/(\\d+)", self._get),
+            ("PUT", f"/({kinds})/(\\d+)", self._update),
+            ("DELETE", f"/({kinds})/(\\d+)", self._delete_request),
+            ("GET", f"/({kinds})/(\\d+)/actions", self._list_resource_actions),
+            ("POST", "/servers", self._create_server),
+            ("POST", "/volumes", self._create_volume),
+            ("POST", "/floating_ips", self._create_floating_ip),
+            ("POST", "/networks", self._create_network),
+            ("POST", "/ssh_keys", self._create_ssh_key),
+            ("POST", "/certificates", self._create_certificate),
+            ("POST", "/load_balancers", self._create_load_balancer),
+            ("POST", "/placement_groups", self._create_placement_group),
+            ("POST", r"/servers/(\d+)/actions/(\w+)", self._server_action),
+            ("POST", r"/volumes/(\d+)/actions/(\w+)", self._volume_action),
+            ("POST", r"/floating_ips/(\d+)/actions/(\w+)", self._floating_ip_action),
+            ("POST", r"/networks/(\d+)/actions/(\w+)", self._network_action),
+            (
+                "POST",
+                r"/load_balancers/(\d+)/actions/(\w+)",
+                self._load_balancer_action,
+            ),
+        ]
+
+    # Helpers
+
+    def _find(self, kind: str, id: Any) -> Dict[str, Any]:
+        try:
+            return self.resources[kind][int(id)]
+        except (KeyError, ValueError):
+            raise MockAPIError(
+                404, "not_found", f"{KINDS[kind]} with ID {id} not found"
+            )
+
+    def _lookup(self, kind: str, ref: Any) -> Dict[str, Any]:
+        """Find a resource by ID or name, as the create endpoints accept either."""
+        if isinstance(ref, dict):
+            ref = ref.get("id") or ref.get("name")
+        if isinstance(ref, int) or str(ref).isdigit():
+            return self._find(kind, ref)
+        for x in self.resources[kind].values():
+            if x.get("name") == ref:
+                return x
+        raise MockAPIError(
+            422, "invalid_input", f"{KINDS[kind]} ‘{ref}’ does not exist"
+        )
+
+    def _require(self, body: Dict, *keys: str) -> None:
+        for key in keys:
+            if body.get(key) is None:
+                raise MockAPIError(422, "invalid_input", f"missing field ‘{key}’")
+
+    def _check_unique_name(self, kind: str, name: str) -> None:
+        if any(x.get("name") == name for x in self.resources[kind].values()):
+            raise MockAPIError(409, "uniqueness_error", f"name ‘{name}’ already used")
+
+    def _check_locked(self, *resources: Tuple[str, int]) -> None:
+        if not self.lock_resources:
+            return
+        wanted = {(KINDS[kind], int(id)) for kind, id in resources}
+        for action in self.actions.values():
+            if self._action_status(action) != "running":
+                continue
+            if wanted & {(r["type"], r["id"]) for r in action["resources"]}:
+                raise MockAPIError(423, "locked", "resource is locked by an action")
+
+    def _new_id(self) -> int:
+        return next(self._ids)
+
+    def _action(
+        self,
+        command: str,
+        resources: List[Tuple[str, int]],
+        duration: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        action = {
+            "id": self._new_id(),
+            "command": command,
+            "status": "running",
+            "progress": 0,
+            "started": _now(),
+            "finished": None,
+            "resources": [{"id": id, "type": KINDS[kind]} for kind, id in resources],
+            "error": None,
+            "_done": time.monotonic()
+            + (self.action_duration if duration is None else duration),
+        }
+        self.actions[action["id"]] = action
+        return self._render_action(action)
+
+    def _action_status(self, action: Dict[str, Any]) -> str:
+        if action["status"] == "running" and time.monotonic() >= action["_done"]:
+            action["status"] = "success"
+            action["progress"] = 100
+            action["finished"] = _now()
+        return action["status"]
+
+    def _render_action(self, action: Dict[str, Any]) -> Dict[str, Any]:
+        self._action_status(action)
+        return {k: v for k, v in action.items() if not k.startswith("_")}
+
+    def _paginate(self, kind: str, items: List[Any], query: Dict) -> Dict[str, Any]:
+        page = int(query.get("page", ["1"])[0])
+        per_page = min(int(query.get("per_page", ["25"])[0]), 50)
+        total = len(items)
+        last_page = max((total + per_page - 1) // per_page, 1)
+        return {
+            kind: items[(page - 1) * per_page : page * per_page],
+            "meta": {
+                "pagination": {
+                    "page": page,
+                    "per_page": per_page,
+                    "previous_page": page - 1 if page > 1 else None,
+                    "next_page": page + 1 if page < last_page else None,
+                    "last_page": last_page,
+                    "total_entries": total,
+                }
+            },
+        }
+
+    def _location(self, ref: Any) -> Dict[str, Any]:
+        return self._lookup("locations", ref)
+
+    def _datacenter(self, location: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "id": location["id"],
+            "name": f"{location['name']}-dc{location['id']}",
+            "description": f"{location['city']} DC {location['id']}",
+            "location": location,
+            "server_types": {
+                "supported": [x["id"] for x in SERVER_TYPES],
+                "available": [x["id"] for x in SERVER_TYPES],
+                "available_for_migration": [x["id"] for x in SERVER_TYPES],
+            },
+        }
+
+    def _next_ipv4(self) -> str:
+        n = next(self._addresses)
+        return f"203.0.{n // 250 % 250}.{n % 250 + 1}"
+
+    # Generic collection endpoints
+
+    def _list(self, query: Dict, body: Any, kind: str) -> Tuple[int, Any]:
+        if kind == "images":
+            self._refresh_images()
+        items = list(self.resources[kind].values())
+        if "name" in query:
+            items = [x for x in items if x.get("name") == query["name"][0]]
+        if "label_selector" in query:
+            selector = query["label_selector"][0]
+            items = [x for x in items if _match_labels(x.get("labels") or {}, selector)]
+        if "type" in query:
+            items = [x for x in items if x.get("type") in query["type"]]
+        if "fingerprint" in query:
+            items = [
+                x for x in items if x.get("fingerprint") == query["fingerprint"][0]
+            ]
+        if kind == "load_balancers":
+            for x in items:
+                self._match_targets(x)
+        return 200, self._paginate(kind, items, query)
+
+    def _get(self, query: Dict, body: Any, kind: str, id: str) -> Tuple[int, Any]:
+        if kind == "images":
+            self._refresh_images()
+        x = self._find(kind, id)
+        if kind == "load_balancers":
+            self._match_targets(x)
+        return 200, {KINDS[kind]: x}
+
+    def _update(self, query: Dict, body: Any, kind: str, id: str) -> Tuple[int, Any]:
+        x = self._find(kind, id)
+        for key in ("name", "labels", "description"):
+            if body.get(key) is not None:
+                if key == "name" and body["name"] != x.get("name"):
+                    self._check_unique_name(kind, body["name"])
+                x[key] = body[key]
+        return 200, {KINDS[kind]: x}
+
+    def _delete_request(
+        self, query: Dict, body: Any, kind: str, id: str
+    ) -> Tuple[int, Any]:
+        self._find(kind, id)
+        if kind in ("locations", "server_types"):
+            raise MockAPIError(405, "method_not_allowed", "can't delete that")
+        self._check_locked((kind, int(id)))
+        if kind == "servers":
+            action = self._action("delete_server", [("servers", int(id))])
+            self._delete(kind, int(id))
+            return 200, {"action": action}
+        if kind == "volumes" and self.resources[kind][int(id)]["server"]:
+            raise MockAPIError(423, "locked", "volume is still attached")
+        self._delete(kind, int(id))
+        return 204, None
+
+    def _delete(self, kind: str, id: int) -> None:
+        x = self.resources[kind].pop(id)
+        if kind == "servers":
+            for volume_id in x["volumes"]:
+                self.resources["volumes"][volume_id]["server"] = None
+            for fip_id in x["public_net"]["floating_ips"]:
+                self.resources["floating_ips"][fip_id]["server"] = None
+            for net in x["private_net"]:
+                servers = self.resources["networks"][net["network"]]["servers"]
+                servers.remove(id)
+            if x["placement_group"] is not None:
+                group = self.resources["placement_groups"][x["placement_group"]["id"]]
+                group["servers"].remove(id)
+            for lb in self.resources["load_balancers"].values():
+                lb["targets"] = [
+                    t
+                    for t in lb["targets"]
+                    if t["type"] != "server" or t["server"]["id"] != id
+                ]
+        elif kind == "volumes" and x["server"]:
+            self.resources["servers"][x["server"]]["volumes"].remove(id)
+        elif kind == "floating_ips" and x["server"]:
+            server = self.resources["servers"][x["server"]]
+            server["public_net"]["floating_ips"].remove(id)
+        elif kind == "networks":
+            for server_id in x["servers"]:
+                server = self.resources["servers"][server_id]
+                server["private_net"] = [
+                    n for n in server["private_net"] if n["network"] != id
+                ]
+            for lb_id in x["load_balancers"]:
+                lb = self.resources["load_balancers"][lb_id]
+                lb["private_net"] = [n for n in lb["private_net"] if n["network"] != id]
+        elif kind == "placement_groups":
+            for server_id in x["servers"]:
+                self.resources["servers"][server_id]["placement_group"] = None
+        elif kind == "load_balancers":
+            for net in x["private_net"]:
+                self.resources["networks"][net["network"]]["load_balancers"].remove(id)
+
+    # Actions
+
+    def _list_actions(self, query: Dict, body: Any) -> Tuple[int, Any]:
+        if "id" in query:
+            ids = [int(x) for x in query["id"]]
+            actions = [self.actions[x] for x in ids if x in self.actions]
+        else:
+            actions = list(self.actions.values())
+        rendered = [self._render_action(x) for x in actions]
+        if "status" in query:
+            rendered = [x for x in rendered if x["status"] in query["status"]]
+        return 200, self._paginate("actions", rendered, query)
+
+    def _get_action(self, query: Dict, body: Any, id: str) -> Tuple[int, Any]:
+        if int(id) not in self.actions:
+            raise MockAPIError(404, "not_found", f"action with ID {id} not found")
+        return 200, {"action": self._render_action(self.actions[int(id)])}
+
+    def _list_resource_actions(
+        self, query: Dict, body: Any, kind: str, id: str
+    ) -> Tuple[int, Any]:
+        wanted = (KINDS[kind], int(id))
+        actions = [
+            self._render_action(x)
+            for x in self.actions.values()
+            if wanted in {(r["type"], r["id"]) for r in x["resources"]}
+        ]
+        return 200, self._paginate("actions", actions, query)
+
+    def fail_action(self, id: int, code: str = "action_failed") -> None:
+        """Make a running action finish with an error."""
+        with self.lock:
+            action = self.actions[id]
+            action["status"] = "error"
+            action["finished"] = _now()
+            action["error"] = {"code": code, "message": "injected action failure"}
+
+    # Servers
+
+    def _new_server(
+        self,
+        name: str,
+        server_type: Any = "cx11",
+        location: Any = "nbg1",
+        image: Any = "ubuntu-20.04",
+        labels: Optional[Dict[str, str]] = None,
+        status: str = "running",
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._check_unique_name("servers", name)
+        id = self._new_id()
+        server_type = self._lookup("server_types", server_type)
+        location = self._location(location)
+        server = {
+            "id": id,
+            "name": name,
+            "status": status,
+            "created": _now(),
+            "public_net": {
+                "ipv4": {
+                    "id": self._new_id(),
+                    "ip": self._next_ipv4(),
+                    "blocked": False,
+                    "dns_ptr": f"static.{id}.example.com",
+                },
+                "ipv6": {
+                    "id": self._new_id(),
+                    "ip": f"2001:db8:{id % 0xFFFF:x}::/64",
+                    "blocked": False,
+                    "dns_ptr": [],
+                },
+                "floating_ips": [],
+                "firewalls": [],
+            },
+            "private_net": [],
+            "server_type": server_type,
+            "datacenter": self._datacenter(location),
+            "image": self._lookup("images", image),
+            "iso": None,
+            "rescue_enabled": False,
+            "locked": False,
+            "backup_window": None,
+            "outgoing_traffic": 0,
+            "ingoing_traffic": 0,
+            "included_traffic": 21990232555520,
+            "protection": {"delete": False, "rebuild": False},
+            "labels": labels or {},
+            "volumes": [],
+            "primary_disk_size": server_type["disk"],
+            "placement_group": None,
+        }
+        self.resources["servers"][id] = server
+        return server
+
+    def _create_server(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "name", "server_type", "image")
+        if body.get("location") and body.get("datacenter"):
+            raise MockAPIError(
+                422, "invalid_input", "specify either location or datacenter"
+            )
+        for key in body.get("ssh_keys") or ():
+            self._lookup("ssh_keys", key)
+        start = body.get("start_after_create", True)
+        group = None
+        if body.get("placement_group") is not None:
+            group = self._find("placement_groups", body["placement_group"])
+            self._check_placement_room(group)
+        server = self._new_server(
+            name=body["name"],
+            server_type=body["server_type"],
+            location=body.get("location") or "nbg1",
+            image=body["image"],
+            labels=body.get("labels"),
+            status="running" if start else "off",
+        )
+        if group is not None:
+            self._place(server, group)
+        action = self._action("create_server", [("servers", server["id"])])
+        next_actions = []
+        for volume_id in body.get("volumes") or ():
+            self._attach_volume(self._find("volumes", volume_id), server)
+            next_actions.append(
+                self._action(
+                    "attach_volume", [("servers", server["id"]), ("volumes", volume_id)]
+                )
+            )
+        for network_id in body.get("networks") or ():
+            self._attach_network(server, self._find("networks", network_id), None, [])
+            next_actions.append(
+                self._action(
+                    "attach_to_network",
+                    [("servers", server["id"]), ("networks", network_id)],
+                )
+            )
+        if start:
+            next_actions.append(
+                self._action("start_server", [("servers", server["id"])])
+            )
+        return 201, {
+            "server": server,
+            "action": action,
+            "next_actions": next_actions,
+            "root_password": None if body.get("ssh_keys") else "hunter2",
+        }
+
+    def _attach_volume(self, volume: Dict, server: Dict) -> None:
+        if volume["server"] is not None:
+            raise MockAPIError(422, "invalid_input", "volume is already attached")
+        if volume["location"]["id"] != server["datacenter"]["location"]["id"]:
+            raise MockAPIError(
+                422, "invalid_input", "volume and server are in different locations"
+            )
+        volume["server"] = server["id"]
+        server["volumes"].append(volume["id"])
+
+    def _attach_network(
+        self, server: Dict, network: Dict, ip: Optional[str], alias_ips: List[str]
+    ) -> None:
+        if any(n["network"] == network["id"] for n in server["private_net"]):
+            raise MockAPIError(
+                422, "server_already_attached", "server already attached to network"
+            )
+        if not network["subnets"]:
+            raise MockAPIError(422, "invalid_input", "network has no subnets")
+        ip = self._private_ip(network, ip)
+        server["private_net"].append(
+            {
+                "network": network["id"],
+                "ip": ip,
+                "alias_ips": list(alias_ips),
+                "mac_address": f"86:00:00:{server['id'] % 256:02x}:00:01",
+            }
+        )
+        network["servers"].append(server["id"])
+
+    def _private_ip(self, network: Dict, ip: Optional[str]) -> str:
+        """Check a requested private IP is free, or pick the first free one."""
+        taken = {
+            n["ip"]
+            for kind in ("servers", "load_balancers")
+            for x in self.resources[kind].values()
+            for n in x["private_net"]
+            if n["network"] == network["id"]
+        }
+        if ip is None:
+            subnet = ipaddress.ip_network(network["subnets"][0]["ip_range"])
+            hosts = (str(x) for x in itertools.islice(subnet.hosts(), 1, None))
+            return next(x for x in hosts if x not in taken)
+        if ip in taken:
+            raise MockAPIError(409, "ip_not_available", f"IP {ip} is already in use")
+        return ip
+
+    def _server_action(
+        self, query: Dict, body: Dict, id: str, command: str
+    ) -> Tuple[int, Any]:
+        server = self._find("servers", id)
+        resources: List[Tuple[str, int]] = [("servers", server["id"])]
+        extra: Dict[str, Any] = {}
+        self._check_locked(*resources)
+
+        if command in ("poweron", "reboot", "reset"):
+            server["status"] = "running"
+        elif command in ("poweroff", "shutdown"):
+            server["status"] = "off"
+        elif command == "change_type":
+            if server["status"] != "off":
+                raise MockAPIError(422, "server_not_stopped", "server must be off")
+            server["server_type"] = self._lookup("server_types", body["server_type"])
+            if body.get("upgrade_disk"):
+                server["primary_disk_size"] = server["server_type"]["disk"]
+        elif command == "attach_to_network":
+            network = self._find("networks", body["network"])
+            resources.append(("networks", network["id"]))
+            self._check_locked(("networks", network["id"]))
+            self._attach_network(
+                server, network, body.get("ip"), body.get("alias_ips") or []
+            )
+        elif command == "detach_from_network":
+            network = self._find("networks", body["network"])
+            resources.append(("networks", network["id"]))
+            if not any(n["network"] == network["id"] for n in server["private_net"]):
+                raise MockAPIError(
+                    422, "server_not_attached", "server not attached to network"
+                )
+            server["private_net"] = [
+                n for n in server["private_net"] if n["network"] != network["id"]
+            ]
+            network["servers"].remove(server["id"])
+        elif command == "change_alias_ips":
+            for n in server["private_net"]:
+                if n["network"] == body["network"]:
+                    n["alias_ips"] = list(body["alias_ips"])
+        elif command == "create_image":
+            image = self._new_image(
+                description=body.get("description"),
+                type=body.get("type", "snapshot"),
+                labels=body.get("labels"),
+                created_from=server,
+            )
+            image["status"] = "creating"
+            resources.append(("images", image["id"]))
+            extra["image"] = image
+        elif command.endswith("_placement_group"):
+            self._placement_action(server, command, body)
+        elif command == "rebuild":
+            server["image"] = self._lookup("images", body["image"])
+            extra["root_password"] = None
+        elif command not in ("enable_backup", "disable_backup", "change_protection"):
+            raise MockAPIError(404, "not_found", f"unknown server action {command}")
+
+        command = {
+            "poweron": "start_server",
+            "poweroff": "stop_server",
+            "shutdown": "shutdown_server",
+            "reboot": "reboot_server",
+            "reset": "reset_server",
+            "change_type": "change_server_type",
+        }.get(command, command)
+        action = self._action(command, resources)
+        if "image" in extra:
+            self._creating[extra["image"]["id"]] = action["id"]
+        return 201, {"action": action, **extra}
+
+    def _placement_action(self, server: Dict, command: str, body: Dict) -> None:
+        if server["status"] != "off":
+            raise MockAPIError(422, "server_not_stopped", "server must be off")
+        if command == "add_to_placement_group":
+            group = self._find("placement_groups", body["placement_group"])
+            if server["placement_group"] is not None:
+                raise MockAPIError(
+                    422, "server_already_in_placement_group", "remove it first"
+                )
+            self._check_placement_room(group)
+            self._place(server, group)
+        elif command == "remove_from_placement_group":
+            if server["placement_group"] is None:
+                raise MockAPIError(
+                    422, "server_not_in_placement_group", "server isn't in a group"
+                )
+            group = self.resources["placement_groups"][server["placement_group"]["id"]]
+            group["servers"].remove(server["id"])
+            server["placement_group"] = None
+        else:
+            raise MockAPIError(404, "not_found", f"unknown server action {command}")
+
+    # Images
+
+    def _refresh_images(self) -> None:
+        for id, action in list(self._creating.items()):
+            if self._action_status(self.actions[action]) != "running":
+                if id in self.resources["images"]:
+                    self.resources["images"][id]["status"] = "available"
+                del self._creating[id]
+
+    def _new_image(
+        self,
+        description: Optional[str] = None,
+        type: str = "snapshot",
+        labels: Optional[Dict[str, str]] = None,
+        created_from: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        id = self._new_id()
+        image = {
+            "id": id,
+            "type": type,
+            "status": "available",
+            "name": None,
+            "description": description or f"snapshot {id}",
+            "image_size": 1.5,
+            "disk_size": created_from["primary_disk_size"] if created_from else 20,
+            "created": _now(),
+            "created_from": (
+                {"id": created_from["id"], "name": created_from["name"]}
+                if created_from
+                else None
+            ),
+            "bound_to": None,
+            "os_flavor": "unknown",
+            "os_version": None,
+            "rapid_deploy": False,
+            "protection": {"delete": False},
+            "deprecated": None,
+            "labels": labels or {},
+        }
+        self.resources["images"][id] = image
+        return image
+
+    # Volumes
+
+    def _new_volume(
+        self,
+        name: str,
+        size: int = 10,
+        location: Any = "nbg1",
+        format: Optional[str] = None,
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._check_unique_name("volumes", name)
+        id = self._new_id()
+        volume = {
+            "id": id,
+            "name": name,
+            "server": None,
+            "location": self._location(location),
+            "size": size,
+            "linux_device": f"/dev/disk/by-id/scsi-0HC_Volume_{id}",
+            "protection": {"delete": False},
+            "labels": labels or {},
+            "status": "available",
+            "format": format,
+            "created": _now(),
+        }
+        self.resources["volumes"][id] = volume
+        return volume
+
+    def _create_volume(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "name", "size")
+        if bool(body.get("location")) == bool(body.get("server")):
+            raise MockAPIError(
+                422, "invalid_input", "specify exactly one of location and server"
+            )
+        if not 10 <= body["size"] <= 10240:
+            raise MockAPIError(422, "invalid_input", "size must be 10 to 10240 GB")
+        server = self._find("servers", body["server"]) if body.get("server") else None
+        volume = self._new_volume(
+            name=body["name"],
+            size=body["size"],
+            location=body.get("location") or server["datacenter"]["location"]["id"],
+            format=body.get("format"),
+            labels=body.get("labels"),
+        )
+        action = self._action("create_volume", [("volumes", volume["id"])])
+        next_actions = []
+        if server is not None:
+            self._attach_volume(volume, server)
+            next_actions.append(
+                self._action(
+                    "attach_volume",
+                    [("volumes", volume["id"]), ("servers", server["id"])],
+                )
+            )
+        return 201, {"volume": volume, "action": action, "next_actions": next_actions}
+
+    def _volume_action(
+        self, query: Dict, body: Dict, id: str, command: str
+    ) -> Tuple[int, Any]:
+        volume = self._find("volumes", id)
+        resources: List[Tuple[str, int]] = [("volumes", volume["id"])]
+        self._check_locked(*resources)
+
+        if command == "attach":
+            server = self._find("servers", body["server"])
+            resources.append(("servers", server["id"]))
+            self._check_locked(("servers", server["id"]))
+            self._attach_volume(volume, server)
+            command = "attach_volume"
+        elif command == "detach":
+            if volume["server"] is None:
+                raise MockAPIError(422, "invalid_input", "volume is not attached")
+            resources.append(("servers", volume["server"]))
+            self.resources["servers"][volume["server"]]["volumes"].remove(volume["id"])
+            volume["server"] = None
+            command = "detach_volume"
+        elif command == "resize":
+            if body["size"] < volume["size"]:
+                raise MockAPIError(422, "invalid_input", "volumes can't shrink")
+            volume["size"] = body["size"]
+            command = "resize_volume"
+        elif command != "change_protection":
+            raise MockAPIError(404, "not_found", f"unknown volume action {command}")
+        return 201, {"action": self._action(command, resources)}
+
+    # Floating IPs
+
+    def _new_floating_ip(
+        self,
+        type: str = "ipv4",
+        home_location: Any = "nbg1",
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        id = self._new_id()
+        name = name or str(id)
+        self._check_unique_name("floating_ips", name)
+        fip = {
+            "id": id,
+            "name": name,
+            "description": description,
+            "ip": self._next_ipv4() if type == "ipv4" else f"2001:db8:f:{id:x}::/64",
+            "type": type,
+            "server": None,
+            "dns_ptr": [],
+            "home_location": self._location(home_location),
+            "blocked": False,
+            "protection": {"delete": False},
+            "labels": labels or {},
+            "created": _now(),
+        }
+        self.resources["floating_ips"][id] = fip
+        return fip
+
+    def _create_floating_ip(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "type")
+        server = self._find("servers", body["server"]) if body.get("server") else None
+        fip = self._new_floating_ip(
+            type=body["type"],
+            home_location=body.get("home_location")
+            or server["datacenter"]["location"]["id"],
+            name=body.get("name"),
+            description=body.get("description"),
+            labels=body.get("labels"),
+        )
+        action = None
+        if server is not None:
+            self._assign_floating_ip(fip, server)
+            action = self._action(
+                "assign_floating_ip",
+                [("floating_ips", fip["id"]), ("servers", server["id"])],
+            )
+        return 201, {"floating_ip": fip, "action": action}
+
+    def _assign_floating_ip(self, fip: Dict, server: Optional[Dict]) -> None:
+        if fip["server"] is not None:
+            previous = self.resources["servers"][fip["server"]]
+            previous["public_net"]["floating_ips"].remove(fip["id"])
+        fip["server"] = server["id"] if server else None
+        if server is not None:
+            server["public_net"]["floating_ips"].append(fip["id"])
+
+    def _floating_ip_action(
+        self, query: Dict, body: Dict, id: str, command: str
+    ) -> Tuple[int, Any]:
+        fip = self._find("floating_ips", id)
+        resources: List[Tuple[str, int]] = [("floating_ips", fip["id"])]
+        self._check_locked(*resources)
+
+        if command == "assign":
+            server = self._find("servers", body["server"])
+            resources.append(("servers", server["id"]))
+            self._assign_floating_ip(fip, server)
+            command = "assign_floating_ip"
+        elif command == "unassign":
+            self._assign_floating_ip(fip, None)
+            command = "unassign_floating_ip"
+        elif command not in ("change_dns_ptr", "change_protection"):
+            raise MockAPIError(
+                404, "not_found", f"unknown floating IP action {command}"
+            )
+        return 201, {"action": self._action(command, resources)}
+
+    # Networks
+
+    def _new_network(
+        self,
+        name: str,
+        ip_range: str = "10.0.0.0/16",
+        subnets: Optional[List[Dict[str, Any]]] = None,
+        routes: Optional[List[Dict[str, Any]]] = None,
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._check_unique_name("networks", name)
+        id = self._new_id()
+        network = {
+            "id": id,
+            "name": name,
+            "ip_range": ip_range,
+            "subnets": [],
+            "routes": [],
+            "servers": [],
+            "load_balancers": [],
+            "protection": {"delete": False},
+            "labels": labels or {},
+            "created": _now(),
+        }
+        for subnet in subnets or ():
+            self._add_subnet(network, subnet)
+        for route in routes or ():
+            self._add_route(network, route)
+        self.resources["networks"][id] = network
+        return network
+
+    def _create_network(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "name", "ip_range")
+        return 201, {"network": self._new_network(**body)}
+
+    def _add_subnet(self, network: Dict, subnet: Dict) -> None:
+        ip_range = ipaddress.ip_network(subnet["ip_range"])
+        if not ip_range.subnet_of(ipaddress.ip_network(network["ip_range"])):
+            raise MockAPIError(
+                422, "invalid_input", "subnet must be within the network's range"
+            )
+        for x in network["subnets"]:
+            if ipaddress.ip_network(x["ip_range"]).overlaps(ip_range):
+                raise MockAPIError(422, "invalid_input", "subnets overlap")
+        network["subnets"].append(
+            {
+                "type": subnet.get("type", "cloud"),
+                "ip_range": str(ip_range),
+                "network_zone": subnet.get("network_zone", "eu-central"),
+                "gateway": str(next(ip_range.hosts())),
+            }
+        )
+
+    def _add_route(self, network: Dict, route: Dict) -> None:
+        if route in network["routes"]:
+            raise MockAPIError(409, "conflict", "route already exists")
+        network["routes"].append(
+            {"destination": route["destination"], "gateway": route["gateway"]}
+        )
+
+    def _network_action(
+        self, query: Dict, body: Dict, id: str, command: str
+    ) -> Tuple[int, Any]:
+        network = self._find("networks", id)
+        self._check_locked(("networks", network["id"]))
+
+        if command == "add_subnet":
+            self._add_subnet(network, body)
+        elif command == "delete_subnet":
+            before = len(network["subnets"])
+            network["subnets"] = [
+                x for x in network["subnets"] if x["ip_range"] != body["ip_range"]
+            ]
+            if len(network["subnets"]) == before:
+                raise MockAPIError(404, "not_found", "subnet not found")
+        elif command == "add_route":
+            self._add_route(network, body)
+        elif command == "delete_route":
+            route = {"destination": body["destination"], "gateway": body["gateway"]}
+            if route not in network["routes"]:
+                raise MockAPIError(404, "not_found", "route not found")
+            network["routes"].remove(route)
+        elif command == "change_ip_range":
+            network["ip_range"] = body["ip_range"]
+        elif command != "change_protection":
+            raise MockAPIError(404, "not_found", f"unknown network action {command}")
+        return 201, {"action": self._action(command, [("networks", network["id"])])}
+
+    # Load balancers
+
+    def _load_balancer_type(self, ref: Any) -> Dict[str, Any]:
+        for x in LOAD_BALANCER_TYPES:
+            if ref in (x["id"], x["name"]):
+                return x
+        raise MockAPIError(
+            422, "invalid_input", f"load balancer type ‘{ref}’ does not exist"
+        )
+
+    def _new_load_balancer(
+        self,
+        name: str,
+        load_balancer_type: Any = "lb11",
+        location: Any = "nbg1",
+        algorithm: Optional[Dict[str, str]] = None,
+        services: Optional[List[Dict[str, Any]]] = None,
+        targets: Optional[List[Dict[str, Any]]] = None,
+        network: Optional[int] = None,
+        public_interface: bool = True,
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._check_unique_name("load_balancers", name)
+        id = self._new_id()
+        lb = {
+            "id": id,
+            "name": name,
+            "public_net": {
+                "enabled": public_interface,
+                "ipv4": {"ip": self._next_ipv4(), "dns_ptr": None},
+                "ipv6": {"ip": f"2001:db8:b:{id:x}::1", "dns_ptr": None},
+            },
+            "private_net": [],
+            "location": self._location(location),
+            "load_balancer_type": self._load_balancer_type(load_balancer_type),
+            "protection": {"delete": False},
+            "labels": labels or {},
+            "targets": [],
+            "services": [],
+            "algorithm": {"type": "round_robin"},
+            "outgoing_traffic": 0,
+            "ingoing_traffic": 0,
+            "included_traffic": 21990232555520,
+            "created": _now(),
+        }
+        if algorithm is not None:
+            self._change_algorithm(lb, algorithm)
+        # Everything is checked before the load balancer joins the network.
+        attached = self._find("networks", network) if network is not None else None
+        if attached is not None:
+            lb["private_net"].append(self._lb_network(lb, attached, None))
+        for service in services or ():
+            self._add_service(lb, service)
+        for target in targets or ():
+            self._add_target(lb, target)
+        if attached is not None:
+            attached["load_balancers"].append(id)
+        self.resources["load_balancers"][id] = lb
+        return lb
+
+    def _create_load_balancer(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "name", "load_balancer_type")
+        if bool(body.get("location")) == bool(body.get("network_zone")):
+            raise MockAPIError(
+                422, "invalid_input", "specify exactly one of location and network_zone"
+            )
+        lb = self._new_load_balancer(**body)
+        action = self._action("create_load_balancer", [("load_balancers", lb["id"])])
+        return 201, {"load_balancer": lb, "action": action}
+
+    def _change_algorithm(self, lb: Dict, body: Dict) -> None:
+        if body.get("type") not in ("round_robin", "least_connections"):
+            raise MockAPIError(422, "invalid_input", "unknown algorithm")
+        lb["algorithm"] = {"type": body["type"]}
+
+    def _lb_network(self, lb: Dict, network: Dict, ip: Optional[str]) -> Dict:
+        if any(n["network"] == network["id"] for n in lb["private_net"]):
+            raise MockAPIError(
+                422,
+                "load_balancer_already_attached",
+                "load balancer already attached to network",
+            )
+        if not network["subnets"]:
+            raise MockAPIError(422, "invalid_input", "network has no subnets")
+        return {"network": network["id"], "ip": self._private_ip(network, ip)}
+
+    def _service(self, body: Dict) -> Dict[str, Any]:
+        self._require(
+            body,
+            "protocol",
+            "listen_port",
+            "destination_port",
+            "proxyprotocol",
+            "health_check",
+        )
+        if body["protocol"] not in ("tcp", "http", "https"):
+            raise MockAPIError(422, "invalid_input", "unknown protocol")
+        check = {"http": None, **body["health_check"]}
+        self._require(check, "protocol", "port", "interval", "timeout", "retries")
+        service = {
+            "protocol": body["protocol"],
+            "listen_port": body["listen_port"],
+            "destination_port": body["destination_port"],
+            "proxyprotocol": body["proxyprotocol"],
+            "health_check": check,
+            "http": None,
+        }
+        if body["protocol"] != "tcp":
+            service["http"] = {
+                "cookie_name": "HCLBSTICKY",
+                "cookie_lifetime": 300,
+                "certificates": [],
+                "redirect_http": False,
+                "sticky_sessions": False,
+                **(body.get("http") or {}),
+            }
+            for certificate in service["http"]["certificates"]:
+                self._find("certificates", certificate)
+            if body["protocol"] == "https" and not service["http"]["certificates"]:
+                raise MockAPIError(
+                    422, "invalid_input", "https services need a certificate"
+                )
+        return service
+
+    def _add_service(self, lb: Dict, body: Dict) -> None:
+        service = self._service(body)
+        if any(x["listen_port"] == service["listen_port"] for x in lb["services"]):
+            raise MockAPIError(
+                422, "source_port_already_used", "listen port is already used"
+            )
+        if len(lb["services"]) >= lb["load_balancer_type"]["max_services"]:
+            raise MockAPIError(422, "invalid_input", "too many services")
+        lb["services"].append(service)
+
+    def _find_service(self, lb: Dict, listen_port: Any) -> Dict[str, Any]:
+        for service in lb["services"]:
+            if service["listen_port"] == listen_port:
+                return service
+        raise MockAPIError(404, "not_found", f"no service on port {listen_port}")
+
+    def _update_service(self, lb: Dict, body: Dict) -> None:
+        self._require(body, "listen_port")
+        old = self._find_service(lb, body["listen_port"])
+        merged = {**old, **body}
+        for key in ("health_check", "http"):
+            merged[key] = {**(old[key] or {}), **(body.get(key) or {})}
+        lb["services"][lb["services"].index(old)] = self._service(merged)
+
+    def _target_key(self, body: Dict) -> Tuple[str, Any]:
+        if body.get("type") == "server":
+            return "server", self._find("servers", body["server"]["id"])["id"]
+        if body.get("type") == "label_selector":
+            return "label_selector", body["label_selector"]["selector"]
+        raise MockAPIError(422, "invalid_input", "unknown target type")
+
+    def _add_target(self, lb: Dict, body: Dict) -> None:
+        kind, ref = self._target_key(body)
+        private = bool(body.get("use_private_ip"))
+        if any(self._target_key(x) == (kind, ref) for x in lb["targets"]):
+            raise MockAPIError(
+                422, "target_already_defined", "target is already defined"
+            )
+        if len(lb["targets"]) >= lb["load_balancer_type"]["max_targets"]:
+            raise MockAPIError(
+                422, "resource_limit_exceeded", "load balancer has too many targets"
+            )
+        if private and not lb["private_net"]:
+            raise MockAPIError(
+                422, "load_balancer_not_attached_to_network", "no private network"
+            )
+        if kind == "server" and private:
+            server = self.resources["servers"][ref]
+            networks = {n["network"] for n in server["private_net"]}
+            if not networks & {n["network"] for n in lb["private_net"]}:
+                raise MockAPIError(
+                    422,
+                    "target_server_not_attached_to_network",
+                    "server isn't in the load balancer's network",
+                )
+        target: Dict[str, Any] = {"type": kind, "use_private_ip": private}
+        if kind == "server":
+            target["server"] = {"id": ref}
+            target["health_status"] = []
+        else:
+            target["label_selector"] = {"selector": ref}
+            target["targets"] = []
+        lb["targets"].append(target)
+
+    def _match_targets(self, lb: Dict) -> None:
+        """List the servers each label selector target currently matches."""
+        for target in lb["targets"]:
+            if target["type"] == "label_selector":
+                selector = target["label_selector"]["selector"]
+                target["targets"] = [
+                    {
+                        "type": "server",
+                        "server": {"id": x["id"]},
+                        "use_private_ip": target["use_private_ip"],
+                        "health_status": [],
+                    }
+                    for x in self.resources["servers"].values()
+                    if _match_labels(x["labels"], selector)
+                ]
+
+    def _remove_target(self, lb: Dict, body: Dict) -> None:
+        key = self._target_key(body)
+        before = len(lb["targets"])
+        lb["targets"] = [x for x in lb["targets"] if self._target_key(x) != key]
+        if len(lb["targets"]) == before:
+            raise MockAPIError(404, "not_found", "target not found")
+
+    def _load_balancer_action(
+        self, query: Dict, body: Dict, id: str, command: str
+    ) -> Tuple[int, Any]:
+        lb = self._find("load_balancers", id)
+        resources: List[Tuple[str, int]] = [("load_balancers", lb["id"])]
+        self._check_locked(*resources)
+
+        if command == "add_service":
+            self._add_service(lb, body)
+        elif command == "update_service":
+            self._update_service(lb, body)
+        elif command == "delete_service":
+            lb["services"].remove(self._find_service(lb, body.get("listen_port")))
+        elif command in ("add_target", "remove_target"):
+            if command == "add_target":
+                self._add_target(lb, body)
+            else:
+                self._remove_target(lb, body)
+        elif command == "change_algorithm":
+            self._change_algorithm(lb, body)
+        elif command == "change_type":
+            lb_type = self._load_balancer_type(body.get("load_balancer_type"))
+            if len(lb["targets"]) > lb_type["max_targets"]:
+                raise MockAPIError(
+                    422, "invalid_input", "too many targets for the new type"
+                )
+            lb["load_balancer_type"] = lb_type
+            command = "change_load_balancer_type"
+        elif command == "attach_to_network":
+            network = self._find("networks", body["network"])
+            resources.append(("networks", network["id"]))
+            self._check_locked(("networks", network["id"]))
+            lb["private_net"].append(self._lb_network(lb, network, body.get("ip")))
+            network["load_balancers"].append(lb["id"])
+        elif command == "detach_from_network":
+            network = self._find("networks", body["network"])
+            resources.append(("networks", network["id"]))
+            if not any(n["network"] == network["id"] for n in lb["private_net"]):
+                raise MockAPIError(
+                    422,
+                    "load_balancer_not_attached_to_network",
+                    "load balancer not attached to network",
+                )
+            lb["private_net"] = [
+                n for n in lb["private_net"] if n["network"] != network["id"]
+            ]
+            network["load_balancers"].remove(lb["id"])
+        elif command == "enable_public_interface":
+            lb["public_net"]["enabled"] = True
+        elif command == "disable_public_interface":
+            lb["public_net"]["enabled"] = False
+        elif command != "change_protection":
+            raise MockAPIError(
+                404, "not_found", f"unknown load balancer action {command}"
+            )
+        return 201, {"action": self._action(command, resources)}
+
+    # Placement groups
+
+    def _new_placement_group(
+        self,
+        name: str,
+        type: str = "spread",
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._check_unique_name("placement_groups", name)
+        if type != "spread":
+            raise MockAPIError(422, "invalid_input", f"unknown type ‘{type}’")
+        id = self._new_id()
+        group = {
+            "id": id,
+            "name": name,
+            "type": type,
+            "servers": [],
+            "labels": labels or {},
+            "created": _now(),
+        }
+        self.resources["placement_groups"][id] = group
+        return group
+
+    def _create_placement_group(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "name", "type")
+        return 201, {
+            "placement_group": self._new_placement_group(**body),
+            "action": None,
+        }
+
+    def _check_placement_room(self, group: Dict) -> None:
+        # Spread groups keep every server on its own host.
+        if len(group["servers"]) >= PLACEMENT_GROUP_SIZE:
+            raise MockAPIError(
+                422, "placement_error", "no more servers fit in the placement group"
+            )
+
+    def _place(self, server: Dict, group: Dict) -> None:
+        group["servers"].append(server["id"])
+        server["placement_group"] = {k: v for k, v in group.items() if k != "servers"}
+
+    # SSH keys and certificates
+
+    def _new_ssh_key(
+        self,
+        name: str,
+        public_key: str,
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._check_unique_name("ssh_keys", name)
+        fingerprint = _fingerprint(public_key)
+        if any(
+            x["fingerprint"] == fingerprint for x in self.resources["ssh_keys"].values()
+        ):
+            raise MockAPIError(409, "uniqueness_error", "SSH key already exists")
+        id = self._new_id()
+        ssh_key = {
+            "id": id,
+            "name": name,
+            "fingerprint": fingerprint,
+            "public_key": public_key,
+            "labels": labels or {},
+            "created": _now(),
+        }
+        self.resources["ssh_keys"][id] = ssh_key
+        return ssh_key
+
+    def _create_ssh_key(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "name", "public_key")
+        return 201, {"ssh_key": self._new_ssh_key(**body)}
+
+    def _new_certificate(
+        self,
+        name: str,
+        certificate: Optional[str] = None,
+        private_key: Optional[str] = None,
+        type: str = "uploaded",
+        domain_names: Optional[List[str]] = None,
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._check_unique_name("certificates", name)
+        id = self._new_id()
+        cert = {
+            "id": id,
+            "name": name,
+            "type": type,
+            "certificate": certificate,
+            "created": _now(),
+            "not_valid_before": _now(),
+            "not_valid_after": "2030-08-03T15:34:57+00:00",
+            "domain_names": domain_names or [],
+            "fingerprint": hashlib.sha256((certificate or name).encode()).hexdigest(),
+            "status": None,
+            "used_by": [],
+            "labels": labels or {},
+        }
+        self.resources["certificates"][id] = cert
+        return cert
+
+    def _create_certificate(self, query: Dict, body: Dict) -> Tuple[int, Any]:
+        self._require(body, "name")
+        if body.get("type", "uploaded") == "uploaded":
+            self._require(body, "certificate", "private_key")
+        cert = self._new_certificate(**body)
+        if cert["type"] == "managed":
+            action = self._action("create_certificate", [("certificates", cert["id"])])
+            return 201, {"certificate": cert, "action": action}
+        return 201, {"certificate": cert}
+
+
+def _fingerprint(public_key: str) -> str:
+    """The MD5 fingerprint Hetzner Cloud identifies SSH keys by."""
+    try:
+        data = base64.b64decode(public_key.split()[1])
+    except (IndexError, ValueError):
+        raise MockAPIError(422, "invalid_input", "invalid SSH public key")
+    digest = hashlib.md5(data).hexdigest()
+    return ":".join(digest[i : i + 2] for i in range(0, len(digest), 2))
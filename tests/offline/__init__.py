@@ -0,0 +1,80 @@
+import os
+import shlex
+import tempfile
+from unittest import mock
+
+from nixops_hetznercloud.backends.hetznercloud import HetznerCloudState
+from nixops_hetznercloud.hetznercloud_client import registry
+
+from tests import destroy
+from tests.functional import GenericDeploymentTest
+from tests.hcloud_mock import MockHetznerCloud
+
+
+def _run_command(command, capture_stdout=False, **kwargs):
+    # Every volume device being waited for shows up at once.
+    if "nixops-devices" in command:
+        devices = shlex.split(command)[4:]
+        return "".join(f"nixops-device {i} /dev/sd{i}\n" for i in range(len(devices)))
+    return "" if capture_stdout else 0
+
+
+class OfflineDeploymentTest(GenericDeploymentTest):
+    """
+    Deployment against an in-memory Hetzner Cloud API.
+
+    The mock's servers never boot, so everything that would reach a machine
+    over SSH is replaced by a no-op that succeeds.
+    """
+
+    nix_expr: str
+    action_duration = 0.05
+    latency = 0.0
+
+    def setup(self) -> None:
+        super(OfflineDeploymentTest, self).setup()
+        self.api = MockHetznerCloud(
+            latency=self.latency, action_duration=self.action_duration
+        ).start()
+        self.depl.nix_exprs = [self.nix_expr]
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.patches = [
+            mock.patch.dict(
+                os.environ,
+                {
+                    "HCLOUD_ENDPOINT": self.api.endpoint,
+                    "HCLOUD_API_TOKEN": "offline",
+                    "HCLOUD_CATALOGUE_CACHE": f"{self.cache_dir.name}/catalogue.json",
+                },
+            ),
+            mock.patch.object(HetznerCloudState, "wait_for_ssh"),
+            mock.patch.object(HetznerCloudState, "reboot_sync"),
+            mock.patch.object(
+                HetznerCloudState, "run_command", side_effect=_run_command
+            ),
+            mock.patch("nixops_hetznercloud.backends.hetznercloud.known_hosts"),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self) -> None:
+        try:
+            destroy(self.sf, self.depl.uuid)
+        finally:
+            for patch in reversed(self.patches):
+                patch.stop()
+            registry.clear()
+            self.api.stop()
+            self.cache_dir.cleanup()
+            super(OfflineDeploymentTest, self).teardown()
+
+    def deploy(self, **kwargs) -> None:
+        self.depl.deploy(create_only=True, **kwargs)
+
+    def labelled(self, kind: str):
+        """Resources of a kind which belong to this deployment."""
+        return [
+            x
+            for x in self.api.resources[kind].values()
+            if x["labels"].get("CharonNetworkUUID") == self.depl.uuid
+        ]
@@ -0,0 +1,27 @@
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  resources.hetznerCloudFloatingIPs.fip1 = {
+    location = "nbg1";
+  };
+  resources.hetznerCloudFloatingIPs.fip2 = {
+    location = "nbg1";
+  };
+
+  primary =
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        location = "nbg1";
+        ipAddresses = with resources.hetznerCloudFloatingIPs; [ fip1 fip2 ];
+      };
+    };
+
+  standby =
+    { ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud.location = "nbg1";
+    };
+}
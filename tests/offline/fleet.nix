@@ -0,0 +1,15 @@
+let
+  machine =
+    { ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud.location = "nbg1";
+    };
+in
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  machine1 = machine;
+  machine2 = machine;
+  machine3 = machine;
+}
@@ -0,0 +1,44 @@
+{ first ? 1, byLabel ? false }:
+let
+  backend = i:
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        location = "nbg1";
+        serverNetworks = [
+          { network = resources.hetznerCloudNetworks.network1;
+            privateIpAddress = "10.1.0.${toString (10 + i)}";
+          }
+        ];
+      };
+    };
+in
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  resources.hetznerCloudNetworks.network1 = {
+    ipRange = "10.1.0.0/16";
+    subnets = [ "10.1.0.0/24" ];
+  };
+
+  resources.hetznerCloudLoadBalancers.lb1 =
+    { resources, lib, ... }:
+    {
+      location = "nbg1";
+      network = resources.hetznerCloudNetworks.network1;
+      usePrivateIp = true;
+      targets = map (i: resources.machines."web${toString i}") (lib.range first (first + 2));
+      targetsByLabel = byLabel;
+      labelSelectors = [ "role=web" ];
+      services = [
+        { protocol = "http"; listenPort = 80; destinationPort = 8080; }
+        { protocol = "tcp"; listenPort = 22; destinationPort = 22; }
+      ];
+    };
+
+  web1 = backend 1;
+  web2 = backend 2;
+  web3 = backend 3;
+  web4 = backend 4;
+}
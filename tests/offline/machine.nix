@@ -0,0 +1,30 @@
+{ autoAddress ? false, sharedKey ? false }:
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  resources.hetznerCloudVolumes.volume1 = {
+    location = "nbg1";
+    size = 10;
+  };
+
+  resources.hetznerCloudNetworks.network1 = {
+    ipRange = "10.1.0.0/16";
+    subnets = [ "10.1.0.0/24" ];
+  };
+
+  machine =
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        location = "nbg1";
+        serverType = "cx11";
+        sharedSSHKey = sharedKey;
+        serverNetworks = [
+          ({ network = resources.hetznerCloudNetworks.network1; }
+            // (if autoAddress then { } else { privateIpAddress = "10.1.0.2"; }))
+        ];
+      };
+      fileSystems."/data".hetznerCloud.volume = resources.hetznerCloudVolumes.volume1;
+    };
+}
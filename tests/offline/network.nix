@@ -0,0 +1,14 @@
+{ routes ? 1 }:
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  resources.hetznerCloudNetworks.network1 =
+    { lib, ... }:
+    {
+      ipRange = "10.1.0.0/16";
+      subnets = [ "10.1.0.0/24" "10.1.1.0/24" ];
+      routes = map
+        (i: { destination = "10.${toString (2 + i)}.0.0/16"; gateway = "10.1.0.254"; })
+        (lib.range 0 (routes - 1));
+    };
+}
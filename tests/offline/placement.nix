@@ -0,0 +1,24 @@
+{ spread ? true }:
+let
+  replica =
+    { resources, ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        location = "nbg1";
+        placementGroup =
+          with resources.hetznerCloudPlacementGroups;
+          if spread then [ group1 group2 ] else group1;
+      };
+    };
+in
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  resources.hetznerCloudPlacementGroups.group1 = { };
+  resources.hetznerCloudPlacementGroups.group2 = { };
+
+  db1 = replica;
+  db2 = replica;
+  db3 = replica;
+}
@@ -0,0 +1,20 @@
+{ serverType ? "cx11" }:
+let
+  web =
+    { ... }:
+    {
+      deployment.targetEnv = "hetznercloud";
+      deployment.hetznerCloud = {
+        location = "nbg1";
+        inherit serverType;
+      };
+    };
+in
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  web1 = web;
+  web2 = web;
+  web3 = web;
+  web4 = web;
+}
@@ -0,0 +1,43 @@
+import os
+from os.path import dirname
+from unittest import mock
+
+from tests.offline import OfflineDeploymentTest
+
+
+class TestBulkDestroy(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/machine.nix"
+
+    def test_destroy_by_label(self) -> None:
+        self.deploy()
+        kinds = ["servers", "volumes", "networks", "ssh_keys"]
+        assert all(self.labelled(kind) for kind in kinds)
+
+        # Objects nixops has no state for are deleted too.
+        self.api.add(
+            "floating_ips",
+            type="ipv4",
+            home_location="nbg1",
+            labels={"CharonNetworkUUID": self.depl.uuid},
+        )
+        self.api.reset_requests()
+        with mock.patch.dict(os.environ, {"HCLOUD_BULK_DESTROY": "1"}):
+            self.depl.destroy_resources()
+
+        for kind in kinds + ["floating_ips"]:
+            assert not self.labelled(kind), kind
+        for res in self.depl.resources.values():
+            assert res.state == res.MISSING
+        # Volumes are detached by deleting their server, not one by one.
+        assert not self.api.request_count("POST", "/volumes/")
+        # The deployment is listed once, however many resources it has.
+        assert self.api.request_count("GET", "^/load_balancers$") == 1
+
+    def test_destroy_again_after_redeploy(self) -> None:
+        with mock.patch.dict(os.environ, {"HCLOUD_BULK_DESTROY": "1"}):
+            self.deploy()
+            self.depl.destroy_resources()
+            self.deploy()
+            assert self.labelled("servers")
+            self.depl.destroy_resources()
+        assert not self.labelled("servers")
@@ -0,0 +1,41 @@
+import os
+from os.path import dirname
+
+from nixops_hetznercloud.hetznercloud_catalogue import cache
+
+from tests.offline import OfflineDeploymentTest
+
+
+class TestCatalogue(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/machine.nix"
+
+    def test_catalogue_is_cached(self) -> None:
+        self.deploy()
+        # The volume and the machine share one fetch of the catalogue.
+        assert self.api.request_count("GET", "^/locations") == 1
+        assert self.api.request_count("GET", "^/server_types") == 1
+        assert os.path.exists(os.environ["HCLOUD_CATALOGUE_CACHE"])
+
+        self.depl.destroy_resources()
+        self.api.reset_requests()
+        self.deploy()
+        assert not self.api.request_count("GET", "^/(locations|server_types|images)")
+
+    def test_retired_server_type(self) -> None:
+        self.deploy()
+        del cache.cached().server_types["cx11"]
+
+        # The existing machine is still checked and destroyed.
+        self.deploy(check=True)
+        self.depl.destroy_resources()
+        assert not self.labelled("servers")
+
+        # But no new machine is created, and no API call is made for it.
+        self.api.reset_requests()
+        try:
+            self.deploy()
+        except Exception as e:
+            assert "unknown Hetzner Cloud server type ‘cx11’" in str(e)
+        else:
+            raise AssertionError("the server type should be unknown")
+        assert not self.api.request_count("POST", "^/(servers|ssh_keys)")
@@ -0,0 +1,44 @@
+from os.path import dirname
+
+from nixops_hetznercloud.backends.failover import failover
+
+from tests.offline import OfflineDeploymentTest
+
+
+class TestFailover(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/failover.nix"
+
+    def assigned(self):
+        return sorted(x["server"] for x in self.api.resources["floating_ips"].values())
+
+    def test_failover(self) -> None:
+        self.deploy()
+        primary = self.depl.machines["primary"]
+        standby = self.depl.machines["standby"]
+        assert self.assigned() == [primary.vm_id] * 2
+
+        # Failing over only assigns the IPs and polls for the actions.
+        self.api.reset_requests()
+        failover(self.depl, "standby", ["fip1", "fip2"])
+        assert self.assigned() == [standby.vm_id] * 2
+        assert self.api.request_count("POST", "/actions/assign", ok=True) == 2
+        assert self.api.request_count("GET", "^/(servers|floating_ips)") == 0
+        assert not primary.ip_addresses
+        addresses = {
+            f"nixops-{self.depl.uuid}-{x}": self.depl.resources[x].address
+            for x in ("fip1", "fip2")
+        }
+        assert standby.ip_addresses == addresses
+
+        # Deploying moves them back as specified.
+        self.deploy()
+        assert self.assigned() == [primary.vm_id] * 2
+        assert primary.ip_addresses == addresses
+        assert not standby.ip_addresses
+
+        try:
+            failover(self.depl, "standby", ["primary"])
+        except Exception:
+            pass
+        else:
+            raise AssertionError("failing over a machine should fail")
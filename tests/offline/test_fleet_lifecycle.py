@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname
+from unittest import mock
+
+from nixops_hetznercloud.backends import fleet
+
+from tests.offline import OfflineDeploymentTest
+
+
+class TestFleetLifecycle(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/fleet.nix"
+
+    def statuses(self):
+        return sorted(x["status"] for x in self.api.resources["servers"].values())
+
+    def check(self):
+        machines = list(self.depl.machines.values())
+        with ThreadPoolExecutor(len(machines)) as executor:
+            return dict(zip(machines, executor.map(lambda m: m.check(), machines)))
+
+    def test_power_and_check(self) -> None:
+        self.deploy()
+        machines = list(self.depl.machines.values())
+
+        self.depl.stop_machines()
+        assert self.statuses() == ["off"] * 3
+        assert all(m.state == m.STOPPED for m in machines)
+
+        self.depl.start_machines()
+        assert self.statuses() == ["running"] * 3
+        assert all(m.state == m.UP for m in machines)
+
+        self.api.reset_requests()
+        self.depl.reboot_machines(hard=True)
+        assert self.api.request_count("POST", "/actions/reset$", ok=True) == 3
+        assert all(m.state == m.UP for m in machines)
+
+        # Machines checked together share one labelled list of the servers.
+        self.api.reset_requests()
+        results = self.check()
+        assert self.api.request_count("GET", "^/servers$") == 1
+        assert all(x.exists and x.is_up for x in results.values())
+
+        gone = self.depl.machines["machine2"]
+        self.api.delete("servers", gone.vm_id)
+        results = self.check()
+        assert not results[gone].exists
+        assert gone.state == gone.MISSING
+
+    def test_failure_stays_with_its_machine(self) -> None:
+        self.deploy()
+        failing = self.depl.machines["machine1"]
+        self.api.inject_error(
+            "POST", f"/servers/{failing.vm_id}/actions/shutdown", 500, "server_error"
+        )
+        try:
+            self.depl.stop_machines()
+        except Exception:
+            pass
+        servers = self.api.resources["servers"]
+        assert servers[failing.vm_id]["status"] == "running"
+        for m in self.depl.machines.values():
+            if m is not failing:
+                assert servers[m.vm_id]["status"] == "off"
+                assert m.state == m.STOPPED
+
+    def test_status_poll_errors_are_retried(self) -> None:
+        self.deploy()
+        # Polls for the machines' statuses which fail transiently are retried
+        # rather than failing every machine waiting on them.
+        self.api.inject_error("GET", "^/servers$", 503, "unavailable", times=2)
+        self.depl.stop_machines()
+        assert self.statuses() == ["off"] * 3
+        assert all(m.state == m.STOPPED for m in self.depl.machines.values())
+
+    def test_action_poll_errors_are_retried(self) -> None:
+        self.deploy()
+        self.api.inject_error("GET", "^/actions$", 503, "unavailable", times=2)
+        self.depl.reboot_machines(hard=True)
+        assert self.api.request_count("GET", "^/actions$", ok=False) == 2
+        assert all(m.state == m.UP for m in self.depl.machines.values())
+
+    def test_remove_backup(self) -> None:
+        self.deploy()
+        machines = list(self.depl.machines.values())
+        fleet.backup(machines, "20260101000000")
+        images = {m.backups["20260101000000"] for m in machines}
+
+        # Removing a backup from every machine at once prunes all of its
+        # snapshots in one batch.
+        with mock.patch.object(
+            fleet, "remove_backups", wraps=fleet.remove_backups
+        ) as remove_backups:
+            with ThreadPoolExecutor(len(machines)) as executor:
+                list(
+                    executor.map(lambda m: m.remove_backup("20260101000000"), machines)
+                )
+        assert remove_backups.call_count == 1
+        assert not images & set(self.api.resources["images"])
+        assert all(not m.backups for m in machines)
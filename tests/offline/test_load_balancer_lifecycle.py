@@ -0,0 +1,94 @@
+from os.path import dirname
+from tests.offline import OfflineDeploymentTest
+
+
+class TestLoadBalancerLifecycle(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/load_balancer.nix"
+
+    def server_ids(self, *names: str):
+        return {self.depl.machines[name].vm_id for name in names}
+
+    def targets(self, lb):
+        return {
+            x["server"]["id"]
+            if x["type"] == "server"
+            else x["label_selector"]["selector"]
+            for x in lb["targets"]
+        }
+
+    def test_hetznercloud_load_balancer(self) -> None:
+        self.deploy()
+        res = self.depl.resources["lb1"]
+        assert res.state == res.UP
+        (lb,) = self.api.resources["load_balancers"].values()
+        (network,) = self.api.resources["networks"].values()
+        assert lb["id"] == int(res.resource_id)
+        assert [x["network"] for x in lb["private_net"]] == [network["id"]]
+        assert self.targets(lb) == self.server_ids("web1", "web2", "web3") | {
+            "role=web"
+        }
+        assert all(x["use_private_ip"] for x in lb["targets"])
+        assert {(x["listen_port"], x["destination_port"]) for x in lb["services"]} == {
+            (80, 8080),
+            (22, 22),
+        }
+
+        # Redeploying without changes doesn't touch the load balancer.
+        self.api.reset_requests()
+        self.deploy()
+        assert self.api.request_count("POST", "/load_balancers") == 0
+
+        # Moving the pool along by one backend is one removal and one addition.
+        self.api.reset_requests()
+        self.depl.set_arg("first", "2")
+        self.deploy()
+        assert self.api.request_count("POST", "/load_balancers") == 2
+        assert self.api.request_count("POST", "/actions/remove_target$") == 1
+        assert self.api.request_count("POST", "/actions/add_target$") == 1
+        assert self.targets(lb) == self.server_ids("web2", "web3", "web4") | {
+            "role=web"
+        }
+
+        self.depl.destroy_resources()
+        assert res.state == res.MISSING
+        assert not self.api.resources["load_balancers"]
+
+    def test_targets_by_label(self) -> None:
+        self.depl.set_arg("byLabel", "true")
+        self.deploy()
+        (lb,) = self.api.resources["load_balancers"].values()
+        selector = (
+            f"CharonNetworkUUID={self.depl.uuid},CharonInstanceName in (web1,web2,web3)"
+        )
+        assert self.targets(lb) == {selector, "role=web"}
+        (machines,) = [
+            x
+            for x in lb["targets"]
+            if x.get("label_selector") == {"selector": selector}
+        ]
+        self.api._match_targets(lb)
+        assert {x["server"]["id"] for x in machines["targets"]} == self.server_ids(
+            "web1", "web2", "web3"
+        )
+
+        # However many machines change, the selector is swapped in two actions.
+        self.api.reset_requests()
+        self.depl.set_arg("first", "2")
+        self.deploy()
+        assert self.api.request_count("POST", "/load_balancers") == 2
+        assert "CharonInstanceName in (web2,web3,web4)" in str(self.targets(lb))
+
+    def test_target_changes_are_made_one_at_a_time(self) -> None:
+        self.deploy()
+
+        # Swapping the three server targets for a label selector removes them
+        # one after another, rather than all at once with all but one of the
+        # removals failing while the load balancer is locked.
+        self.api.reset_requests()
+        self.depl.set_arg("byLabel", "true")
+        self.deploy()
+        assert self.api.request_count("POST", "/actions/remove_target$", ok=True) == 3
+        assert (
+            self.api.request_count("POST", "/actions/(add|remove)_target$", ok=False)
+            == 0
+        )
@@ -0,0 +1,108 @@
+from os.path import dirname
+
+from nixops_hetznercloud.backends import fleet
+
+from tests.offline import OfflineDeploymentTest
+
+
+class TestMachineLifecycle(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/machine.nix"
+
+    def check_deployed(self) -> None:
+        machine = self.depl.machines["machine"]
+        assert machine.state == machine.UP
+        (server,) = self.api.resources["servers"].values()
+        (volume,) = self.api.resources["volumes"].values()
+        (network,) = self.api.resources["networks"].values()
+        assert server["id"] == machine.vm_id
+        assert server["public_net"]["ipv4"]["ip"] == machine.public_ipv4
+        assert server["volumes"] == [volume["id"]]
+        assert [(x["network"], x["ip"]) for x in server["private_net"]] == [
+            (network["id"], "10.1.0.2")
+        ]
+
+    def test_hetznercloud_server(self) -> None:
+        self.deploy()
+        self.check_deployed()
+
+        # Redeploying without changes doesn't touch anything.
+        self.api.reset_requests()
+        self.deploy()
+        assert self.api.request_count("POST") == 0
+        assert self.api.request_count("PUT") == 0
+
+        machine = self.depl.machines["machine"]
+        machine.check()
+        self.depl.stop_machines()
+        assert self.api.resources["servers"][machine.vm_id]["status"] == "off"
+        self.depl.start_machines()
+        assert self.api.resources["servers"][machine.vm_id]["status"] == "running"
+
+        self.depl.destroy_resources()
+        for kind in ("servers", "volumes", "networks", "ssh_keys"):
+            assert not self.api.resources[kind], kind
+
+    def test_attaches_at_create(self) -> None:
+        # Without a fixed address, the network is attached along with the
+        # volume by the request creating the server.
+        self.depl.set_arg("autoAddress", "true")
+        self.api.reset_requests()
+        self.deploy()
+        assert self.api.request_count("POST", "/actions/attach") == 0
+        machine = self.depl.machines["machine"]
+        (server,) = self.api.resources["servers"].values()
+        (volume,) = self.api.resources["volumes"].values()
+        assert server["volumes"] == [volume["id"]]
+        (network,) = machine.server_networks.values()
+        assert network["privateIpAddress"] == server["private_net"][0]["ip"]
+
+    def test_shared_ssh_key(self) -> None:
+        self.depl.set_arg("sharedKey", "true")
+        self.deploy()
+        (key,) = self.api.resources["ssh_keys"].values()
+        assert key["name"] == f"nixops-{self.depl.uuid}"
+        assert key["public_key"] == self.depl.machines["machine"].public_client_key
+
+        self.depl.destroy_resources()
+        assert not self.api.resources["ssh_keys"]
+
+    def test_backup_and_restore(self) -> None:
+        self.deploy()
+        machine = self.depl.machines["machine"]
+        defn = self.depl.definitions["machine"]
+
+        # Backing up only starts the snapshot.
+        machine.backup(defn, "20260101000000")
+        assert machine.get_backups()["20260101000000"]["status"] == "running"
+        fleet.backup([machine], "20260102000000")
+        backups = machine.get_backups()
+        assert [x["status"] for x in backups.values()] == ["complete"] * 2
+
+        # Restoring rebuilds the server from the latest backup.
+        machine.restore(defn, None)
+        server = self.api.resources["servers"][machine.vm_id]
+        assert server["image"]["id"] == machine.backups["20260102000000"]
+
+        images = dict(machine.backups)
+        machine.remove_backup("20260101000000")
+        assert images["20260101000000"] not in self.api.resources["images"]
+        fleet.remove_backups([machine], ["20260102000000"], keep_physical=True)
+        assert images["20260102000000"] in self.api.resources["images"]
+        assert machine.get_backups() == {}
+
+    def test_retries_locked_attachments(self) -> None:
+        self.api.inject_error(
+            "POST", r"/actions/(attach|attach_to_network)$", 423, "locked", times=2
+        )
+        self.deploy()
+        self.check_deployed()
+
+    def test_failed_create(self) -> None:
+        self.api.inject_error("POST", "^/servers$", 503, "unavailable")
+        try:
+            self.deploy()
+        except Exception:
+            pass
+        else:
+            raise AssertionError("deploy should fail when server creation fails")
+        assert not self.api.resources["servers"]
@@ -0,0 +1,48 @@
+from os.path import dirname
+from tests.offline import OfflineDeploymentTest
+
+
+class TestNetworkLifecycle(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/network.nix"
+
+    def test_hetznercloud_network(self) -> None:
+        self.deploy()
+        res = self.depl.resources["network1"]
+        assert res.state == res.UP
+        (network,) = self.api.resources["networks"].values()
+        assert network["id"] == int(res.resource_id)
+        assert {x["ip_range"] for x in network["subnets"]} == {
+            "10.1.0.0/24",
+            "10.1.1.0/24",
+        }
+        assert network["routes"] == [
+            {"destination": "10.2.0.0/16", "gateway": "10.1.0.254"}
+        ]
+
+        # Subnets and routes were created along with the network.
+        assert self.api.request_count("POST", "/networks/.*/actions") == 0
+
+        # Only the routes missing from the live network are added.
+        network["routes"].clear()
+        self.api.reset_requests()
+        self.depl.set_arg("routes", "20")
+        self.deploy()
+        assert self.api.request_count("POST", "/actions/add_route$", ok=True) == 20
+        assert self.api.request_count("POST", "/actions/add_subnet$") == 0
+        assert len(network["routes"]) == 20
+        self.depl.set_arg("routes", "1")
+        self.deploy()
+        assert network["routes"] == [
+            {"destination": "10.2.0.0/16", "gateway": "10.1.0.254"}
+        ]
+
+        # Deleted behind our back; checking recreates it.
+        self.api.delete("networks", network["id"])
+        self.deploy(check=True)
+        (network,) = self.api.resources["networks"].values()
+        assert network["id"] == int(res.resource_id)
+        assert len(network["subnets"]) == 2
+
+        self.depl.destroy_resources()
+        assert res.state == res.MISSING
+        assert not self.api.resources["networks"]
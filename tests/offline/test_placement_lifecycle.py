@@ -0,0 +1,42 @@
+from os.path import dirname
+from tests.offline import OfflineDeploymentTest
+
+
+class TestPlacementLifecycle(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/placement.nix"
+
+    def groups(self):
+        return sorted(
+            len(x["servers"]) for x in self.api.resources["placement_groups"].values()
+        )
+
+    def test_spread_replicas(self) -> None:
+        self.deploy()
+        assert self.groups() == [1, 2]
+        for machine in self.depl.machines.values():
+            server = self.api.resources["servers"][machine.vm_id]
+            assert server["placement_group"]["id"] == machine.placement_group
+
+        # Machines already in one of their groups stay where they are.
+        self.api.reset_requests()
+        self.deploy()
+        assert self.api.request_count("POST", "/actions/add_to_placement_group") == 0
+
+        # Narrowing the machines to one group moves the odd one out.
+        self.depl.set_arg("spread", "false")
+        self.deploy(allow_reboot=True)
+        assert self.groups() == [0, 3]
+
+        self.depl.destroy_resources()
+        assert not self.api.resources["placement_groups"]
+
+    def test_move_needs_reboot(self) -> None:
+        self.deploy()
+        self.depl.set_arg("spread", "false")
+        try:
+            self.deploy()
+        except Exception:
+            pass
+        else:
+            raise AssertionError("moving a running server should need a reboot")
+        assert self.groups() == [1, 2]
@@ -0,0 +1,60 @@
+import os
+from os.path import dirname
+from unittest import mock
+
+from nixops_hetznercloud.backends.hetznercloud import HetznerCloudState
+from nixops_hetznercloud.backends.rolling import get_rolling_resize
+
+from tests.offline import OfflineDeploymentTest
+
+
+class TestResizeLifecycle(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/resize.nix"
+
+    def server_types(self):
+        return sorted(
+            self.api.resources["servers"][x.vm_id]["server_type"]["name"]
+            for x in self.depl.machines.values()
+        )
+
+    def test_rolling_server_type_change(self) -> None:
+        self.deploy()
+        self.depl.set_argstr("serverType", "cx21")
+
+        try:
+            self.deploy()
+        except Exception:
+            pass
+        else:
+            raise AssertionError("changing the server type should need a reboot")
+        assert self.server_types() == ["cx11"] * 4
+
+        with mock.patch.dict(os.environ, {"HCLOUD_MAX_UNAVAILABLE": "2"}):
+            self.deploy(allow_reboot=True)
+        assert self.server_types() == ["cx21"] * 4
+        for machine in self.depl.machines.values():
+            assert machine.server_type == "cx21"
+            assert machine.state == machine.UP
+
+        # No more than two machines were down at once.
+        waves = get_rolling_resize(self.depl.uuid).waves
+        assert sorted(len(names) for names, _ in waves) == [2, 2]
+
+    def test_rolling_server_type_change_after_failure(self) -> None:
+        self.deploy()
+        self.depl.set_argstr("serverType", "cx21")
+
+        with mock.patch.object(
+            HetznerCloudState, "_change_server_type", side_effect=Exception("stuck")
+        ):
+            try:
+                self.deploy(allow_reboot=True)
+            except Exception:
+                pass
+            else:
+                raise AssertionError("the server type change should fail")
+        assert self.server_types() == ["cx11"] * 4
+
+        # The failed rollout doesn't hold back the next deploy.
+        self.deploy(allow_reboot=True)
+        assert self.server_types() == ["cx21"] * 4
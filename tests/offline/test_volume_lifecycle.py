@@ -0,0 +1,37 @@
+from os.path import dirname
+from tests.offline import OfflineDeploymentTest
+
+
+class TestVolumeLifecycle(OfflineDeploymentTest):
+    nix_expr = f"{dirname(__file__)}/volume.nix"
+
+    def test_hetznercloud_volume(self) -> None:
+        self.deploy()
+        res = self.depl.resources["volume1"]
+        assert res.state == res.UP
+        (volume,) = self.api.resources["volumes"].values()
+        assert volume["id"] == int(res.resource_id)
+        assert volume["size"] == 10
+        assert volume["labels"]["CharonNetworkUUID"] == self.depl.uuid
+
+        # Deleted behind our back; checking recreates it.
+        self.api.delete("volumes", volume["id"])
+        self.deploy(check=True)
+        (volume,) = self.api.resources["volumes"].values()
+        assert volume["id"] == int(res.resource_id)
+
+        self.depl.destroy_resources()
+        assert res.state == res.MISSING
+        assert not self.api.resources["volumes"]
+
+    def test_lookups_after_a_deploy_are_fresh(self) -> None:
+        self.deploy()
+        res = self.depl.resources["volume1"]
+        self.api.resources["volumes"][int(res.resource_id)]["size"] = 20
+
+        # The deploy's snapshot went with it, so the volume is fetched afresh
+        # rather than listing every volume again.
+        self.api.reset_requests()
+        assert res.get_instance().size == 20
+        assert self.api.request_count("GET", "^/volumes$") == 0
+        assert self.api.request_count("GET", "^/volumes/") == 1
@@ -0,0 +1,8 @@
+{
+  network.description = "NixOps HetznerCloud Offline Test";
+
+  resources.hetznerCloudVolumes.volume1 = {
+    location = "nbg1";
+    size = 10;
+  };
+}